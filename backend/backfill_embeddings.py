@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# backfill_embeddings.py - Radix IA
+"""
+Pipeline reanudable para (re)construir `reporte_embeddings_new` a partir de
+los reportes existentes.
+
+- Recorre `reportes` en páginas con paginación por clave (id ascendente)
+- Divide cada reporte en fragmentos por sección y calcula embeddings en
+  lotes con concurrencia acotada
+- Inserta los vectores de cada página en un único insert multi-fila
+- Guarda un checkpoint tras cada página para reanudar sin repetir trabajo
+
+Uso:
+    python backfill_embeddings.py --page-size 200 --batch-size 32 --concurrency 4
+    python backfill_embeddings.py --rebuild --reset
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from dataclasses import dataclass, asdict, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from chunking import dividir_por_secciones
+
+TABLA_EMBEDDINGS = 'reporte_embeddings_new'
+COLUMNAS_REPORTE = 'id,paciente_id,reporte_generado,tecnica,hallazgos,impresion_diagnostica,recomendaciones'
+
+
+@dataclass
+class BackfillCheckpoint:
+    """Estado persistido del backfill"""
+    last_id: Optional[str] = None
+    reportes_procesados: int = 0
+    reportes_omitidos: int = 0
+    chunks_insertados: int = 0
+    errores: int = 0
+    updated_at: Optional[str] = None
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "BackfillCheckpoint":
+        """Cargar checkpoint desde disco (o uno vacío si no existe)"""
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(**json.load(f))
+        return cls()
+
+    def save(self, path: Optional[str]) -> None:
+        """Guardar checkpoint de forma atómica"""
+        if not path:
+            return
+        self.updated_at = datetime.now().isoformat()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+
+@dataclass
+class BackfillMetrics:
+    """Métricas de throughput de una ejecución"""
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    paginas: int = 0
+    reportes: int = 0
+    chunks: int = 0
+    en_ejecucion: bool = True
+    ultimo_error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "en_ejecucion": self.en_ejecucion,
+            "paginas": self.paginas,
+            "reportes": self.reportes,
+            "chunks": self.chunks,
+            "segundos": round(elapsed, 2),
+            "reportes_por_segundo": round(self.reportes / elapsed, 2) if elapsed > 0 else 0.0,
+            "chunks_por_segundo": round(self.chunks / elapsed, 2) if elapsed > 0 else 0.0,
+            "ultimo_error": self.ultimo_error
+        }
+
+
+def texto_reporte(reporte: Dict[str, Any]) -> str:
+    """Texto a indexar: el reporte generado o, si es manual, sus secciones"""
+    if reporte.get('reporte_generado'):
+        return reporte['reporte_generado']
+    secciones = [
+        ('TÉCNICA', reporte.get('tecnica')),
+        ('HALLAZGOS', reporte.get('hallazgos')),
+        ('IMPRESIÓN DIAGNÓSTICA', reporte.get('impresion_diagnostica')),
+        ('RECOMENDACIONES', reporte.get('recomendaciones')),
+    ]
+    return "\n\n".join(f"{titulo}:\n{contenido}" for titulo, contenido in secciones if contenido)
+
+
+class EmbeddingBackfill:
+    """Job de backfill de embeddings de reportes"""
+
+    def __init__(self, supabase, db, embedding_service, page_size: int = 100,
+                 batch_size: int = 32, concurrency: int = 4,
+                 checkpoint_path: Optional[str] = "backfill_checkpoint.json",
+                 rebuild: bool = False):
+        self.supabase = supabase
+        self.db = db
+        self.embedding_service = embedding_service
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.checkpoint_path = checkpoint_path
+        self.rebuild = rebuild
+        self.checkpoint = BackfillCheckpoint.load(checkpoint_path)
+        self.metrics = BackfillMetrics()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self, max_pages: Optional[int] = None) -> Dict[str, Any]:
+        """Procesar páginas hasta agotar los reportes (o `max_pages`)"""
+        try:
+            while max_pages is None or self.metrics.paginas < max_pages:
+                reportes = await self._fetch_page(self.checkpoint.last_id)
+                if not reportes:
+                    break
+                await self._process_page(reportes)
+                self.checkpoint.last_id = reportes[-1]['id']
+                self.checkpoint.save(self.checkpoint_path)
+                self.metrics.paginas += 1
+                print(f"📦 Página {self.metrics.paginas}: {self.metrics.to_dict()}")
+        except Exception as e:
+            self.metrics.ultimo_error = str(e)
+            print(f"❌ Error en backfill de embeddings: {e}")
+            raise
+        finally:
+            self.metrics.en_ejecucion = False
+            self.metrics.finished_at = time.time()
+        return self.metrics.to_dict()
+
+    async def _fetch_page(self, after_id: Optional[str]) -> List[Dict[str, Any]]:
+        """Obtener la siguiente página de reportes por clave"""
+        query = self.supabase.table('reportes').select(COLUMNAS_REPORTE).order('id')
+        if after_id:
+            query = query.gt('id', after_id)
+        result = await self.db.execute(query.limit(self.page_size))
+        return result.data or []
+
+    async def _ya_indexados(self, reporte_ids: List[str]) -> Set[str]:
+        """Reportes de la página que ya tienen embeddings"""
+        result = await self.db.execute(
+            self.supabase.table(TABLA_EMBEDDINGS).select('reporte_id').in_('reporte_id', reporte_ids)
+        )
+        return {row['reporte_id'] for row in result.data or []}
+
+    async def _process_page(self, reportes: List[Dict[str, Any]]) -> None:
+        reporte_ids = [r['id'] for r in reportes]
+        if self.rebuild:
+            await self.db.execute(
+                self.supabase.table(TABLA_EMBEDDINGS).delete().in_('reporte_id', reporte_ids)
+            )
+            indexados: Set[str] = set()
+        else:
+            indexados = await self._ya_indexados(reporte_ids)
+
+        # Fragmentar todos los reportes pendientes de la página
+        filas: List[Dict[str, Any]] = []
+        for reporte in reportes:
+            if reporte['id'] in indexados:
+                self.checkpoint.reportes_omitidos += 1
+                continue
+            for chunk in dividir_por_secciones(texto_reporte(reporte)):
+                filas.append({
+                    'reporte_id': reporte['id'],
+                    'paciente_id': reporte['paciente_id'],
+                    'contenido': chunk.contenido,
+                    'seccion': chunk.seccion,
+                    'chunk_inicio': chunk.inicio,
+                    'chunk_fin': chunk.fin
+                })
+
+        # Embeddings en lotes con concurrencia acotada
+        lotes = [filas[i:i + self.batch_size] for i in range(0, len(filas), self.batch_size)]
+        await asyncio.gather(*(self._embed_lote(lote) for lote in lotes))
+
+        # Un único insert multi-fila por página (atómico en PostgREST)
+        if filas:
+            await self.db.execute(self.supabase.table(TABLA_EMBEDDINGS).insert(filas))
+
+        procesados = len(reportes) - len(indexados)
+        self.checkpoint.reportes_procesados += procesados
+        self.checkpoint.chunks_insertados += len(filas)
+        self.metrics.reportes += procesados
+        self.metrics.chunks += len(filas)
+
+    async def _embed_lote(self, lote: List[Dict[str, Any]]) -> None:
+        async with self._semaphore:
+            embeddings = await self.embedding_service.encode_batch([f['contenido'] for f in lote])
+        for fila, embedding in zip(lote, embeddings):
+            fila['embedding'] = embedding
+
+
+async def _main(args: argparse.Namespace) -> None:
+    from dotenv import load_dotenv
+    from supabase import create_client
+    from db import get_db_executor
+    from http_client import get_http_clients
+    from services import EmbeddingService
+
+    load_dotenv()
+    supabase = create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_KEY"))
+    http_clients = get_http_clients()
+    embedding_service = EmbeddingService(
+        os.environ.get("EMBEDDING_API_URL", "https://fs7mn6r3tsu0su7q.us-east-1.aws.endpoints.huggingface.cloud"),
+        http_clients,
+        max_batch_size=args.batch_size
+    )
+
+    if args.reset and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    backfill = EmbeddingBackfill(
+        supabase, get_db_executor(), embedding_service,
+        page_size=args.page_size, batch_size=args.batch_size,
+        concurrency=args.concurrency, checkpoint_path=args.checkpoint,
+        rebuild=args.rebuild
+    )
+    try:
+        metrics = await backfill.run(max_pages=args.max_pages)
+        print(f"✅ Backfill completado: {metrics}")
+    finally:
+        await http_clients.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backfill de embeddings de reportes")
+    parser.add_argument("--page-size", type=int, default=100, help="Reportes por página")
+    parser.add_argument("--batch-size", type=int, default=32, help="Fragmentos por petición de embeddings")
+    parser.add_argument("--concurrency", type=int, default=4, help="Peticiones de embeddings simultáneas")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json", help="Archivo de checkpoint")
+    parser.add_argument("--max-pages", type=int, default=None, help="Detener tras N páginas")
+    parser.add_argument("--rebuild", action="store_true", help="Reemplazar embeddings existentes")
+    parser.add_argument("--reset", action="store_true", help="Ignorar el checkpoint previo")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        print("\n⚠️  Backfill interrumpido; se reanudará desde el último checkpoint")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
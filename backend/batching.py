@@ -0,0 +1,79 @@
+# batching.py - Radix IA
+"""
+Micro-batching de llamadas concurrentes.
+
+Agrupa los elementos enviados por distintas corrutinas dentro de una ventana
+de pocos milisegundos en una sola llamada a `batch_fn` y reparte cada
+resultado a quien lo solicitó.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """Coalescedor de llamadas concurrentes en lotes"""
+
+    def __init__(self, batch_fn: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        """Encolar un elemento y esperar su resultado"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        """Despachar los elementos pendientes como un lote"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._run(batch))
+        # Mantener referencia para que la tarea no sea recolectada
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.batch_fn([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"El lote devolvió {len(results)} resultados para {len(batch)} elementos"
+                )
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de agrupamiento"""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "pending": len(self._pending)
+        }
@@ -0,0 +1,140 @@
+# benchmark_conversation_cache.py - Radix IA
+"""
+Micro-benchmark de la caché en memoria de conversaciones.
+
+Mide el rendimiento de get/put con decenas de miles de conversaciones y lo
+compara con el algoritmo anterior (desalojo por `min()` sobre los tiempos de
+acceso, índice de usuario en listas y un único lock global):
+
+    python benchmark_conversation_cache.py --conversaciones 10000
+
+Fases:
+- llenado: `put` de N conversaciones hasta llenar la caché
+- lecturas: `get` aleatorios sobre conversaciones presentes
+- rotación: `put` de conversaciones nuevas con la caché llena (desalojo en cada uno)
+- concurrencia: lecturas y escrituras desde muchas tareas a la vez
+"""
+
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from typing import Dict, List
+from uuid import UUID, uuid4
+
+from context_manager import ConversationCache, ConversationContext
+from models import EspecialidadEnum
+from token_counter import HeuristicTokenCounter
+
+TOKEN_COUNTER = HeuristicTokenCounter()
+
+
+class CacheLineal:
+    """Algoritmo previo de ConversationCache, solo para comparar"""
+
+    def __init__(self, max_size: int = 1000, ttl_minutes: int = 30):
+        self.cache: Dict[UUID, ConversationContext] = {}
+        self.user_conversations: Dict[str, List[UUID]] = defaultdict(list)
+        self.max_size = max_size
+        self.ttl = timedelta(minutes=ttl_minutes)
+        self._access_times: Dict[UUID, datetime] = {}
+        self._lock = asyncio.Lock()
+
+    async def get(self, conversation_id):
+        async with self._lock:
+            context = self.cache.get(conversation_id)
+            if context and datetime.now() - context.last_activity < self.ttl:
+                self._access_times[conversation_id] = datetime.now()
+                return context
+            return None
+
+    async def put(self, context):
+        async with self._lock:
+            if len(self.cache) >= self.max_size:
+                oldest_id = min(self._access_times.keys(), key=lambda x: self._access_times[x])
+                oldest = self.cache.pop(oldest_id)
+                self.user_conversations[oldest.user_id].remove(oldest_id)
+                del self._access_times[oldest_id]
+            self.cache[context.conversation_id] = context
+            self.user_conversations[context.user_id].append(context.conversation_id)
+            self._access_times[context.conversation_id] = datetime.now()
+
+
+def _contexto(usuarios: int) -> ConversationContext:
+    return ConversationContext(
+        conversation_id=uuid4(),
+        user_id=f"usuario-{random.randrange(usuarios)}",
+        speciality=EspecialidadEnum.GENERAL,
+        messages=deque(),
+        metadata={},
+        last_activity=datetime.now(),
+        token_count=0,
+        token_counter=TOKEN_COUNTER
+    )
+
+
+def _reportar(fase: str, operaciones: int, segundos: float) -> None:
+    print(f"  {fase:<13} {operaciones:>8} ops  {segundos * 1000:>9.1f} ms  {operaciones / segundos:>12,.0f} ops/s")
+
+
+async def _medir(cache, contextos: List[ConversationContext], args: argparse.Namespace) -> None:
+    inicio = time.perf_counter()
+    for context in contextos:
+        await cache.put(context)
+    _reportar("llenado", len(contextos), time.perf_counter() - inicio)
+
+    ids = [c.conversation_id for c in contextos]
+    lecturas = [random.choice(ids) for _ in range(args.operaciones)]
+    inicio = time.perf_counter()
+    for conv_id in lecturas:
+        await cache.get(conv_id)
+    _reportar("lecturas", len(lecturas), time.perf_counter() - inicio)
+
+    nuevos = [_contexto(args.usuarios) for _ in range(args.rotaciones)]
+    inicio = time.perf_counter()
+    for context in nuevos:
+        await cache.put(context)
+    _reportar("rotación", len(nuevos), time.perf_counter() - inicio)
+
+    async def cliente(n: int) -> None:
+        for i in range(n):
+            if i % 10 == 0:
+                await cache.put(_contexto(args.usuarios))
+            else:
+                await cache.get(random.choice(ids))
+
+    por_tarea = args.operaciones // args.tareas
+    inicio = time.perf_counter()
+    await asyncio.gather(*(cliente(por_tarea) for _ in range(args.tareas)))
+    _reportar("concurrencia", por_tarea * args.tareas, time.perf_counter() - inicio)
+
+
+async def _main(args: argparse.Namespace) -> None:
+    random.seed(args.seed)
+    contextos = [_contexto(args.usuarios) for _ in range(args.conversaciones)]
+
+    print(f"🧪 {args.conversaciones} conversaciones, {args.usuarios} usuarios")
+    print(f"ConversationCache (LRU por particiones, {args.shards} particiones)")
+    await _medir(ConversationCache(max_size=args.conversaciones, shards=args.shards), contextos, args)
+    if not args.sin_comparar:
+        print("Algoritmo anterior (min() + lock global)")
+        await _medir(CacheLineal(max_size=args.conversaciones), contextos, args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark de la caché de conversaciones")
+    parser.add_argument("--conversaciones", type=int, default=10000, help="Tamaño de la caché")
+    parser.add_argument("--usuarios", type=int, default=2000, help="Usuarios distintos")
+    parser.add_argument("--operaciones", type=int, default=100000, help="Lecturas por fase")
+    parser.add_argument("--rotaciones", type=int, default=2000, help="Inserciones con la caché llena")
+    parser.add_argument("--tareas", type=int, default=100, help="Tareas concurrentes")
+    parser.add_argument("--shards", type=int, default=16, help="Particiones de la caché")
+    parser.add_argument("--seed", type=int, default=7, help="Semilla aleatoria")
+    parser.add_argument("--sin-comparar", action="store_true", help="No medir el algoritmo anterior")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# chunking.py - Radix IA
+"""
+División de reportes en fragmentos (chunks) para generar embeddings.
+
+Los fragmentos respetan los límites de párrafo y de oración cuando es
+posible y se solapan ligeramente para no perder contexto entre cortes.
+`dividir_por_secciones` además separa los reportes por sus secciones
+(TÉCNICA, HALLAZGOS, IMPRESIÓN, RECOMENDACIONES) para que cada fragmento
+pertenezca a una sola sección.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class Chunk:
+    """Fragmento de texto con su posición en el documento original"""
+    contenido: str
+    inicio: int
+    fin: int
+    seccion: Optional[str] = None
+
+
+_CORTE_ORACION = re.compile(r"(?<=[.!?;:])\s+")
+
+# Encabezado de sección: inicio de línea (admite '#', '**', numeración) y ':' o fin de línea
+_ENCABEZADO_SECCION = re.compile(
+    r"^[ \t#*>\-\d.)]*(T[ÉE]CNICA|HALLAZGOS|IMPRESI[ÓO]N(?: DIAGN[ÓO]STICA)?|RECOMENDACI[ÓO]N(?:ES)?)[ \t*]*(?::|$)",
+    re.IGNORECASE | re.MULTILINE
+)
+
+_NOMBRE_SECCION = {
+    "TECNICA": "TÉCNICA",
+    "HALLAZGOS": "HALLAZGOS",
+    "IMPRESION": "IMPRESIÓN DIAGNÓSTICA",
+    "RECOMENDACION": "RECOMENDACIONES",
+}
+
+
+def _normalizar_seccion(encabezado: str) -> str:
+    clave = encabezado.upper().replace("É", "E").replace("Ó", "O").split()[0]
+    clave = "RECOMENDACION" if clave.startswith("RECOMENDACION") else clave
+    return _NOMBRE_SECCION[clave]
+
+
+def dividir_texto(texto: str, max_chars: int = 1500, solapamiento: int = 200) -> List[Chunk]:
+    """Dividir un texto en fragmentos de como máximo `max_chars` caracteres"""
+    texto = texto or ""
+    if not texto.strip():
+        return []
+    if len(texto) <= max_chars:
+        inicio = len(texto) - len(texto.lstrip())
+        return [Chunk(contenido=texto.strip(), inicio=inicio, fin=len(texto.rstrip()))]
+
+    chunks: List[Chunk] = []
+    inicio = 0
+    while inicio < len(texto):
+        fin = min(inicio + max_chars, len(texto))
+        if fin < len(texto):
+            # Preferir cortar en párrafo, luego en fin de oración, luego en espacio
+            ventana = texto[inicio:fin]
+            corte = ventana.rfind("\n\n")
+            if corte < max_chars // 2:
+                oraciones = [m.end() for m in _CORTE_ORACION.finditer(ventana)]
+                corte = oraciones[-1] if oraciones else -1
+            if corte < max_chars // 2:
+                corte = ventana.rfind(" ")
+            if corte > 0:
+                fin = inicio + corte
+
+        contenido = texto[inicio:fin].strip()
+        if contenido:
+            desplazamiento = len(texto[inicio:fin]) - len(texto[inicio:fin].lstrip())
+            chunks.append(Chunk(
+                contenido=contenido,
+                inicio=inicio + desplazamiento,
+                fin=inicio + desplazamiento + len(contenido)
+            ))
+
+        if fin >= len(texto):
+            break
+        # Retroceder para solapar, empezando siempre en inicio de palabra
+        siguiente = max(fin - solapamiento, inicio + 1)
+        espacio = texto.find(" ", siguiente, fin)
+        inicio = espacio + 1 if espacio != -1 else siguiente
+
+    return chunks
+
+
+def dividir_por_secciones(texto: str, max_chars: int = 800, solapamiento: int = 100) -> List[Chunk]:
+    """Dividir un reporte por secciones y cada sección en fragmentos"""
+    texto = texto or ""
+    encabezados = list(_ENCABEZADO_SECCION.finditer(texto))
+    if not encabezados:
+        return dividir_texto(texto, max_chars, solapamiento)
+
+    # Tramos [inicio, fin) por sección; el texto previo al primer encabezado va sin sección
+    tramos = [(0, encabezados[0].start(), None)]
+    for actual, siguiente in zip(encabezados, encabezados[1:] + [None]):
+        fin = siguiente.start() if siguiente else len(texto)
+        tramos.append((actual.start(), fin, _normalizar_seccion(actual.group(1))))
+
+    chunks: List[Chunk] = []
+    for inicio, fin, seccion in tramos:
+        for chunk in dividir_texto(texto[inicio:fin], max_chars, solapamiento):
+            chunks.append(Chunk(
+                contenido=chunk.contenido,
+                inicio=inicio + chunk.inicio,
+                fin=inicio + chunk.fin,
+                seccion=seccion
+            ))
+    return chunks
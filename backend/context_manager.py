@@ -6,19 +6,183 @@ Sistema avanzado de gestión de contexto para chat IA médico con soporte para:
 - Límites dinámicos de contexto
 - Optimización de memoria
 - Sesiones paralelas
+- Resumen progresivo de los turnos antiguos (en lugar de descartarlos)
 """
 
+import os
+import sys
+import gzip
 import asyncio
+import base64
 import json
 import time
-from typing import Dict, List, Optional, Tuple, Any
+import weakref
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, Any
 from uuid import UUID
 from datetime import datetime, timedelta
-from dataclasses import dataclass, asdict
-from collections import defaultdict, deque
+from dataclasses import dataclass, asdict, field
+from collections import OrderedDict, defaultdict, deque
+from itertools import chain
 import hashlib
+import tempfile
 
 from models import ChatMessage, RolChatEnum, EspecialidadEnum
+from db import SupabaseExecutor, get_db_executor
+from token_counter import TokenCounter, get_token_counter
+from write_behind import WriteBehindQueue
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # pragma: no cover - depende del entorno
+    redis_asyncio = None
+
+# Genera el resumen a partir del resumen previo y los turnos desplazados
+Summarizer = Callable[[Optional[str], List["MensajeContexto"]], Awaitable[str]]
+
+# Turnos desplazados pendientes de resumir que se conservan como máximo
+MAX_TURNOS_PENDIENTES = 40
+
+# Mensajes que el contexto conserva en memoria
+MAX_MENSAJES_CONTEXTO = 50
+
+# Columnas del historial: solo las que usa el contexto / las que muestra la UI
+COLUMNAS_CONTEXTO = 'id,rol,contenido,timestamp_mensaje'
+COLUMNAS_HISTORIAL = 'id,conversacion_id,rol,contenido,archivos_adjuntos,metadatos,timestamp_mensaje'
+
+# Formato del snapshot de la caché en disco
+SNAPSHOT_VERSION = 1
+
+# Memoria aproximada (medida con tracemalloc) de un contexto vacío y de cada
+# mensaje sin contar su texto: registro MensajeContexto, su conteo de tokens y
+# la entrada en el deque
+BYTES_BASE_CONTEXTO = 2048
+BYTES_POR_MENSAJE = 100
+
+# System prompt por especialidad: se compone una sola vez al importar
+PROMPTS_ESPECIALIDAD = {
+    EspecialidadEnum.RADIOLOGIA: "Eres un radiólogo experto especializado en interpretación de imágenes médicas.",
+    EspecialidadEnum.CARDIOLOGIA: "Eres un cardiólogo experto en diagnóstico y tratamiento cardiovascular.",
+    EspecialidadEnum.NEUROLOGIA: "Eres un neurólogo experto en el sistema nervioso y trastornos neurológicos.",
+    EspecialidadEnum.DERMATOLOGIA: "Eres un dermatólogo experto en enfermedades de la piel.",
+    EspecialidadEnum.GINECOLOGIA: "Eres un ginecólogo experto en salud femenina y reproductiva.",
+    EspecialidadEnum.GENERAL: "Eres un médico general experto en medicina clínica."
+}
+
+INSTRUCCIONES_SISTEMA = """INSTRUCCIONES IMPORTANTES:
+- Responde SIEMPRE en español
+- Sé profesional, preciso y empático
+- Proporciona información médica basada en evidencia
+- Si la consulta está fuera de tu especialidad, refiérelo apropiadamente
+- Siempre incluye la recomendación de consultar con un médico para evaluación presencial
+- Mantén un tono médico profesional pero accesible
+- No proporciones diagnósticos definitivos sin evaluación presencial
+- Enfócate en educación y orientación médica
+
+Recuerda: Eres un asistente médico IA diseñado para proporcionar orientación médica general, no para reemplazar la consulta médica profesional."""
+
+SYSTEM_PROMPTS: Dict[EspecialidadEnum, str] = {
+    especialidad: f"{base}\n\n{INSTRUCCIONES_SISTEMA}"
+    for especialidad, base in PROMPTS_ESPECIALIDAD.items()
+}
+
+
+class MensajeContexto:
+    """Mensaje del contexto en memoria: rol, texto y tokens en un registro compacto
+    
+    Sustituye al modelo pydantic `ChatMessage` dentro de la caché (sin
+    `__dict__` ni validación por mensaje). El rol es el miembro del enum, de
+    modo que todos los mensajes comparten el mismo objeto. `tokens` guarda el
+    conteo (plantilla incluida) para no recontar al recortar o ajustar.
+    """
+    
+    __slots__ = ("role", "content", "tokens")
+    
+    def __init__(self, role: RolChatEnum, content: str, tokens: Optional[int] = None):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+    
+    def to_wire(self) -> Dict[str, str]:
+        """Formato de mensaje de la API de chat (TGI)"""
+        return {"role": self.role.value, "content": self.content}
+    
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (MensajeContexto, ChatMessage)):
+            return self.role == other.role and self.content == other.content
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self) -> str:
+        return f"MensajeContexto(role={self.role.value!r}, content={self.content!r}, tokens={self.tokens})"
+
+
+# System prompts ya contados, por contador de tokens y especialidad
+_system_prompts: "weakref.WeakKeyDictionary[TokenCounter, Dict[EspecialidadEnum, MensajeContexto]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def system_prompt(speciality: EspecialidadEnum, token_counter: TokenCounter) -> MensajeContexto:
+    """System prompt de una especialidad (el mismo registro en cada llamada; no modificar)"""
+    por_especialidad = _system_prompts.setdefault(token_counter, {})
+    mensaje = por_especialidad.get(speciality)
+    if mensaje is None:
+        content = SYSTEM_PROMPTS.get(speciality, SYSTEM_PROMPTS[EspecialidadEnum.GENERAL])
+        mensaje = MensajeContexto(RolChatEnum.SYSTEM, content)
+        mensaje.tokens = token_counter.contar_mensaje(mensaje)
+        por_especialidad[speciality] = mensaje
+    return mensaje
+
+
+def codificar_cursor(filas: List[Dict[str, Any]]) -> str:
+    """Cursor opaco tras la última fila de una página (ordenada de nueva a antigua)"""
+    ultimo = filas[-1]['timestamp_mensaje']
+    # Ids ya entregados con la misma marca de tiempo: la siguiente página los excluye
+    ids = [f['id'] for f in filas if f['timestamp_mensaje'] == ultimo]
+    data = json.dumps({"t": ultimo, "ids": ids}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> Tuple[str, List[str]]:
+    """(marca de tiempo, ids a excluir) de un cursor; ValueError si es inválido"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        datetime.fromisoformat(data["t"])
+        return data["t"], [str(UUID(i)) for i in data["ids"]]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Cursor de historial inválido: {cursor}") from e
+
+
+async def consultar_mensajes_recientes(
+    db: SupabaseExecutor,
+    supabase_client,
+    conversation_id: UUID,
+    limit: int,
+    cursor: Optional[str] = None,
+    columnas: str = COLUMNAS_CONTEXTO
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Página de mensajes de la más reciente a la más antigua y cursor de la siguiente
+    
+    Paginación por cursor (keyset) sobre `timestamp_mensaje`: cada página es
+    una lectura acotada por el índice, sin OFFSET.
+    """
+    query = supabase_client.table('mensajes_chat').select(columnas).eq(
+        'conversacion_id', str(conversation_id)
+    )
+    if cursor:
+        antes_de, excluir = decodificar_cursor(cursor)
+        query = query.lte('timestamp_mensaje', antes_de)
+        if excluir:
+            query = query.not_.in_('id', excluir)
+    result = await db.execute(
+        query.order('timestamp_mensaje', desc=True).limit(limit + 1)
+    )
+    filas = result.data or []
+    if len(filas) <= limit:
+        return filas, None
+    filas = filas[:limit]
+    return filas, codificar_cursor(filas)
 
 
 @dataclass
@@ -33,169 +197,533 @@ class ConversationContext:
     token_count: int
     max_tokens: int = 4096  # Límite del modelo
     context_window: int = 3000  # Tokens para contexto (dejando espacio para respuesta)
+    token_counter: Optional[TokenCounter] = field(default=None, repr=False)
+    summary: Optional[str] = None  # Resumen de los turnos que ya salieron del contexto
+    summary_max_tokens: int = 0  # Tokens reservados para el resumen (0 = sin resumen)
     
     def __post_init__(self):
-        if not isinstance(self.messages, deque):
-            self.messages = deque(self.messages, maxlen=50)  # Límite de mensajes en memoria
+        if self.token_counter is None:
+            self.token_counter = get_token_counter()
+        # Los mensajes se guardan como registros compactos con sus tokens ya contados
+        maxlen = self.messages.maxlen if isinstance(self.messages, deque) else MAX_MENSAJES_CONTEXTO
+        self.messages = deque((self._compactar(m) for m in self.messages), maxlen=maxlen)
+        if self.messages:
+            self.token_count = sum(m.tokens for m in self.messages)
+        # Turnos recortados que aún no se han incorporado al resumen
+        self.pending_summary: List[MensajeContexto] = []
+        # Mensaje del resumen construido para el texto actual de `summary`
+        self._summary_cache: Tuple[Optional[str], Optional[MensajeContexto]] = (None, None)
+    
+    def _compactar(self, message: Any) -> MensajeContexto:
+        """Registro compacto (con tokens) de un ChatMessage o MensajeContexto"""
+        if isinstance(message, MensajeContexto):
+            if message.tokens is None:
+                message.tokens = self._estimate_message_tokens(message)
+            return message
+        return MensajeContexto(message.role, message.content, self._estimate_message_tokens(message))
     
     def add_message(self, message: ChatMessage) -> None:
         """Agregar mensaje y actualizar contadores"""
+        message = self._compactar(message)
+        if self.messages.maxlen is not None and len(self.messages) == self.messages.maxlen:
+            # El deque descartará el mensaje más antiguo al agregar
+            self.token_count -= self.messages[0].tokens
+            self._desplazar(self.messages[0])
         self.messages.append(message)
         self.last_activity = datetime.now()
-        self.token_count += self._estimate_tokens(message.content)
+        self.token_count += message.tokens
         self._trim_if_needed()
     
     def _estimate_tokens(self, text: str) -> int:
-        """Estimación aproximada de tokens (1 token ≈ 4 caracteres para español)"""
-        return len(text) // 3
+        """Tokens de un texto según el contador configurado (tokenizer o heurística)"""
+        return self.token_counter.contar(text)
+    
+    def _estimate_message_tokens(self, message: Any) -> int:
+        """Tokens de un mensaje incluida la plantilla de chat"""
+        return self.token_counter.contar_mensaje(message)
+    
+    def _system_prompt_tokens(self) -> int:
+        """Tokens del system prompt que get_context_messages antepone"""
+        if self.messages and self.messages[0].role == RolChatEnum.SYSTEM:
+            return 0  # Ya contado en token_count
+        return self._generate_system_prompt().tokens
     
     def _trim_if_needed(self) -> None:
-        """Recortar contexto si excede límites"""
-        while self.token_count > self.context_window and len(self.messages) > 2:
-            removed_msg = self.messages.popleft()
-            self.token_count -= self._estimate_tokens(removed_msg.content)
+        """Recortar contexto si excede límites (los turnos recortados pasan al resumen)"""
+        # En modo resumen se reserva siempre su espacio: el prompt no crece con la consulta
+        limite = self.context_window - self._system_prompt_tokens() - self.summary_max_tokens
+        while self.token_count > limite and len(self.messages) > 2:
+            message = self.messages.popleft()
+            self._desplazar(message)
+            self.token_count -= message.tokens
+    
+    def _desplazar(self, message: MensajeContexto) -> None:
+        """Guardar un turno que sale del contexto para el próximo resumen"""
+        if self.summary_max_tokens <= 0 or message.role == RolChatEnum.SYSTEM:
+            return
+        self.pending_summary.append(message)
+        if len(self.pending_summary) > MAX_TURNOS_PENDIENTES:
+            del self.pending_summary[0]
     
-    def get_context_messages(self) -> List[ChatMessage]:
-        """Obtener mensajes para enviar al modelo IA"""
+    def _summary_message(self) -> Optional[MensajeContexto]:
+        if not self.summary:
+            return None
+        texto, mensaje = self._summary_cache
+        if texto is not self.summary:
+            # Solo se reconstruye (y recuenta) cuando cambia el resumen
+            mensaje = self._compactar(MensajeContexto(
+                RolChatEnum.SYSTEM, f"RESUMEN DE LA CONSULTA HASTA AHORA:\n{self.summary}"
+            ))
+            self._summary_cache = (self.summary, mensaje)
+        return mensaje
+    
+    def prompt_tokens(self) -> int:
+        """Tamaño en tokens de los mensajes que se enviarán al modelo"""
+        summary_message = self._summary_message()
+        summary_tokens = summary_message.tokens if summary_message else 0
+        return self.token_count + self._system_prompt_tokens() + summary_tokens
+    
+    def get_context_messages(self) -> List[MensajeContexto]:
+        """Obtener mensajes para enviar al modelo IA
+        
+        Devuelve los registros del contexto (con sus tokens) sin copiarlos; el
+        system prompt es el compartido de la especialidad. No deben
+        modificarse: para cambiar uno se sustituye en la lista.
+        """
         # Si no hay mensajes, devolver solo el system prompt
         if not self.messages:
-            system_prompt = self._generate_system_prompt()
-            return [system_prompt]
+            return [self._generate_system_prompt()]
         
         messages = list(self.messages)
         
         # Asegurar que tenemos el system prompt
         if messages[0].role != RolChatEnum.SYSTEM:
-            # Agregar system prompt basado en especialidad
-            system_prompt = self._generate_system_prompt()
-            messages.insert(0, system_prompt)
+            messages.insert(0, self._generate_system_prompt())
+        
+        # El resumen de los turnos antiguos va justo después del system prompt
+        summary_message = self._summary_message()
+        if summary_message is not None:
+            messages.insert(1, summary_message)
         
         return messages
     
-    def _generate_system_prompt(self) -> ChatMessage:
-        """Generar prompt de sistema basado en especialidad"""
-        prompts = {
-            EspecialidadEnum.RADIOLOGIA: "Eres un radiólogo experto especializado en interpretación de imágenes médicas.",
-            EspecialidadEnum.CARDIOLOGIA: "Eres un cardiólogo experto en diagnóstico y tratamiento cardiovascular.",
-            EspecialidadEnum.NEUROLOGIA: "Eres un neurólogo experto en el sistema nervioso y trastornos neurológicos.",
-            EspecialidadEnum.DERMATOLOGIA: "Eres un dermatólogo experto en enfermedades de la piel.",
-            EspecialidadEnum.GINECOLOGIA: "Eres un ginecólogo experto en salud femenina y reproductiva.",
-            EspecialidadEnum.GENERAL: "Eres un médico general experto en medicina clínica."
+    def estimated_bytes(self) -> int:
+        """Memoria aproximada del contexto (estructuras y textos) para la caché"""
+        total = BYTES_BASE_CONTEXTO + sys.getsizeof(self.summary or "")
+        for message in chain(self.messages, self.pending_summary):
+            total += BYTES_POR_MENSAJE + sys.getsizeof(message.content)
+        return total
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializar el contexto (para cachés compartidas entre procesos)"""
+        return {
+            "conversation_id": str(self.conversation_id),
+            "user_id": self.user_id,
+            "speciality": self.speciality.value,
+            "messages": [m.to_wire() for m in self.messages],
+            "message_tokens": [m.tokens for m in self.messages],
+            "tokenizer": self.token_counter.nombre,
+            "metadata": self.metadata,
+            "last_activity": self.last_activity.isoformat(),
+            "max_tokens": self.max_tokens,
+            "context_window": self.context_window,
+            "summary": self.summary,
+            "summary_max_tokens": self.summary_max_tokens,
+            "pending_summary": [{"role": m.role.value, "content": m.content} for m in self.pending_summary]
         }
-        
-        base_prompt = prompts.get(self.speciality, prompts[EspecialidadEnum.GENERAL])
-        full_prompt = f"""{base_prompt}
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any],
+                  token_counter: Optional[TokenCounter] = None) -> "ConversationContext":
+        """Reconstruir un contexto serializado con `to_dict`"""
+        context = cls(
+            conversation_id=UUID(data["conversation_id"]),
+            user_id=data["user_id"],
+            speciality=EspecialidadEnum(data["speciality"]),
+            messages=deque(),
+            metadata=data.get("metadata", {}),
+            last_activity=datetime.fromisoformat(data["last_activity"]),
+            token_count=0,
+            max_tokens=data.get("max_tokens", cls.max_tokens),
+            context_window=data.get("context_window", cls.context_window),
+            token_counter=token_counter,
+            summary=data.get("summary"),
+            summary_max_tokens=data.get("summary_max_tokens", 0)
+        )
+        tokens = data.get("message_tokens") or []
+        # Los conteos guardados solo valen si se hicieron con el mismo tokenizer
+        if data.get("tokenizer") != context.token_counter.nombre or len(tokens) != len(data["messages"]):
+            tokens = [None] * len(data["messages"])
+        context.messages.extend(
+            context._compactar(MensajeContexto(RolChatEnum(m["role"]), m["content"], t))
+            for m, t in zip(data["messages"], tokens)
+        )
+        context.token_count = sum(m.tokens for m in context.messages)
+        context.pending_summary = [
+            MensajeContexto(RolChatEnum(m["role"]), m["content"])
+            for m in data.get("pending_summary", [])
+        ]
+        return context
+    
+    def _generate_system_prompt(self) -> MensajeContexto:
+        """System prompt de la especialidad (compartido entre conversaciones)"""
+        return system_prompt(self.speciality, self.token_counter)
 
-INSTRUCCIONES IMPORTANTES:
-- Responde SIEMPRE en español
-- Sé profesional, preciso y empático
-- Proporciona información médica basada en evidencia
-- Si la consulta está fuera de tu especialidad, refiérelo apropiadamente
-- Siempre incluye la recomendación de consultar con un médico para evaluación presencial
-- Mantén un tono médico profesional pero accesible
-- No proporciones diagnósticos definitivos sin evaluación presencial
-- Enfócate en educación y orientación médica
 
-Recuerda: Eres un asistente médico IA diseñado para proporcionar orientación médica general, no para reemplazar la consulta médica profesional."""
-        
-        return ChatMessage(role=RolChatEnum.SYSTEM, content=full_prompt)
+class ConversationCacheBackend:
+    """Interfaz de la caché de conversaciones activas
+    
+    Las implementaciones compartidas (Redis) devuelven copias deserializadas:
+    los cambios en un contexto deben publicarse con `update`.
+    """
+    
+    nombre = "base"
+    
+    async def get(self, conversation_id: UUID) -> Optional[ConversationContext]:
+        raise NotImplementedError
+    
+    async def put(self, context: ConversationContext) -> None:
+        raise NotImplementedError
+    
+    async def update(self, conversation_id: UUID, context: ConversationContext) -> None:
+        raise NotImplementedError
+    
+    async def get_user_conversations(self, user_id: str) -> List[ConversationContext]:
+        raise NotImplementedError
+    
+    async def cleanup_expired(self) -> None:
+        """Limpieza periódica (no-op si el backend expira por TTL)"""
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    async def snapshot(self, limit: int) -> List[ConversationContext]:
+        """Contextos a guardar al apagar (vacío si el backend sobrevive a reinicios)"""
+        return []
+    
+    async def close(self) -> None:
+        """Liberar recursos del backend"""
 
 
-class ConversationCache:
-    """Caché en memoria para conversaciones activas"""
+class _CacheShard:
+    """Partición de la caché en memoria: LRU propio y lock propio"""
+    
+    __slots__ = ("entries", "lock", "capacity", "max_bytes", "sizes", "bytes")
+    
+    def __init__(self, capacity: int, max_bytes: Optional[int] = None):
+        # Orden de inserción = orden de uso (el primero es el menos reciente)
+        self.entries: "OrderedDict[UUID, ConversationContext]" = OrderedDict()
+        self.lock = asyncio.Lock()
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        # Tamaño estimado de cada contexto al guardarlo y total de la partición
+        self.sizes: Dict[UUID, int] = {}
+        self.bytes = 0
+    
+    def excede(self) -> bool:
+        return (len(self.entries) > self.capacity
+                or (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+
+class ConversationCache(ConversationCacheBackend):
+    """Caché en memoria para conversaciones activas
+    
+    LRU por particiones: cada conversación cae en una partición según su id,
+    con su propio OrderedDict (get/put/desalojo en O(1)) y su propio lock, de
+    modo que conversaciones distintas no compiten por el mismo lock. El
+    desalojo es LRU dentro de cada partición.
+    
+    Además del número de conversaciones se limita la memoria: cada contexto
+    se contabiliza con su tamaño estimado al guardarlo y se desalojan los
+    menos usados hasta respetar `max_bytes` (repartido entre particiones).
+    """
+    
+    nombre = "memory"
     
-    def __init__(self, max_size: int = 1000, ttl_minutes: int = 30):
-        self.cache: Dict[UUID, ConversationContext] = {}
-        self.user_conversations: Dict[str, List[UUID]] = defaultdict(list)
+    def __init__(self, max_size: int = 1000, ttl_minutes: int = 30, shards: int = 16,
+                 max_bytes: Optional[int] = None):
         self.max_size = max_size
+        self.max_bytes = max_bytes
         self.ttl = timedelta(minutes=ttl_minutes)
-        self._access_times: Dict[UUID, datetime] = {}
-        self._lock = asyncio.Lock()
+        shards = max(1, min(shards, max_size))
+        shard_bytes = max_bytes // shards if max_bytes is not None else None
+        self._shards = [_CacheShard(-(-max_size // shards), shard_bytes) for _ in range(shards)]
+        self.user_conversations: Dict[str, Set[UUID]] = defaultdict(set)
+        self.evictions = 0
+        self.memory_evictions = 0
+    
+    def _shard(self, conversation_id: UUID) -> _CacheShard:
+        return self._shards[hash(conversation_id) % len(self._shards)]
+    
+    def __len__(self) -> int:
+        return sum(len(shard.entries) for shard in self._shards)
     
     async def get(self, conversation_id: UUID) -> Optional[ConversationContext]:
         """Obtener conversación del caché"""
-        async with self._lock:
-            context = self.cache.get(conversation_id)
+        shard = self._shard(conversation_id)
+        async with shard.lock:
+            context = shard.entries.get(conversation_id)
             if context and self._is_valid(context):
-                self._access_times[conversation_id] = datetime.now()
+                shard.entries.move_to_end(conversation_id)
                 return context
             elif context:
                 # Limpiar conversación expirada
-                await self._remove(conversation_id)
+                self._remove(shard, conversation_id)
             return None
     
     async def put(self, context: ConversationContext) -> None:
         """Almacenar conversación en caché"""
-        async with self._lock:
-            # Limpiar caché si está lleno
-            if len(self.cache) >= self.max_size:
-                await self._evict_oldest()
-            
-            self.cache[context.conversation_id] = context
-            self.user_conversations[context.user_id].append(context.conversation_id)
-            self._access_times[context.conversation_id] = datetime.now()
+        shard = self._shard(context.conversation_id)
+        async with shard.lock:
+            self._guardar(shard, context)
+            self.user_conversations[context.user_id].add(context.conversation_id)
     
     async def update(self, conversation_id: UUID, context: ConversationContext) -> None:
-        """Actualizar conversación existente"""
-        async with self._lock:
-            if conversation_id in self.cache:
-                self.cache[conversation_id] = context
-                self._access_times[conversation_id] = datetime.now()
+        """Actualizar conversación existente (recalcula su tamaño)"""
+        shard = self._shard(conversation_id)
+        async with shard.lock:
+            if conversation_id in shard.entries:
+                self._guardar(shard, context)
+    
+    def _guardar(self, shard: _CacheShard, context: ConversationContext) -> None:
+        """Guardar como la más reciente y desalojar las menos usadas hasta respetar los límites"""
+        conversation_id = context.conversation_id
+        size = context.estimated_bytes()
+        shard.bytes += size - shard.sizes.get(conversation_id, 0)
+        shard.sizes[conversation_id] = size
+        shard.entries[conversation_id] = context
+        shard.entries.move_to_end(conversation_id)
+        # La conversación que se guarda nunca se desaloja (queda al final)
+        while shard.excede() and len(shard.entries) > 1:
+            if len(shard.entries) <= shard.capacity:
+                self.memory_evictions += 1
+            self._remove(shard, next(iter(shard.entries)))
+            self.evictions += 1
     
     async def get_user_conversations(self, user_id: str) -> List[ConversationContext]:
         """Obtener todas las conversaciones activas de un usuario"""
-        async with self._lock:
-            conversations = []
-            for conv_id in self.user_conversations.get(user_id, []):
-                if conv_id in self.cache and self._is_valid(self.cache[conv_id]):
-                    conversations.append(self.cache[conv_id])
-            return conversations
+        conversations = []
+        for conv_id in list(self.user_conversations.get(user_id, ())):
+            context = self._shard(conv_id).entries.get(conv_id)
+            if context is not None and self._is_valid(context):
+                conversations.append(context)
+        return conversations
     
     def _is_valid(self, context: ConversationContext) -> bool:
         """Verificar si el contexto sigue siendo válido"""
         return datetime.now() - context.last_activity < self.ttl
     
-    async def _remove(self, conversation_id: UUID) -> None:
-        """Remover conversación del caché"""
-        if conversation_id in self.cache:
-            context = self.cache[conversation_id]
-            del self.cache[conversation_id]
-            self.user_conversations[context.user_id].remove(conversation_id)
-            if conversation_id in self._access_times:
-                del self._access_times[conversation_id]
-    
-    async def _evict_oldest(self) -> None:
-        """Eliminar la conversación menos usada recientemente"""
-        if not self._access_times:
+    def _remove(self, shard: _CacheShard, conversation_id: UUID) -> None:
+        """Remover conversación del caché (con el lock de la partición tomado)"""
+        context = shard.entries.pop(conversation_id, None)
+        if context is None:
             return
-        
-        oldest_id = min(self._access_times.keys(), key=lambda x: self._access_times[x])
-        await self._remove(oldest_id)
+        shard.bytes -= shard.sizes.pop(conversation_id, 0)
+        user_ids = self.user_conversations.get(context.user_id)
+        if user_ids is not None:
+            user_ids.discard(conversation_id)
+            if not user_ids:
+                del self.user_conversations[context.user_id]
     
     async def cleanup_expired(self) -> None:
         """Limpieza periódica de conversaciones expiradas"""
-        async with self._lock:
-            expired_ids = [
-                conv_id for conv_id, context in self.cache.items()
-                if not self._is_valid(context)
-            ]
-            
-            for conv_id in expired_ids:
-                await self._remove(conv_id)
+        for shard in self._shards:
+            async with shard.lock:
+                expired_ids = [
+                    conv_id for conv_id, context in shard.entries.items()
+                    if not self._is_valid(context)
+                ]
+                
+                for conv_id in expired_ids:
+                    self._remove(shard, conv_id)
+    
+    async def snapshot(self, limit: int) -> List[ConversationContext]:
+        """Los `limit` contextos válidos con actividad más reciente"""
+        contexts = [
+            context for shard in self._shards for context in shard.entries.values()
+            if self._is_valid(context)
+        ]
+        contexts.sort(key=lambda c: c.last_activity, reverse=True)
+        return contexts[:limit]
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        size = len(self)
+        bytes_used = sum(shard.bytes for shard in self._shards)
+        return {
+            "backend": self.nombre,
+            "conversations_in_cache": size,
+            "max_cache_size": self.max_size,
+            "cache_utilization": size / self.max_size,
+            "active_users": len(self.user_conversations),
+            "shards": len(self._shards),
+            "bytes_used": bytes_used,
+            "max_bytes": self.max_bytes,
+            "memory_utilization": round(bytes_used / self.max_bytes, 4) if self.max_bytes else None,
+            "avg_context_bytes": bytes_used // size if size else 0,
+            "evictions": self.evictions,
+            "memory_evictions": self.memory_evictions
+        }
+
+
+class RedisConversationCache(ConversationCacheBackend):
+    """Caché compartida entre workers sobre un servidor compatible con Redis
+    
+    Cada contexto se guarda serializado en JSON bajo `<prefijo>conv:<id>` con
+    TTL deslizante (se renueva en cada escritura) y cada usuario tiene un
+    conjunto `<prefijo>user:<id>` con sus conversaciones. La expiración la
+    hace el servidor; el tamaño máximo lo acota su política de memoria.
+    Los errores del servidor se tratan como fallos de caché: el chat sigue
+    funcionando cargando el historial desde la BD. `client` es un
+    `redis.asyncio.Redis`.
+    """
+    
+    nombre = "redis"
+    
+    def __init__(self, client: Any, ttl_minutes: int = 30, prefix: str = "radix:chat:",
+                 token_counter: Optional[TokenCounter] = None):
+        self.client = client
+        self.ttl_ms = ttl_minutes * 60 * 1000
+        self.prefix = prefix
+        self.token_counter = token_counter or get_token_counter()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+    
+    def _key(self, conversation_id: UUID) -> str:
+        return f"{self.prefix}conv:{conversation_id}"
+    
+    def _user_key(self, user_id: str) -> str:
+        return f"{self.prefix}user:{user_id}"
+    
+    def _deserializar(self, raw: Optional[bytes]) -> Optional[ConversationContext]:
+        if raw is None:
+            return None
+        return ConversationContext.from_dict(json.loads(raw), self.token_counter)
+    
+    def _error(self, operacion: str, e: Exception) -> None:
+        self.errors += 1
+        print(f"⚠️ Error en caché Redis de conversaciones ({operacion}): {e}")
+    
+    async def get(self, conversation_id: UUID) -> Optional[ConversationContext]:
+        """Obtener conversación del caché"""
+        try:
+            context = self._deserializar(await self.client.get(self._key(conversation_id)))
+        except Exception as e:
+            self._error("get", e)
+            return None
+        if context is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return context
+    
+    async def put(self, context: ConversationContext) -> None:
+        """Almacenar conversación en caché"""
+        try:
+            await self._guardar(context)
+            user_key = self._user_key(context.user_id)
+            await self.client.sadd(user_key, str(context.conversation_id))
+            await self.client.pexpire(user_key, self.ttl_ms)
+        except Exception as e:
+            self._error("put", e)
+    
+    async def update(self, conversation_id: UUID, context: ConversationContext) -> None:
+        """Actualizar conversación existente (renueva el TTL)"""
+        try:
+            await self._guardar(context)
+        except Exception as e:
+            self._error("update", e)
+    
+    async def _guardar(self, context: ConversationContext) -> None:
+        await self.client.set(
+            self._key(context.conversation_id),
+            json.dumps(context.to_dict(), ensure_ascii=False),
+            px=self.ttl_ms
+        )
+    
+    async def get_user_conversations(self, user_id: str) -> List[ConversationContext]:
+        """Obtener todas las conversaciones activas de un usuario"""
+        try:
+            user_key = self._user_key(user_id)
+            ids = [m.decode() for m in await self.client.smembers(user_key)]
+            if not ids:
+                return []
+            raws = await self.client.mget(*(f"{self.prefix}conv:{conv_id}" for conv_id in ids))
+            # Las conversaciones que expiraron salen del índice del usuario
+            expirados = [conv_id for conv_id, raw in zip(ids, raws) if raw is None]
+            if expirados:
+                await self.client.srem(user_key, *expirados)
+            return [self._deserializar(raw) for raw in raws if raw is not None]
+        except Exception as e:
+            self._error("get_user_conversations", e)
+            return []
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": self.nombre,
+            "ttl_seconds": self.ttl_ms // 1000,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "errors": self.errors
+        }
+    
+    async def close(self) -> None:
+        await self.client.aclose()
 
 
 class ContextManager:
     """Gestor principal de contexto conversacional"""
     
-    def __init__(self, supabase_client, cache_size: int = 1000, ttl_minutes: int = 30):
+    def __init__(self, supabase_client, cache_size: int = 1000, ttl_minutes: int = 30,
+                 db: Optional[SupabaseExecutor] = None,
+                 token_counter: Optional[TokenCounter] = None,
+                 summarizer: Optional[Summarizer] = None,
+                 summary_max_tokens: int = 300,
+                 cache: Optional[ConversationCacheBackend] = None,
+                 cache_shards: int = 16,
+                 cache_max_bytes: Optional[int] = None,
+                 persist_batch_size: int = 50,
+                 persist_wait_ms: float = 200.0,
+                 persist_dead_letter: Optional[str] = None,
+                 history_page_size: int = 20,
+                 snapshot_path: Optional[str] = None,
+                 snapshot_max: int = 1000):
         self.supabase = supabase_client
-        self.cache = ConversationCache(max_size=cache_size, ttl_minutes=ttl_minutes)
+        self.db = db or get_db_executor()
+        self.token_counter = token_counter or get_token_counter()
+        # Resumen progresivo: sin summarizer los turnos antiguos se descartan
+        self.summarizer = summarizer
+        self.summary_max_tokens = summary_max_tokens
+        self._summary_tasks: Dict[UUID, asyncio.Task] = {}
+        self.summary_stats = {"generados": 0, "errores": 0}
+        # Sin backend explícito la caché es local al proceso
+        self.cache = cache or ConversationCache(
+            max_size=cache_size, ttl_minutes=ttl_minutes, shards=cache_shards,
+            max_bytes=cache_max_bytes
+        )
         self.session_locks: Dict[UUID, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Mensajes por consulta al cargar el final del historial
+        self.history_page_size = history_page_size
+        # Snapshot de la caché para sobrevivir a reinicios (solo caché en memoria)
+        self.snapshot_path = snapshot_path
+        self.snapshot_max = snapshot_max
+        self._snapshot_pendiente: Dict[UUID, Dict[str, Any]] = {}
+        self._snapshot_guardado_en: Optional[str] = None
+        self.snapshot_stats = {"guardados": 0, "restaurados": 0, "obsoletos": 0}
+        # Los mensajes se persisten en lotes multi-fila fuera del camino de la respuesta
+        self.persistencia = WriteBehindQueue(
+            "mensajes_chat", self._insertar_mensajes,
+            max_batch_size=persist_batch_size, max_wait_ms=persist_wait_ms,
+            dead_letter_path=persist_dead_letter
+        )
         
         # Iniciar tarea de limpieza solo si hay un event loop corriendo
+        self._cleanup_task: Optional[asyncio.Task] = None
         try:
             loop = asyncio.get_running_loop()
-            loop.create_task(self._periodic_cleanup())
+            self._cleanup_task = loop.create_task(self._periodic_cleanup())
         except RuntimeError:
             # No hay event loop corriendo, la limpieza se hará cuando se necesite
             pass
@@ -213,11 +741,15 @@ class ContextManager:
         if context:
             return context
         
-        # Si no está en caché, cargar desde BD
-        context = await self._load_from_database(conversation_id, user_id, speciality)
+        # Si no está en caché, restaurar del snapshot del último apagado o cargar desde BD
+        context = await self._restaurar_de_snapshot(conversation_id)
+        if context is None:
+            context = await self._load_from_database(conversation_id, user_id, speciality)
         
         # Almacenar en caché
         await self.cache.put(context)
+        # Los turnos antiguos del historial que no caben se resumen en segundo plano
+        self._programar_resumen(context)
         
         return context
     
@@ -234,25 +766,19 @@ class ContextManager:
             context = await self.cache.get(conversation_id)
             
             if not context:
-                # Crear nuevo contexto si no existe
-                context = ConversationContext(
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    speciality=EspecialidadEnum.GENERAL,  # Se puede actualizar dinámicamente
-                    messages=deque(),
-                    metadata={},
-                    last_activity=datetime.now(),
-                    token_count=0
-                )
+                # Cargar el historial (vacío si la conversación es nueva) y dejarlo en caché;
+                # un contexto creado aquí sin cachear se perdía en el siguiente turno
+                context = await self.get_conversation_context(conversation_id, user_id)
             
             # Agregar mensaje
             context.add_message(message)
+            self._programar_resumen(context)
             
             # Actualizar caché
             await self.cache.update(conversation_id, context)
             
-            # Persistir en BD de forma asíncrona (no bloquear)
-            asyncio.create_task(self._persist_message(conversation_id, message))
+            # Encolar para persistir en BD por lotes (no bloquear)
+            await self._persist_message(conversation_id, message)
             
             return context
     
@@ -261,7 +787,7 @@ class ContextManager:
         conversation_id: UUID,
         include_rag: bool = True,
         rag_query: Optional[str] = None
-    ) -> List[ChatMessage]:
+    ) -> List[MensajeContexto]:
         """Obtener contexto optimizado para enviar al modelo IA"""
         
         context = await self.cache.get(conversation_id)
@@ -275,7 +801,8 @@ class ContextManager:
                 messages=deque(),
                 metadata={},
                 last_activity=datetime.now(),
-                token_count=0
+                token_count=0,
+                token_counter=self.token_counter
             )
             messages = basic_context.get_context_messages()
         else:
@@ -288,11 +815,85 @@ class ContextManager:
             rag_context = await self._get_rag_context(rag_query)
             if rag_context and messages:
                 # Insertar contexto RAG antes del último mensaje del usuario
+                # (en una copia: el system prompt es compartido)
                 system_msg = messages[0]
-                system_msg.content += f"\\n\\nCONTEXTO RELEVANTE:\\n{rag_context}"
+                messages[0] = MensajeContexto(
+                    system_msg.role, system_msg.content + f"\\n\\nCONTEXTO RELEVANTE:\\n{rag_context}"
+                )
+                messages[0].tokens = self.token_counter.contar_mensaje(messages[0])
         
+        # El contexto RAG puede superar la ventana: descartar los turnos más antiguos
+        context_window = context.context_window if context else ConversationContext.context_window
+        return self._ajustar_a_ventana(messages, context_window)
+    
+    def _ajustar_a_ventana(self, messages: List[MensajeContexto],
+                           context_window: int) -> List[MensajeContexto]:
+        """Quitar turnos antiguos (conservando system prompt, resumen y último turno) hasta caber"""
+        total = sum(m.tokens for m in messages)
+        while total > context_window:
+            indice = next(
+                (i for i in range(1, len(messages) - 1) if messages[i].role != RolChatEnum.SYSTEM),
+                None
+            )
+            if indice is None:
+                break
+            total -= messages.pop(indice).tokens
         return messages
     
+    def _summary_budget(self) -> int:
+        """Tokens reservados al resumen en los contextos nuevos"""
+        return self.summary_max_tokens if self.summarizer is not None else 0
+    
+    def _programar_resumen(self, context: ConversationContext) -> None:
+        """Resumir en segundo plano los turnos desplazados (fuera del camino crítico)"""
+        if not context.pending_summary or self.summarizer is None:
+            return
+        tarea = self._summary_tasks.get(context.conversation_id)
+        if tarea is not None and not tarea.done():
+            return  # La tarea en curso recoge también los turnos nuevos
+        self._summary_tasks[context.conversation_id] = asyncio.create_task(
+            self._actualizar_resumen(context)
+        )
+    
+    async def _actualizar_resumen(self, context: ConversationContext) -> None:
+        """Incorporar los turnos desplazados al resumen de la conversación"""
+        try:
+            while context.pending_summary:
+                turnos, context.pending_summary = context.pending_summary, []
+                try:
+                    context.summary = await self.summarizer(context.summary, turnos)
+                    self.summary_stats["generados"] += 1
+                except Exception as e:
+                    self.summary_stats["errores"] += 1
+                    print(f"⚠️ Error resumiendo conversación {context.conversation_id}: {e}")
+                    # Se reintenta con el próximo turno desplazado
+                    context.pending_summary = (turnos + context.pending_summary)[-MAX_TURNOS_PENDIENTES:]
+                    break
+                context = await self._publicar_resumen(context, turnos)
+        finally:
+            self._summary_tasks.pop(context.conversation_id, None)
+    
+    async def _publicar_resumen(self, context: ConversationContext,
+                                turnos: List[MensajeContexto]) -> ConversationContext:
+        """Llevar el resumen a la versión en caché del contexto
+        
+        En la caché en memoria es el mismo objeto; en una caché compartida el
+        contexto del resumen es una copia que pudo quedar atrás de otros turnos.
+        En ambos casos se vuelve a guardar para recalcular su tamaño estimado.
+        """
+        async with self.session_locks[context.conversation_id]:
+            actual = await self.cache.get(context.conversation_id)
+            if actual is None:
+                return context
+            if actual is context:
+                await self.cache.update(context.conversation_id, context)
+                return context
+            actual.summary = context.summary
+            if actual.pending_summary[:len(turnos)] == turnos:
+                del actual.pending_summary[:len(turnos)]
+            await self.cache.update(actual.conversation_id, actual)
+            return actual
+    
     async def get_user_active_sessions(self, user_id: str) -> List[Dict[str, Any]]:
         """Obtener todas las sesiones activas de un usuario"""
         conversations = await self.cache.get_user_conversations(user_id)
@@ -317,41 +918,39 @@ class ContextManager:
         """Cargar conversación desde la base de datos"""
         
         try:
-            # Obtener metadatos de la conversación
-            conv_result = self.supabase.table('conversaciones_chat').select('*').eq(
-                'id', str(conversation_id)
-            ).execute()
-            
-            # Obtener mensajes
-            msg_result = self.supabase.table('mensajes_chat').select('*').eq(
-                'conversacion_id', str(conversation_id)
-            ).order('timestamp_mensaje', desc=False).execute()
-            
-            messages = deque()
-            total_tokens = 0
+            # Obtener metadatos y los mensajes más recientes de la conversación en paralelo
+            conv_result, filas = await asyncio.gather(
+                self.db.execute(self.supabase.table('conversaciones_chat').select('especialidad').eq(
+                    'id', str(conversation_id)
+                )),
+                self._load_tail(conversation_id, ConversationContext.context_window)
+            )
             
-            for msg_data in msg_result.data or []:
-                message = ChatMessage(
-                    role=RolChatEnum(msg_data['rol']),
-                    content=msg_data['contenido']
-                )
-                messages.append(message)
-                total_tokens += len(msg_data['contenido']) // 3  # Estimación de tokens
+            messages = deque(
+                (MensajeContexto(RolChatEnum(msg_data['rol']), msg_data['contenido'])
+                 for msg_data in reversed(filas)),
+                maxlen=MAX_MENSAJES_CONTEXTO
+            )
             
             # Obtener especialidad de la conversación o usar la proporcionada
             conv_speciality = speciality
             if conv_result.data:
                 conv_speciality = EspecialidadEnum(conv_result.data[0].get('especialidad', speciality.value))
             
-            return ConversationContext(
+            # token_count se calcula con el contador al construir el contexto
+            context = ConversationContext(
                 conversation_id=conversation_id,
                 user_id=user_id,
                 speciality=conv_speciality,
                 messages=messages,
                 metadata={},
                 last_activity=datetime.now(),
-                token_count=total_tokens
+                token_count=0,
+                token_counter=self.token_counter,
+                summary_max_tokens=self._summary_budget()
             )
+            context._trim_if_needed()
+            return context
             
         except Exception as e:
             print(f"Error cargando conversación desde BD: {e}")
@@ -363,20 +962,179 @@ class ContextManager:
                 messages=deque(),
                 metadata={},
                 last_activity=datetime.now(),
-                token_count=0
+                token_count=0,
+                token_counter=self.token_counter,
+                summary_max_tokens=self._summary_budget()
             )
     
+    async def _load_tail(self, conversation_id: UUID, presupuesto: int) -> List[Dict[str, Any]]:
+        """Mensajes más recientes (de nuevo a antiguo) hasta cubrir el presupuesto de tokens
+        
+        Las conversaciones largas no se leen completas: se piden páginas
+        descendentes hasta llenar la ventana de contexto o el máximo de
+        mensajes en memoria. Los que sobren tras el recorte van al resumen.
+        """
+        filas: List[Dict[str, Any]] = []
+        tokens = 0
+        cursor = None
+        while True:
+            limite = min(self.history_page_size, MAX_MENSAJES_CONTEXTO - len(filas))
+            pagina, cursor = await consultar_mensajes_recientes(
+                self.db, self.supabase, conversation_id, limite, cursor
+            )
+            filas.extend(pagina)
+            tokens += sum(self.token_counter.contar_mensaje({"content": f['contenido']}) for f in pagina)
+            if cursor is None or tokens >= presupuesto or len(filas) >= MAX_MENSAJES_CONTEXTO:
+                return filas
+    
     async def _persist_message(self, conversation_id: UUID, message: ChatMessage) -> None:
-        """Persistir mensaje en base de datos de forma asíncrona"""
+        """Encolar el mensaje en la persistencia por lotes"""
+        fila = {
+            'conversacion_id': str(conversation_id),
+            'rol': message.role.value,
+            'contenido': message.content,
+            # La marca de tiempo se fija al encolar: el orden no depende del lote
+            'timestamp_mensaje': datetime.now().isoformat()
+        }
+        try:
+            await self.persistencia.submit(fila)
+        except RuntimeError:
+            # Cola cerrada (apagado en curso): insertar directamente
+            try:
+                await self._insertar_mensajes([fila])
+            except Exception as e:
+                print(f"Error persistiendo mensaje: {e}")
+    
+    async def _insertar_mensajes(self, filas: List[Dict[str, Any]]) -> None:
+        """Insertar varios mensajes en una sola petición"""
+        await self.db.execute(self.supabase.table('mensajes_chat').insert(filas))
+    
+    async def close(self) -> None:
+        """Persistir los mensajes pendientes, guardar el snapshot y liberar la caché"""
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+        await self.persistencia.close()
+        await self.save_snapshot()
+        await self.cache.close()
+    
+    # -------------------------------
+    # Snapshot de la caché
+    # -------------------------------
+    
+    async def save_snapshot(self) -> int:
+        """Guardar en disco los contextos activos (apagado ordenado)"""
+        if not self.snapshot_path:
+            return 0
+        try:
+            contexts = await self.cache.snapshot(self.snapshot_max)
+            if not contexts:
+                return 0
+            data = {
+                "version": SNAPSHOT_VERSION,
+                # Tras vaciar la cola de persistencia: todo mensaje posterior es nuevo
+                "saved_at": datetime.now().isoformat(),
+                "contexts": [context.to_dict() for context in contexts]
+            }
+            await asyncio.to_thread(_escribir_snapshot, self.snapshot_path, data)
+            self.snapshot_stats["guardados"] = len(contexts)
+            print(f"💾 Snapshot de {len(contexts)} conversaciones guardado en {self.snapshot_path}")
+            return len(contexts)
+        except Exception as e:
+            print(f"⚠️ Error guardando snapshot de conversaciones: {e}")
+            return 0
+    
+    async def restore_snapshot(self, eager: bool = True) -> int:
+        """Cargar el snapshot del último apagado
+        
+        En modo eager se validan y cargan en caché todos los contextos al
+        arrancar; en modo lazy se restauran uno a uno en el primer acceso.
+        Un contexto se descarta si la conversación recibió mensajes después
+        del snapshot (otro proceso siguió atendiéndola) o si ya expiró.
+        """
+        if not self.snapshot_path:
+            return 0
+        try:
+            data = await asyncio.to_thread(_leer_snapshot, self.snapshot_path)
+        except Exception as e:
+            print(f"⚠️ Snapshot de conversaciones ilegible, se ignora: {e}")
+            return 0
+        if not data or data.get("version") != SNAPSHOT_VERSION:
+            return 0
+        
+        self._snapshot_guardado_en = data["saved_at"]
+        self._snapshot_pendiente = {UUID(c["conversation_id"]): c for c in data["contexts"]}
+        if not eager:
+            return 0
+        
+        obsoletas = await self._conversaciones_con_mensajes_nuevos(list(self._snapshot_pendiente))
+        restaurados = 0
+        for conversation_id in list(self._snapshot_pendiente):
+            if conversation_id in obsoletas:
+                self._snapshot_pendiente.pop(conversation_id)
+                self.snapshot_stats["obsoletos"] += 1
+                continue
+            if await self._restaurar_entrada(conversation_id):
+                restaurados += 1
+        print(f"♻️ {restaurados} conversaciones restauradas del snapshot ({len(obsoletas)} obsoletas)")
+        return restaurados
+    
+    async def _restaurar_de_snapshot(self, conversation_id: UUID) -> Optional[ConversationContext]:
+        """Restaurar un contexto del snapshot en el primer acceso (modo lazy)"""
+        if conversation_id not in self._snapshot_pendiente:
+            return None
+        if conversation_id in await self._conversaciones_con_mensajes_nuevos([conversation_id]):
+            self._snapshot_pendiente.pop(conversation_id, None)
+            self.snapshot_stats["obsoletos"] += 1
+            return None
+        return await self._restaurar_entrada(conversation_id)
+    
+    async def _restaurar_entrada(self, conversation_id: UUID) -> Optional[ConversationContext]:
+        entrada = self._snapshot_pendiente.pop(conversation_id, None)
+        if entrada is None:
+            return None
+        actual = await self.cache.get(conversation_id)
+        if actual is not None:
+            return actual  # Ya se cargó desde la BD mientras se restauraba
         try:
-            self.supabase.table('mensajes_chat').insert({
-                'conversacion_id': str(conversation_id),
-                'rol': message.role.value,
-                'contenido': message.content,
-                'timestamp_mensaje': datetime.now().isoformat()
-            }).execute()
+            context = ConversationContext.from_dict(entrada, self.token_counter)
+        except (KeyError, ValueError) as e:
+            print(f"⚠️ Contexto {conversation_id} del snapshot inválido: {e}")
+            return None
+        await self.cache.put(context)
+        # Si expiró mientras el proceso estaba parado la caché no lo conserva
+        context = await self.cache.get(conversation_id)
+        if context is not None:
+            self.snapshot_stats["restaurados"] += 1
+            self._programar_resumen(context)
+        return context
+    
+    async def _conversaciones_con_mensajes_nuevos(self, conversation_ids: List[UUID]) -> Set[UUID]:
+        """Conversaciones con mensajes posteriores al snapshot (ante error: todas)
+
+        Una consulta con `limit(1)` por conversación: basta saber si existe algún
+        mensaje nuevo, y así el resultado no depende del límite de filas de PostgREST.
+        """
+        async def tiene_mensajes_nuevos(conversation_id: UUID) -> bool:
+            result = await self.db.execute(
+                self.supabase.table('mensajes_chat').select('conversacion_id')
+                .eq('conversacion_id', str(conversation_id))
+                .gt('timestamp_mensaje', self._snapshot_guardado_en)
+                .limit(1)
+            )
+            return bool(result.data)
+        
+        obsoletas: Set[UUID] = set()
+        try:
+            for i in range(0, len(conversation_ids), 50):
+                lote = conversation_ids[i:i + 50]
+                nuevos = await asyncio.gather(*(tiene_mensajes_nuevos(c) for c in lote))
+                obsoletas.update(c for c, nuevo in zip(lote, nuevos) if nuevo)
         except Exception as e:
-            print(f"Error persistiendo mensaje: {e}")
+            print(f"⚠️ No se pudo validar el snapshot contra la BD: {e}")
+            return set(conversation_ids)
+        return obsoletas
     
     async def _get_rag_context(self, query: str) -> Optional[str]:
         """Obtener contexto RAG relevante"""
@@ -391,9 +1149,10 @@ class ContextManager:
                 await asyncio.sleep(300)  # Cada 5 minutos
                 await self.cache.cleanup_expired()
                 
-                # Limpiar locks huérfanos
-                active_conversations = set(self.cache.cache.keys())
-                orphaned_locks = set(self.session_locks.keys()) - active_conversations
+                # Limpiar locks libres (se recrean bajo demanda; la caché puede ser compartida)
+                orphaned_locks = [
+                    lock_id for lock_id, lock in self.session_locks.items() if not lock.locked()
+                ]
                 for lock_id in orphaned_locks:
                     del self.session_locks[lock_id]
                     
@@ -401,6 +1160,34 @@ class ContextManager:
                 print(f"Error en limpieza periódica: {e}")
 
 
+def _escribir_snapshot(path: str, data: Dict[str, Any]) -> None:
+    """Escritura atómica del snapshot (JSON comprimido)
+
+    El temporal es único (varios workers pueden apagarse a la vez) y se crea
+    con permisos 0600: el snapshot contiene datos de pacientes.
+    """
+    directorio = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directorio, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(
+        dir=directorio, prefix=f".{os.path.basename(path)}.", suffix=".tmp", delete=False
+    )
+    try:
+        with tmp, gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp.name, path)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+
+
+def _leer_snapshot(path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
 # Singleton global para el gestor de contexto
 _context_manager: Optional[ContextManager] = None
 
@@ -408,5 +1195,44 @@ def get_context_manager(supabase_client=None) -> ContextManager:
     """Obtener instancia singleton del gestor de contexto"""
     global _context_manager
     if _context_manager is None and supabase_client:
-        _context_manager = ContextManager(supabase_client)
+        _context_manager = ContextManager(
+            supabase_client,
+            cache_size=int(os.environ.get("CONVERSATION_CACHE_SIZE", 1000)),
+            ttl_minutes=int(os.environ.get("CONVERSATION_CACHE_TTL_MINUTES", 30)),
+            summary_max_tokens=int(os.environ.get("CHAT_SUMMARY_MAX_TOKENS", 300)),
+            cache=_crear_cache_conversaciones(),
+            cache_shards=int(os.environ.get("CONVERSATION_CACHE_SHARDS", 16)),
+            cache_max_bytes=int(float(os.environ.get("CONVERSATION_CACHE_MAX_MB", 256)) * 1024 * 1024),
+            persist_batch_size=int(os.environ.get("CHAT_PERSIST_BATCH_SIZE", 50)),
+            persist_wait_ms=float(os.environ.get("CHAT_PERSIST_WAIT_MS", 200)),
+            persist_dead_letter=os.environ.get("CHAT_PERSIST_DEAD_LETTER") or None,
+            history_page_size=int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", 20)),
+            snapshot_path=os.environ.get("CONVERSATION_CACHE_SNAPSHOT") or None,
+            snapshot_max=int(os.environ.get("CONVERSATION_CACHE_SNAPSHOT_MAX", 1000))
+        )
     return _context_manager
+
+
+def _crear_cache_conversaciones() -> Optional[ConversationCacheBackend]:
+    """Caché compartida si CONVERSATION_CACHE_URL apunta a un servidor Redis"""
+    url = os.environ.get("CONVERSATION_CACHE_URL")
+    if not url:
+        return None
+    if redis_asyncio is None:
+        print("⚠️ CONVERSATION_CACHE_URL configurada pero el paquete 'redis' no está instalado: "
+              "caché de conversaciones en memoria")
+        return None
+    # Pool bloqueante: con todas las conexiones ocupadas se espera en lugar de fallar
+    pool = redis_asyncio.BlockingConnectionPool.from_url(
+        url,
+        max_connections=int(os.environ.get("CONVERSATION_CACHE_MAX_CONNECTIONS", 20)),
+        timeout=2.0,
+        socket_timeout=2.0,
+        socket_connect_timeout=2.0
+    )
+    print(f"✅ Caché de conversaciones compartida en {url.split('@')[-1]}")
+    return RedisConversationCache(
+        redis_asyncio.Redis.from_pool(pool),
+        ttl_minutes=int(os.environ.get("CONVERSATION_CACHE_TTL_MINUTES", 30)),
+        prefix=os.environ.get("CONVERSATION_CACHE_PREFIX", "radix:chat:")
+    )
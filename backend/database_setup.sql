@@ -61,7 +61,7 @@ CREATE TABLE IF NOT EXISTS reportes (
     tipo_estudio VARCHAR(50) NOT NULL,
     fecha_reporte TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     radiologo VARCHAR(100) NOT NULL,
-    estado VARCHAR(30) DEFAULT 'Borrador' CHECK (estado IN ('Borrador', 'Pendiente Revisión', 'Firmado')),
+    estado VARCHAR(30) DEFAULT 'Borrador' CHECK (estado IN ('Borrador', 'Pendiente Revisión', 'Firmado', 'Cancelado')),
     confianza_ia DECIMAL(3,2) CHECK (confianza_ia >= 0 AND confianza_ia <= 1),
     
     -- Secciones del reporte
@@ -212,6 +212,7 @@ CREATE INDEX IF NOT EXISTS idx_reportes_estado ON reportes(estado);
 -- Índices para chat
 CREATE INDEX IF NOT EXISTS idx_chat_conversacion ON mensajes_chat(conversacion_id);
 CREATE INDEX IF NOT EXISTS idx_chat_timestamp ON mensajes_chat(timestamp_mensaje);
+CREATE INDEX IF NOT EXISTS idx_chat_conversacion_timestamp ON mensajes_chat(conversacion_id, timestamp_mensaje DESC);
 
 -- Índice vectorial para RAG
 CREATE INDEX IF NOT EXISTS idx_embeddings_vector ON reporte_embeddings USING ivfflat (embedding vector_cosine_ops);
@@ -0,0 +1,102 @@
+# db.py - Radix IA
+"""
+Capa de acceso a Supabase sin bloquear el event loop.
+
+supabase-py expone un cliente síncrono: cada `.execute()` bloquea el hilo
+hasta completar el round trip a PostgREST. Esta capa ejecuta esas llamadas
+en un pool de hilos acotado y aplica backpressure con un semáforo, de modo
+que una query lenta no detiene el resto de corrutinas del worker.
+"""
+
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+
+class DatabaseSaturadaError(Exception):
+    """La cola de queries pendientes superó el tiempo máximo de espera"""
+
+
+class SupabaseExecutor:
+    """Ejecutor de queries de Supabase sobre un pool de hilos acotado"""
+
+    def __init__(self, max_workers: int = 16, max_pending: int = 64,
+                 acquire_timeout: Optional[float] = 30.0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.acquire_timeout = acquire_timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="supabase"
+        )
+        # Limita las queries en vuelo + en cola del pool (backpressure)
+        self._semaphore = asyncio.Semaphore(max_pending)
+        self._in_flight = 0
+        self._waiting = 0
+        self._total = 0
+        self._rejected = 0
+        self._total_time = 0.0
+
+    async def execute(self, query: Any) -> Any:
+        """Ejecutar un query builder de supabase-py (`query.execute()`) sin bloquear"""
+        return await self.run(query.execute)
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Ejecutar cualquier llamada síncrona de base de datos en el pool"""
+        self._waiting += 1
+        try:
+            if self.acquire_timeout is not None:
+                await asyncio.wait_for(self._semaphore.acquire(), self.acquire_timeout)
+            else:
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            self._rejected += 1
+            raise DatabaseSaturadaError(
+                f"Base de datos saturada: más de {self.max_pending} queries pendientes"
+            )
+        finally:
+            self._waiting -= 1
+
+        self._in_flight += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+        finally:
+            self._in_flight -= 1
+            self._total += 1
+            self._total_time += time.perf_counter() - start
+            self._semaphore.release()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Detener el pool de hilos"""
+        self._executor.shutdown(wait=wait)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas del ejecutor de base de datos"""
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "total_queries": self._total,
+            "rejected": self._rejected,
+            "avg_query_ms": round(self._total_time / self._total * 1000, 2) if self._total else 0.0
+        }
+
+
+# Singleton global para el ejecutor de base de datos
+_db_executor: Optional[SupabaseExecutor] = None
+
+def get_db_executor() -> SupabaseExecutor:
+    """Obtener instancia singleton del ejecutor de base de datos"""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = SupabaseExecutor(
+            max_workers=int(os.environ.get("DB_MAX_WORKERS", 16)),
+            max_pending=int(os.environ.get("DB_MAX_PENDING", 64)),
+            acquire_timeout=float(os.environ.get("DB_ACQUIRE_TIMEOUT", 30.0))
+        )
+    return _db_executor
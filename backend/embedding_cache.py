@@ -0,0 +1,121 @@
+# embedding_cache.py - Radix IA
+"""
+Caché de embeddings indexada por hash del contenido.
+
+Dos niveles:
+- LRU en memoria acotado por número de entradas
+- Tier opcional en SQLite que sobrevive reinicios del proceso
+
+Los vectores se guardan en SQLite como float32 empaquetados para mantener
+el archivo compacto (1024 dims ≈ 4 KB por entrada).
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any
+
+
+class EmbeddingCache:
+    """Caché LRU de embeddings con respaldo persistente opcional"""
+
+    def __init__(self, max_entries: int = 10000, db_path: Optional[str] = None,
+                 namespace: str = ""):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        # El namespace (p. ej. URL del modelo) evita mezclar vectores de modelos distintos
+        self.namespace = namespace
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+                "created_at REAL DEFAULT (julianday('now')))"
+            )
+            self._db.commit()
+
+    def key(self, text: str) -> str:
+        """Clave de caché: sha256 del namespace + texto"""
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    async def get(self, text: str) -> Optional[List[float]]:
+        """Buscar embedding en memoria y, si no está, en disco"""
+        key = self.key(text)
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return vector
+
+        if self._db is not None:
+            vector = await asyncio.to_thread(self._db_get, key)
+            if vector is not None:
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    async def put(self, text: str, vector: List[float]) -> None:
+        """Guardar embedding en ambos niveles"""
+        key = self.key(text)
+        self._remember(key, vector)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_put, key, vector)
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        """Insertar en el LRU en memoria expulsando la entrada más antigua"""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _db_get(self, key: str) -> Optional[List[float]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def _db_put(self, key: str, vector: List[float]) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                (key, array("f", vector).tobytes())
+            )
+            self._db.commit()
+
+    def close(self) -> None:
+        """Cerrar la conexión SQLite si existe"""
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Contadores de aciertos/fallos y ocupación"""
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "entries_in_memory": len(self._memory),
+            "max_entries": self.max_entries,
+            "persistent": self._db is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / total, 4) if total else 0.0
+        }
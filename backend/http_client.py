@@ -0,0 +1,162 @@
+# http_client.py - Radix IA
+"""
+Capa de clientes HTTP compartidos para los servicios upstream (TGI y embeddings).
+
+Mantiene un httpx.AsyncClient por upstream con keep-alive, HTTP/2 cuando el
+paquete `h2` está disponible, límites de conexiones y timeouts configurables.
+Los clientes se crean una sola vez por proceso y se cierran en el shutdown.
+Cada upstream tiene además su política de reintentos, cobertura y circuit
+breaker (ver resilience.py).
+"""
+
+import os
+import importlib.util
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import httpx
+
+from resilience import ResilienceConfig, ResilientUpstream
+
+
+@dataclass
+class UpstreamConfig:
+    """Configuración de conexión para un upstream HTTP"""
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 60.0
+    connect_timeout: float = 10.0
+    read_timeout: float = 180.0
+    write_timeout: float = 30.0
+    pool_timeout: float = 10.0
+    http2: bool = True
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults) -> "UpstreamConfig":
+        """Construir configuración leyendo variables <PREFIX>_HTTP_* del entorno"""
+        config = cls(**defaults)
+
+        def _env(name: str, cast, current):
+            value = os.environ.get(f"{prefix}_HTTP_{name}")
+            return cast(value) if value not in (None, "") else current
+
+        config.max_connections = _env("MAX_CONNECTIONS", int, config.max_connections)
+        config.max_keepalive_connections = _env("MAX_KEEPALIVE", int, config.max_keepalive_connections)
+        config.keepalive_expiry = _env("KEEPALIVE_EXPIRY", float, config.keepalive_expiry)
+        config.connect_timeout = _env("CONNECT_TIMEOUT", float, config.connect_timeout)
+        config.read_timeout = _env("READ_TIMEOUT", float, config.read_timeout)
+        config.write_timeout = _env("WRITE_TIMEOUT", float, config.write_timeout)
+        config.pool_timeout = _env("POOL_TIMEOUT", float, config.pool_timeout)
+        config.http2 = _env("HTTP2", lambda v: v.lower() == "true", config.http2)
+        return config
+
+
+def _http2_disponible() -> bool:
+    """HTTP/2 en httpx requiere el paquete opcional `h2`"""
+    return importlib.util.find_spec("h2") is not None
+
+
+class HTTPClientManager:
+    """Registro de clientes httpx compartidos, uno por upstream"""
+
+    def __init__(self):
+        self._configs: Dict[str, UpstreamConfig] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._resiliencia: Dict[str, ResilienceConfig] = {}
+        self._upstreams: Dict[str, ResilientUpstream] = {}
+
+    def register(self, name: str, config: UpstreamConfig,
+                 resiliencia: Optional[ResilienceConfig] = None) -> None:
+        """Registrar (o reemplazar) la configuración de un upstream"""
+        self._configs[name] = config
+        if resiliencia is not None:
+            self._resiliencia[name] = resiliencia
+            self._upstreams.pop(name, None)
+
+    def client(self, name: str) -> httpx.AsyncClient:
+        """Obtener el cliente del upstream, creándolo de forma perezosa"""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._build_client(self._configs.get(name) or UpstreamConfig())
+            self._clients[name] = client
+        return client
+
+    def upstream(self, name: str) -> ResilientUpstream:
+        """Llamadas al upstream con reintentos, cobertura y circuit breaker"""
+        upstream = self._upstreams.get(name)
+        if upstream is None:
+            upstream = ResilientUpstream(
+                name, lambda: self.client(name), self._resiliencia.get(name)
+            )
+            self._upstreams[name] = upstream
+        return upstream
+
+    def _build_client(self, config: UpstreamConfig) -> httpx.AsyncClient:
+        """Crear un cliente con pool de conexiones y timeouts configurados"""
+        return httpx.AsyncClient(
+            http2=config.http2 and _http2_disponible(),
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry
+            ),
+            timeout=httpx.Timeout(
+                connect=config.connect_timeout,
+                read=config.read_timeout,
+                write=config.write_timeout,
+                pool=config.pool_timeout
+            ),
+            headers=config.headers
+        )
+
+    async def startup(self) -> None:
+        """Crear todos los clientes registrados al iniciar la aplicación"""
+        for name in self._configs:
+            self.client(name)
+
+    async def aclose(self) -> None:
+        """Cerrar todos los clientes y liberar las conexiones del pool"""
+        for client in self._clients.values():
+            if not client.is_closed:
+                await client.aclose()
+        self._clients.clear()
+
+    def get_stats(self) -> Dict[str, Dict[str, object]]:
+        """Resumen de configuración de cada upstream"""
+        return {
+            name: {
+                "http2": config.http2 and _http2_disponible(),
+                "max_connections": config.max_connections,
+                "max_keepalive_connections": config.max_keepalive_connections,
+                "open": name in self._clients and not self._clients[name].is_closed,
+                **self.upstream(name).get_stats()
+            }
+            for name, config in self._configs.items()
+        }
+
+
+# Nombres de upstreams conocidos
+TGI_UPSTREAM = "tgi"
+EMBEDDINGS_UPSTREAM = "embeddings"
+
+# Singleton global para los clientes HTTP
+_http_clients: Optional[HTTPClientManager] = None
+
+def get_http_clients() -> HTTPClientManager:
+    """Obtener instancia singleton del gestor de clientes HTTP"""
+    global _http_clients
+    if _http_clients is None:
+        _http_clients = HTTPClientManager()
+        _http_clients.register(
+            TGI_UPSTREAM,
+            UpstreamConfig.from_env("TGI"),
+            ResilienceConfig.from_env("TGI")
+        )
+        # Los embeddings son baratos: cobertura a partir del p95 por defecto
+        _http_clients.register(
+            EMBEDDINGS_UPSTREAM,
+            UpstreamConfig.from_env("EMBEDDING", read_timeout=30.0),
+            ResilienceConfig.from_env("EMBEDDING", hedge_percentile=95.0)
+        )
+    return _http_clients
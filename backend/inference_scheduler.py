@@ -0,0 +1,154 @@
+# inference_scheduler.py - Radix IA
+"""
+Planificador de inferencia delante de TGI.
+
+Limita las peticiones simultáneas al endpoint de TGI (max in-flight) y
+ordena las que esperan en una cola de prioridad: estudios críticos y
+urgentes primero, luego reportes y por último el chat. Si la cola supera
+su profundidad máxima la petición se rechaza de inmediato en lugar de
+acumular timeouts.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import count
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from models import PrioridadEnum
+
+# Prioridades (menor = antes)
+PRIORIDAD_CRITICA = 0
+PRIORIDAD_URGENTE = 1
+PRIORIDAD_REPORTE = 2
+PRIORIDAD_CHAT = 3
+PRIORIDAD_LOTE = 4
+
+_PRIORIDAD_ESTUDIO = {
+    PrioridadEnum.CRITICA: PRIORIDAD_CRITICA,
+    PrioridadEnum.URGENTE: PRIORIDAD_URGENTE,
+    PrioridadEnum.NORMAL: PRIORIDAD_REPORTE,
+}
+
+
+def prioridad_reporte(prioridad: Optional[PrioridadEnum]) -> int:
+    """Prioridad de cola para la generación de un reporte"""
+    return _PRIORIDAD_ESTUDIO.get(prioridad, PRIORIDAD_REPORTE)
+
+
+def prioridad_lote(prioridad: Optional[PrioridadEnum]) -> int:
+    """Prioridad de cola para un reporte de un lote (pre-generación nocturna)
+
+    Los estudios críticos y urgentes conservan su prioridad; el resto cede
+    el paso al chat interactivo.
+    """
+    cola = prioridad_reporte(prioridad)
+    return cola if cola < PRIORIDAD_REPORTE else PRIORIDAD_LOTE
+
+
+class ColaInferenciaLlenaError(Exception):
+    """La cola de inferencia superó su profundidad máxima o el tiempo de espera"""
+
+
+class InferenceScheduler:
+    """Limitador de concurrencia con cola de prioridad para TGI"""
+
+    def __init__(self, max_in_flight: int = 4, max_queue: int = 32,
+                 queue_timeout: Optional[float] = 60.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._cola: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = count()
+        self._esperas: Deque[float] = deque(maxlen=1000)
+        self._por_etiqueta: Dict[str, int] = {}
+        self._completadas = 0
+        self._rechazadas = 0
+
+    @asynccontextmanager
+    async def slot(self, prioridad: int = PRIORIDAD_CHAT, etiqueta: str = "chat") -> AsyncIterator[None]:
+        """Reservar un lugar de inferencia durante el bloque `async with`"""
+        await self._adquirir(prioridad)
+        self._por_etiqueta[etiqueta] = self._por_etiqueta.get(etiqueta, 0) + 1
+        try:
+            yield
+        finally:
+            self._completadas += 1
+            self._liberar()
+
+    async def _adquirir(self, prioridad: int) -> None:
+        inicio = time.perf_counter()
+        if self._in_flight < self.max_in_flight and not self._cola:
+            self._in_flight += 1
+            self._esperas.append(0.0)
+            return
+
+        if len(self._cola) >= self.max_queue:
+            self._rechazadas += 1
+            raise ColaInferenciaLlenaError(
+                f"Servicio de IA saturado: {len(self._cola)} peticiones en cola"
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        entrada = (prioridad, next(self._seq), future)
+        heapq.heappush(self._cola, entrada)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                # El lugar se asignó justo al expirar: devolverlo
+                self._liberar()
+            else:
+                future.cancel()
+                self._cola.remove(entrada)
+                heapq.heapify(self._cola)
+            if isinstance(e, asyncio.TimeoutError):
+                self._rechazadas += 1
+                raise ColaInferenciaLlenaError(
+                    f"Tiempo de espera en cola de IA agotado ({self.queue_timeout}s)"
+                )
+            raise
+        self._esperas.append(time.perf_counter() - inicio)
+
+    def _liberar(self) -> None:
+        """Pasar el lugar al siguiente en cola (o liberarlo)"""
+        if self._cola:
+            _, _, future = heapq.heappop(self._cola)
+            future.set_result(None)
+            return
+        self._in_flight -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas del planificador (espera en cola en milisegundos)"""
+        esperas = sorted(self._esperas)
+        p95 = esperas[min(int(len(esperas) * 0.95), len(esperas) - 1)] if esperas else 0.0
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self._in_flight,
+            "queued": len(self._cola),
+            "completed": self._completadas,
+            "rejected": self._rechazadas,
+            "by_type": dict(self._por_etiqueta),
+            "avg_queue_wait_ms": round(sum(esperas) / len(esperas) * 1000, 2) if esperas else 0.0,
+            "p95_queue_wait_ms": round(p95 * 1000, 2)
+        }
+
+
+# Singleton global para el planificador de inferencia
+_inference_scheduler: Optional[InferenceScheduler] = None
+
+def get_inference_scheduler() -> InferenceScheduler:
+    """Obtener instancia singleton del planificador de inferencia"""
+    global _inference_scheduler
+    if _inference_scheduler is None:
+        _inference_scheduler = InferenceScheduler(
+            max_in_flight=int(os.environ.get("INFERENCE_MAX_IN_FLIGHT", 4)),
+            max_queue=int(os.environ.get("INFERENCE_MAX_QUEUE", 32)),
+            queue_timeout=float(os.environ.get("INFERENCE_QUEUE_TIMEOUT", 60.0))
+        )
+    return _inference_scheduler
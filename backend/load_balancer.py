@@ -0,0 +1,182 @@
+# load_balancer.py - Radix IA
+"""
+Balanceo de carga entre réplicas de TGI.
+
+- Menor número de peticiones en curso (least outstanding requests) entre
+  las réplicas sanas; los empates se reparten por turnos.
+- Afinidad (sticky routing): una conversación vuelve a la misma réplica
+  para aprovechar su caché de prefijos, salvo que esa réplica esté
+  claramente más cargada que la menos ocupada.
+- Salud: verificación activa periódica de `/health` y pasiva por errores
+  consecutivos (transporte o respuestas 5xx). Si ninguna réplica está
+  sana se usan todas.
+"""
+
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Any, AsyncIterator, Callable, Collection, Deque, Dict, Iterable, Optional, Tuple
+
+import httpx
+
+
+@dataclass
+class Replica:
+    """Estado y métricas de una réplica de TGI"""
+    url: str
+    activa: bool = True
+    en_curso: int = 0
+    completadas: int = 0
+    errores: int = 0
+    errores_consecutivos: int = 0
+    ultima_verificacion: Optional[float] = None
+    latencias: Deque[float] = field(default_factory=lambda: deque(maxlen=200))
+
+    def get_stats(self) -> Dict[str, Any]:
+        latencias = sorted(self.latencias)
+        p95 = latencias[min(int(len(latencias) * 0.95), len(latencias) - 1)] if latencias else 0.0
+        return {
+            "healthy": self.activa,
+            "in_flight": self.en_curso,
+            "completed": self.completadas,
+            "errors": self.errores,
+            "avg_latency_ms": round(sum(latencias) / len(latencias) * 1000, 2) if latencias else 0.0,
+            "p95_latency_ms": round(p95 * 1000, 2),
+            "last_health_check": self.ultima_verificacion
+        }
+
+
+class TGILoadBalancer:
+    """Selección de réplica TGI por carga, salud y afinidad de conversación"""
+
+    def __init__(self, urls: Iterable[str], max_errores: int = 3,
+                 sticky_ttl: float = 1800.0, sticky_max: int = 10000,
+                 sticky_holgura: int = 4):
+        urls = [u.strip().rstrip("/") for u in urls if u and u.strip()]
+        if not urls:
+            raise ValueError("Se requiere al menos un endpoint de TGI")
+        self.replicas = [Replica(url) for url in dict.fromkeys(urls)]
+        self.max_errores = max_errores
+        self.sticky_ttl = sticky_ttl
+        self.sticky_max = sticky_max
+        # Peticiones en curso de más que se toleran para respetar la afinidad
+        self.sticky_holgura = sticky_holgura
+        self._afinidad: "OrderedDict[str, Tuple[Replica, float]]" = OrderedDict()
+        self._turno = count()
+        self.afinidad_hits = 0
+        self.afinidad_misses = 0
+
+    @property
+    def url_principal(self) -> str:
+        return self.replicas[0].url
+
+    def elegir(self, clave: Optional[str] = None, excluir: Collection[str] = ()) -> Replica:
+        """Réplica para la siguiente petición (`clave` = conversación u otra afinidad)
+
+        `excluir` son URLs a evitar (réplicas que ya fallaron en esta petición
+        o con el circuito abierto) mientras quede alguna otra sana.
+        """
+        sanas = [r for r in self.replicas if r.activa]
+        candidatas = [r for r in sanas if r.url not in excluir] or sanas or self.replicas
+        menor = min(r.en_curso for r in candidatas)
+        ahora = time.monotonic()
+
+        if clave is not None:
+            entrada = self._afinidad.get(clave)
+            if entrada is not None:
+                replica, expira = entrada
+                if (expira > ahora and replica in candidatas
+                        and replica.en_curso <= menor + self.sticky_holgura):
+                    self._afinidad[clave] = (replica, ahora + self.sticky_ttl)
+                    self._afinidad.move_to_end(clave)
+                    self.afinidad_hits += 1
+                    return replica
+
+        menos_cargadas = [r for r in candidatas if r.en_curso == menor]
+        replica = menos_cargadas[next(self._turno) % len(menos_cargadas)]
+
+        if clave is not None:
+            self.afinidad_misses += 1
+            self._afinidad[clave] = (replica, ahora + self.sticky_ttl)
+            self._afinidad.move_to_end(clave)
+            while len(self._afinidad) > self.sticky_max:
+                self._afinidad.popitem(last=False)
+        return replica
+
+    @asynccontextmanager
+    async def usar(self, clave: Optional[str] = None,
+                   excluir: Collection[str] = ()) -> AsyncIterator[str]:
+        """URL base de la réplica elegida, contabilizada mientras dura el bloque
+
+        Un error de transporte o un `httpx.HTTPStatusError` 5xx lanzado dentro
+        del bloque cuenta como fallo de la réplica.
+        """
+        replica = self.elegir(clave, excluir)
+        replica.en_curso += 1
+        inicio = time.perf_counter()
+        try:
+            yield replica.url
+        except httpx.TransportError:
+            self._registrar_error(replica)
+            raise
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code >= 500:
+                self._registrar_error(replica)
+            raise
+        else:
+            replica.errores_consecutivos = 0
+            replica.completadas += 1
+            replica.latencias.append(time.perf_counter() - inicio)
+        finally:
+            replica.en_curso -= 1
+
+    def _registrar_error(self, replica: Replica) -> None:
+        replica.errores += 1
+        replica.errores_consecutivos += 1
+        if replica.activa and replica.errores_consecutivos >= self.max_errores:
+            replica.activa = False
+            print(f"⚠️ Réplica TGI fuera de rotación tras {replica.errores_consecutivos} errores: {replica.url}")
+
+    async def verificar_salud(self, client: httpx.AsyncClient, timeout: float = 5.0,
+                              headers: Optional[Dict[str, str]] = None) -> None:
+        """Consultar `/health` de cada réplica y actualizar su estado
+
+        `headers` permite autenticar la consulta (endpoints protegidos de HF).
+        """
+        async def verificar(replica: Replica) -> None:
+            try:
+                response = await client.get(f"{replica.url}/health", headers=headers, timeout=timeout)
+                activa = response.status_code == 200
+            except httpx.HTTPError:
+                activa = False
+            if activa != replica.activa:
+                print(f"{'✅' if activa else '⚠️'} Réplica TGI {'sana' if activa else 'no disponible'}: {replica.url}")
+            replica.activa = activa
+            if activa:
+                replica.errores_consecutivos = 0
+            replica.ultima_verificacion = time.time()
+
+        await asyncio.gather(*(verificar(r) for r in self.replicas))
+
+    async def vigilar(self, client_factory: Callable[[], httpx.AsyncClient],
+                      intervalo: float = 15.0,
+                      headers: Optional[Dict[str, str]] = None) -> None:
+        """Bucle de verificación de salud (tarea en segundo plano)"""
+        while True:
+            try:
+                await self.verificar_salud(client_factory(), headers=headers)
+            except Exception as e:
+                print(f"⚠️ Error verificando réplicas TGI: {e}")
+            await asyncio.sleep(intervalo)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas por réplica y de afinidad"""
+        return {
+            "replicas": {r.url: r.get_stats() for r in self.replicas},
+            "sticky_sessions": len(self._afinidad),
+            "sticky_hits": self.afinidad_hits,
+            "sticky_misses": self.afinidad_misses
+        }
@@ -1,28 +1,95 @@
 import os
+import asyncio
 import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, Query, File, UploadFile, Header
+from fastapi import FastAPI, HTTPException, Depends, Query, File, UploadFile, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from supabase import create_client, Client
 from typing import Optional, List
 from uuid import UUID
 from datetime import datetime
+from contextlib import asynccontextmanager
 
 # Importar modelos y servicios
 from models import *
 from services import PacienteService, EstudioService, ReporteService, ChatService, IAService, EmbeddingService, OrdenCompraService, PersonalService
+from http_client import get_http_clients, TGI_UPSTREAM
+from load_balancer import TGILoadBalancer
+from db import get_db_executor
+from embedding_cache import EmbeddingCache
+from vector_index import LocalVectorIndex
+from semantic_cache import SemanticResponseCache
+from backfill_embeddings import EmbeddingBackfill
 
 # Cargar variables de entorno desde .env
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicializar y liberar recursos compartidos del proceso"""
+    await http_clients.startup()
+    health_task = None
+    if len(tgi_balancer.replicas) > 1:
+        # Verificar periódicamente la salud de las réplicas de TGI
+        health_task = asyncio.create_task(tgi_balancer.vigilar(
+            lambda: http_clients.client(TGI_UPSTREAM),
+            intervalo=float(os.environ.get("TGI_HEALTH_INTERVAL", 15)),
+            # Los endpoints protegidos de Hugging Face exigen el token también en /health
+            headers={"Authorization": f"Bearer {os.environ.get('HF_API_KEY', 'hf_XXXXX')}"}
+        ))
+    restore_task = None
+    modo_restauracion = os.environ.get("CONVERSATION_CACHE_RESTORE", "eager").lower()
+    if (chat_service.context_manager is not None and chat_service.context_manager.snapshot_path
+            and modo_restauracion in ("eager", "lazy")):
+        # Contextos del último apagado: evita recargar de la BD todas las consultas activas
+        restore_task = asyncio.create_task(
+            chat_service.context_manager.restore_snapshot(eager=modo_restauracion == "eager")
+        )
+    index_task = None
+    if vector_index is not None:
+        # Abrir el snapshot en disco y sincronizar con la BD en segundo plano
+        if vector_index.load():
+            print(f"✅ Índice vectorial local cargado: {len(vector_index)} vectores")
+        index_task = asyncio.create_task(_sincronizar_indice_vectorial(
+            intervalo=float(os.environ.get("RAG_LOCAL_INDEX_SYNC_SECONDS", 300))
+        ))
+    yield
+    if health_task is not None:
+        health_task.cancel()
+    if index_task is not None:
+        index_task.cancel()
+    if restore_task is not None:
+        restore_task.cancel()
+    if vector_index is not None and vector_index.listo:
+        vector_index.save()
+    await http_clients.aclose()
+    if chat_service.context_manager is not None:
+        await chat_service.context_manager.close()
+    db_executor.shutdown(wait=False)
+    embedding_cache.close()
+
+async def _sincronizar_indice_vectorial(intervalo: float):
+    """Reconciliar periódicamente el índice local con la BD (altas de otros workers y borrados)"""
+    while True:
+        try:
+            cambios = await vector_index.sync_with_database(supabase, db_executor)
+            print(f"✅ Índice vectorial local sincronizado (+{cambios['agregados']}, "
+                  f"-{cambios['eliminados']}, total {len(vector_index)})")
+        except Exception as e:
+            print(f"⚠️ No se pudo sincronizar el índice vectorial local: {e}")
+        if intervalo <= 0:
+            return
+        await asyncio.sleep(intervalo)
+
 # --- Configuración de la App, Modelos y Supabase ---
 app = FastAPI(
     title="Radix IA - Sistema Médico Inteligente",
     description="API completa para gestión médica con IA, incluyendo pacientes, estudios, reportes y chat médico.",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # Configuración de CORS
@@ -39,23 +106,72 @@ supabase_url: str = os.environ.get("SUPABASE_URL")
 supabase_key: str = os.environ.get("SUPABASE_SERVICE_KEY")
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# Ejecutor no bloqueante para las queries de Supabase (pool de hilos acotado)
+db_executor = get_db_executor()
+
 # URL del modelo de IA (TGI)
 tgi_url: str = os.environ.get("TGI_URL", os.environ.get("LM_STUDIO_URL", "https://dbrmcpr7fjvk2cz6.us-east-1.aws.endpoints.huggingface.cloud"))
-print(f"INFO: Backend configurado para conectar con TGI en: {tgi_url}")
+# Réplicas de TGI separadas por comas (TGI_URLS); por defecto solo TGI_URL
+tgi_urls = [u.strip() for u in os.environ.get("TGI_URLS", "").split(",") if u.strip()] or [tgi_url]
+tgi_url = tgi_urls[0]
+tgi_balancer = TGILoadBalancer(
+    tgi_urls,
+    sticky_ttl=float(os.environ.get("TGI_STICKY_TTL", 1800))
+)
+print(f"INFO: Backend configurado para conectar con TGI en: {', '.join(tgi_urls)}")
 
 # Configurar servicio de embeddings externos
 embedding_api_url = os.environ.get("EMBEDDING_API_URL", "https://fs7mn6r3tsu0su7q.us-east-1.aws.endpoints.huggingface.cloud")
 print(f"Configurando servicio de embeddings externos: {embedding_api_url}")
 
+# Clientes HTTP compartidos (pool keep-alive por upstream)
+http_clients = get_http_clients()
+
+# Caché de embeddings (LRU en memoria + SQLite opcional que sobrevive reinicios)
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000)),
+    db_path=os.environ.get("EMBEDDING_CACHE_PATH") or None,
+    namespace=embedding_api_url
+)
+
 try:
-    embedding_service = EmbeddingService(embedding_api_url)
+    embedding_service = EmbeddingService(
+        embedding_api_url, http_clients, embedding_cache,
+        max_batch_size=int(os.environ.get("EMBEDDING_BATCH_SIZE", 32)),
+        coalesce_window_ms=float(os.environ.get("EMBEDDING_COALESCE_MS", 5))
+    )
     print("Servicio de embeddings configurado exitosamente.")
 except Exception as e:
     print(f"Error fatal: no se pudo configurar el servicio de embeddings. {e}")
     exit()
 
+# Índice vectorial en proceso para RAG (requiere numpy; si no, se usa la RPC)
+vector_index = None
+if os.environ.get("RAG_LOCAL_INDEX", "false").lower() == "true":
+    vector_index = LocalVectorIndex(
+        dim=int(os.environ.get("RAG_LOCAL_INDEX_DIM", 1024)),
+        path=os.environ.get("RAG_LOCAL_INDEX_PATH") or None
+    )
+    if not vector_index.disponible:
+        print("⚠️ RAG_LOCAL_INDEX activo pero numpy no está instalado; se usará la RPC")
+        vector_index = None
+
+# Caché semántica de respuestas de TGI (SEMANTIC_CACHE_ENDPOINTS vacío la desactiva)
+response_cache = None
+if os.environ.get("SEMANTIC_CACHE_ENABLED", "true").lower() == "true":
+    response_cache = SemanticResponseCache(
+        threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+        ttl_seconds=float(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", 3600)),
+        max_entries=int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 1000)),
+        endpoints=[e.strip() for e in os.environ.get("SEMANTIC_CACHE_ENDPOINTS", "chat,reportes").split(",") if e.strip()]
+    )
+
 # --- Inicializar Servicios ---
-ia_service = IAService(supabase, embedding_service, tgi_url)
+ia_service = IAService(
+    supabase, embedding_service, tgi_url, http_clients,
+    vector_index=vector_index, response_cache=response_cache,
+    tgi_balancer=tgi_balancer
+)
 paciente_service = PacienteService(supabase)
 estudio_service = EstudioService(supabase)
 reporte_service = ReporteService(supabase, ia_service)
@@ -88,7 +204,15 @@ async def health_check():
             "database": "connected",
             "ai_model": "loaded",
             "embedding_service": "ready"
-        }
+        },
+        "embedding_cache": embedding_cache.get_stats(),
+        "embedding_batching": embedding_service.batcher.get_stats(),
+        "vector_index": vector_index.get_stats() if vector_index is not None else None,
+        "semantic_cache": response_cache.get_stats() if response_cache is not None else None,
+        "report_streaming": ia_service.streaming_stats,
+        "inference_scheduler": ia_service.scheduler.get_stats(),
+        "upstreams": http_clients.get_stats(),
+        "tgi_replicas": tgi_balancer.get_stats()
     }
 
 # ===================================
@@ -184,9 +308,14 @@ async def obtener_estadisticas_reportes():
     return await reporte_service.obtener_estadisticas()
 
 @app.post("/api/v1/reportes/generar", tags=["Reportes"])
-async def generar_reporte_ia(request: ReportGenerationRequest):
+async def generar_reporte_ia(request: ReportGenerationRequest, http_request: Request):
     """Generar reporte médico usando IA con streaming"""
-    return await reporte_service.generar_reporte_ia_streaming(request)
+    return await reporte_service.generar_reporte_ia_streaming(request, http_request)
+
+@app.post("/api/v1/reportes/generar-lote", tags=["Reportes"])
+async def generar_reportes_lote(request: ReportBatchRequest, http_request: Request):
+    """Generar un lote de reportes con IA (resultados por reporte en NDJSON)"""
+    return await reporte_service.generar_reportes_lote(request, http_request)
 
 @app.get("/api/v1/reportes", response_model=PaginatedResponse, tags=["Reportes"])
 async def obtener_reportes(
@@ -241,6 +370,19 @@ async def procesar_mensaje_chat(
     
     return await chat_service.procesar_mensaje_chat(request, user_id)
 
+@app.post("/api/v1/chat/stream", tags=["Chat IA"])
+async def procesar_mensaje_chat_stream(
+    request: ChatRequest,
+    http_request: Request,
+    x_user_id: Optional[str] = Header("usuario_demo", alias="X-User-ID"),
+    x_user_language: Optional[str] = Header("es", alias="X-User-Language")
+):
+    """Procesar mensaje del chat IA devolviendo la respuesta en streaming (SSE)"""
+    user_id = x_user_id or "usuario_demo"
+    request.idioma_usuario = x_user_language or request.idioma_usuario or "es"
+    
+    return await chat_service.procesar_mensaje_chat_streaming(request, user_id, http_request)
+
 @app.post("/api/v1/chat/conversacion", response_model=BaseResponse, tags=["Chat IA"])
 async def crear_conversacion_chat(conversacion_data: ConversacionChatCreate):
     """Crear nueva conversación de chat"""
@@ -256,10 +398,13 @@ async def obtener_conversaciones(
     return await chat_service.obtener_conversaciones(usuario, page, limit)
 
 @app.get("/api/v1/chat/conversaciones/{conversacion_id}/mensajes", tags=["Chat IA"])
-async def obtener_historial_conversacion(conversacion_id: UUID):
-    """Obtener historial de mensajes de una conversación"""
-    historial = await chat_service.obtener_historial_conversacion(conversacion_id)
-    return {"success": True, "data": historial}
+async def obtener_historial_conversacion(
+    conversacion_id: UUID,
+    limit: int = Query(100, ge=1, le=500, description="Mensajes por página (los más recientes primero)"),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior para mensajes más antiguos")
+):
+    """Obtener historial de mensajes de una conversación (paginado por cursor)"""
+    return await chat_service.obtener_historial_conversacion(conversacion_id, limit, cursor)
 
 @app.get("/api/v1/chat/usuarios/{user_id}/sesiones", tags=["Chat IA"])
 async def obtener_sesiones_activas_usuario(user_id: str):
@@ -280,17 +425,79 @@ async def buscar_en_historial(
     query: str = Query(..., description="Consulta de búsqueda"),
     paciente_id: Optional[UUID] = Query(None, description="Filtrar por paciente"),
     limite_resultados: int = Query(5, ge=1, le=20, description="Límite de resultados"),
-    umbral_similitud: float = Query(0.5, ge=0.0, le=1.0, description="Umbral de similitud")
+    umbral_similitud: float = Query(0.5, ge=0.0, le=1.0, description="Umbral de similitud"),
+    modo: ModoBusquedaEnum = Query(ModoBusquedaEnum.VECTORIAL, description="vectorial, lexico (texto completo) o hibrido (fusión RRF)"),
+    ef_search: Optional[int] = Query(None, ge=1, le=1000, description="Candidatos HNSW a explorar (más recall, más latencia)"),
+    probes: Optional[int] = Query(None, ge=1, le=1000, description="Listas ivfflat a explorar (más recall, más latencia)")
 ):
-    """Búsqueda semántica en historial médico usando RAG"""
+    """Búsqueda en historial médico usando RAG (semántica, léxica o híbrida)"""
     request = RAGSearchRequest(
         query=query,
         paciente_id=paciente_id,
         limite_resultados=limite_resultados,
-        umbral_similitud=umbral_similitud
+        umbral_similitud=umbral_similitud,
+        modo=modo,
+        ef_search=ef_search,
+        probes=probes
     )
     return await ia_service.buscar_rag(request)
 
+# ===================================
+# ENDPOINTS - ADMINISTRACIÓN RAG
+# ===================================
+
+# Job de backfill de embeddings en segundo plano (uno a la vez por worker)
+backfill_job: Optional[EmbeddingBackfill] = None
+backfill_task: Optional[asyncio.Task] = None
+
+@app.post("/api/v1/admin/embeddings/backfill", tags=["Administración RAG"])
+async def iniciar_backfill_embeddings(
+    page_size: int = Query(100, ge=1, le=1000, description="Reportes por página"),
+    batch_size: int = Query(32, ge=1, le=256, description="Fragmentos por petición de embeddings"),
+    concurrency: int = Query(4, ge=1, le=32, description="Peticiones de embeddings simultáneas"),
+    rebuild: bool = Query(False, description="Reemplazar embeddings existentes")
+):
+    """Iniciar el backfill reanudable de reporte_embeddings_new"""
+    global backfill_job, backfill_task
+    if backfill_task and not backfill_task.done():
+        return {
+            "success": False,
+            "message": "Ya hay un backfill en ejecución",
+            "data": backfill_job.metrics.to_dict()
+        }
+    
+    backfill_job = EmbeddingBackfill(
+        supabase, db_executor, embedding_service,
+        page_size=page_size, batch_size=batch_size,
+        concurrency=concurrency, rebuild=rebuild,
+        checkpoint_path=os.environ.get("BACKFILL_CHECKPOINT_PATH", "backfill_checkpoint.json")
+    )
+    backfill_task = asyncio.create_task(backfill_job.run())
+    return {
+        "success": True,
+        "message": "Backfill de embeddings iniciado",
+        "data": {"checkpoint": backfill_job.checkpoint.last_id}
+    }
+
+@app.get("/api/v1/admin/embeddings/backfill", tags=["Administración RAG"])
+async def estado_backfill_embeddings():
+    """Consultar progreso y throughput del backfill de embeddings"""
+    if backfill_job is None:
+        return {"success": True, "message": "No se ha ejecutado ningún backfill", "data": None}
+    return {
+        "success": True,
+        "message": "Estado del backfill",
+        "data": {
+            "metricas": backfill_job.metrics.to_dict(),
+            "checkpoint": backfill_job.checkpoint.__dict__
+        }
+    }
+
+@app.get("/api/v1/admin/embeddings/index", response_model=BaseResponse, tags=["Administración RAG"])
+async def obtener_indice_embeddings():
+    """Consultar definición y tamaño de los índices de embeddings"""
+    return await ia_service.obtener_indice_embeddings()
+
 # ===================================
 # ENDPOINTS - ANÁLISIS DICOM
 # ===================================
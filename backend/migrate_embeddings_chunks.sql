@@ -0,0 +1,121 @@
+-- Migración: fragmentos por sección en reporte_embeddings_new
+-- Ejecutar después de migrate_embeddings_hnsw.sql
+
+-- ===================================
+-- 1. METADATOS DEL FRAGMENTO
+-- ===================================
+
+-- Sección del reporte (TÉCNICA, HALLAZGOS, ...) y posición del fragmento
+-- dentro del texto original: reporte[chunk_inicio:chunk_fin] = contenido
+ALTER TABLE reporte_embeddings_new ADD COLUMN IF NOT EXISTS seccion TEXT;
+ALTER TABLE reporte_embeddings_new ADD COLUMN IF NOT EXISTS chunk_inicio INTEGER;
+ALTER TABLE reporte_embeddings_new ADD COLUMN IF NOT EXISTS chunk_fin INTEGER;
+
+-- ===================================
+-- 2. FUNCIÓN DE BÚSQUEDA CON METADATOS DEL FRAGMENTO
+-- ===================================
+
+-- El tipo de retorno cambia, por lo que hay que eliminar la versión anterior
+DROP FUNCTION IF EXISTS match_report_embeddings_1024(vector(1024), float, int, uuid, int, int);
+
+CREATE OR REPLACE FUNCTION match_report_embeddings_1024(
+    query_embedding vector(1024),
+    match_threshold float DEFAULT 0.5,
+    match_count int DEFAULT 5,
+    paciente_filter uuid DEFAULT NULL,
+    ef_search int DEFAULT NULL,
+    probes int DEFAULT NULL
+)
+RETURNS TABLE (
+    id uuid,
+    reporte_id uuid,
+    paciente_id uuid,
+    contenido text,
+    seccion text,
+    chunk_inicio int,
+    chunk_fin int,
+    similarity float
+)
+LANGUAGE plpgsql VOLATILE
+AS $$
+BEGIN
+    IF ef_search IS NOT NULL THEN
+        PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+    END IF;
+    IF probes IS NOT NULL THEN
+        PERFORM set_config('ivfflat.probes', probes::text, true);
+    END IF;
+
+    -- Con filtro por paciente la búsqueda es exacta sobre sus fragmentos: con
+    -- el índice ANN el filtro se aplicaría después de elegir los ef_search
+    -- candidatos del grafo y podría devolver pocas filas o ninguna. El CTE
+    -- MATERIALIZED impide usar el índice ANN para el ORDER BY (el paciente
+    -- se resuelve con idx_reporte_embeddings_new_paciente_id).
+    IF paciente_filter IS NOT NULL THEN
+        RETURN QUERY
+        WITH fragmentos AS MATERIALIZED (
+            SELECT
+                re.id,
+                re.reporte_id,
+                re.paciente_id,
+                re.contenido,
+                re.seccion,
+                re.chunk_inicio,
+                re.chunk_fin,
+                re.embedding <=> query_embedding AS distancia
+            FROM reporte_embeddings_new re
+            WHERE re.paciente_id = paciente_filter
+        )
+        SELECT
+            fragmentos.id,
+            fragmentos.reporte_id,
+            fragmentos.paciente_id,
+            fragmentos.contenido,
+            fragmentos.seccion,
+            fragmentos.chunk_inicio,
+            fragmentos.chunk_fin,
+            1 - fragmentos.distancia AS similarity
+        FROM fragmentos
+        WHERE 1 - fragmentos.distancia > match_threshold
+        ORDER BY fragmentos.distancia
+        LIMIT match_count;
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+    SELECT
+        candidatos.id,
+        candidatos.reporte_id,
+        candidatos.paciente_id,
+        candidatos.contenido,
+        candidatos.seccion,
+        candidatos.chunk_inicio,
+        candidatos.chunk_fin,
+        1 - candidatos.distancia AS similarity
+    FROM (
+        SELECT
+            re.id,
+            re.reporte_id,
+            re.paciente_id,
+            re.contenido,
+            re.seccion,
+            re.chunk_inicio,
+            re.chunk_fin,
+            re.embedding <=> query_embedding AS distancia
+        FROM reporte_embeddings_new re
+        ORDER BY re.embedding <=> query_embedding
+        LIMIT match_count
+    ) candidatos
+    WHERE 1 - candidatos.distancia > match_threshold
+    ORDER BY candidatos.distancia;
+END;
+$$;
+
+COMMENT ON FUNCTION match_report_embeddings_1024 IS 'Búsqueda semántica (1024 dims) por fragmento de sección; compatible con índice HNSW/ivfflat';
+
+-- ===================================
+-- 3. RE-INDEXAR REPORTES EXISTENTES
+-- ===================================
+
+-- Los embeddings previos representan el reporte completo. Para fragmentarlos:
+--   python backfill_embeddings.py --rebuild --reset
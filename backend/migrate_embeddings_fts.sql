@@ -0,0 +1,62 @@
+-- Migración: búsqueda de texto completo sobre reporte_embeddings_new
+-- Complementa la búsqueda vectorial en modo 'lexico' / 'hibrido'
+-- Ejecutar después de migrate_embeddings_chunks.sql
+
+-- ===================================
+-- 1. COLUMNA TSVECTOR E ÍNDICE GIN
+-- ===================================
+
+-- 'spanish' aplica stemming al texto clínico; 'simple' conserva literales
+-- como códigos (J18.9), nombres de fármacos y números de estudio
+ALTER TABLE reporte_embeddings_new
+    ADD COLUMN IF NOT EXISTS contenido_tsv tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('spanish', contenido) || to_tsvector('simple', contenido)
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_reporte_embeddings_new_contenido_tsv
+    ON reporte_embeddings_new USING gin (contenido_tsv);
+
+-- ===================================
+-- 2. FUNCIÓN DE BÚSQUEDA LÉXICA
+-- ===================================
+
+CREATE OR REPLACE FUNCTION search_report_embeddings_text(
+    query_text text,
+    match_count int DEFAULT 5,
+    paciente_filter uuid DEFAULT NULL
+)
+RETURNS TABLE (
+    id uuid,
+    reporte_id uuid,
+    paciente_id uuid,
+    contenido text,
+    seccion text,
+    chunk_inicio int,
+    chunk_fin int,
+    rank float
+)
+LANGUAGE sql STABLE
+AS $$
+    WITH q AS (
+        SELECT websearch_to_tsquery('spanish', query_text)
+            || websearch_to_tsquery('simple', query_text) AS consulta
+    )
+    SELECT
+        re.id,
+        re.reporte_id,
+        re.paciente_id,
+        re.contenido,
+        re.seccion,
+        re.chunk_inicio,
+        re.chunk_fin,
+        -- Normalización 32: rank / (rank + 1), en el rango [0, 1)
+        ts_rank_cd(re.contenido_tsv, q.consulta, 32)::float AS rank
+    FROM reporte_embeddings_new re, q
+    WHERE re.contenido_tsv @@ q.consulta
+      AND (paciente_filter IS NULL OR re.paciente_id = paciente_filter)
+    ORDER BY rank DESC
+    LIMIT match_count;
+$$;
+
+COMMENT ON FUNCTION search_report_embeddings_text IS 'Búsqueda de texto completo (español + literal) sobre fragmentos de reportes para RAG híbrido';
@@ -0,0 +1,137 @@
+-- Migración: índice ANN (HNSW / ivfflat) para reporte_embeddings_new
+-- Requiere pgvector >= 0.5.0 (HNSW). Ejecutar después de migrate_embeddings_1024.sql
+
+-- ===================================
+-- 1. ÍNDICE HNSW POR DISTANCIA COSENO
+-- ===================================
+
+-- Aumentar memoria de mantenimiento acelera la construcción del grafo
+SET maintenance_work_mem = '512MB';
+
+CREATE INDEX IF NOT EXISTS idx_reporte_embeddings_new_embedding
+    ON reporte_embeddings_new
+    USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+
+RESET maintenance_work_mem;
+
+-- ===================================
+-- 2. FUNCIÓN DE BÚSQUEDA COMPATIBLE CON EL ÍNDICE
+-- ===================================
+
+-- La versión anterior filtraba con `1 - (embedding <=> q) > threshold` en el
+-- WHERE, lo que impide usar el índice. Ahora la consulta interna solo ordena
+-- por distancia con LIMIT (index scan) y el umbral se aplica afuera.
+DROP FUNCTION IF EXISTS match_report_embeddings_1024(vector(1024), float, int);
+
+CREATE OR REPLACE FUNCTION match_report_embeddings_1024(
+    query_embedding vector(1024),
+    match_threshold float DEFAULT 0.5,
+    match_count int DEFAULT 5,
+    paciente_filter uuid DEFAULT NULL,
+    ef_search int DEFAULT NULL,
+    probes int DEFAULT NULL
+)
+RETURNS TABLE (
+    id uuid,
+    reporte_id uuid,
+    paciente_id uuid,
+    contenido text,
+    similarity float
+)
+LANGUAGE plpgsql VOLATILE
+AS $$
+BEGIN
+    -- Parámetros de búsqueda solo para esta transacción
+    IF ef_search IS NOT NULL THEN
+        PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+    END IF;
+    IF probes IS NOT NULL THEN
+        PERFORM set_config('ivfflat.probes', probes::text, true);
+    END IF;
+
+    -- Con filtro por paciente la búsqueda es exacta sobre sus fragmentos: con
+    -- el índice ANN el filtro se aplicaría después de elegir los ef_search
+    -- candidatos del grafo y podría devolver pocas filas o ninguna. El CTE
+    -- MATERIALIZED impide usar el índice ANN para el ORDER BY (el paciente
+    -- se resuelve con idx_reporte_embeddings_new_paciente_id).
+    IF paciente_filter IS NOT NULL THEN
+        RETURN QUERY
+        WITH fragmentos AS MATERIALIZED (
+            SELECT
+                re.id,
+                re.reporte_id,
+                re.paciente_id,
+                re.contenido,
+                re.embedding <=> query_embedding AS distancia
+            FROM reporte_embeddings_new re
+            WHERE re.paciente_id = paciente_filter
+        )
+        SELECT
+            fragmentos.id,
+            fragmentos.reporte_id,
+            fragmentos.paciente_id,
+            fragmentos.contenido,
+            1 - fragmentos.distancia AS similarity
+        FROM fragmentos
+        WHERE 1 - fragmentos.distancia > match_threshold
+        ORDER BY fragmentos.distancia
+        LIMIT match_count;
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+    SELECT
+        candidatos.id,
+        candidatos.reporte_id,
+        candidatos.paciente_id,
+        candidatos.contenido,
+        1 - candidatos.distancia AS similarity
+    FROM (
+        SELECT
+            re.id,
+            re.reporte_id,
+            re.paciente_id,
+            re.contenido,
+            re.embedding <=> query_embedding AS distancia
+        FROM reporte_embeddings_new re
+        ORDER BY re.embedding <=> query_embedding
+        LIMIT match_count
+    ) candidatos
+    WHERE 1 - candidatos.distancia > match_threshold
+    ORDER BY candidatos.distancia;
+END;
+$$;
+
+COMMENT ON FUNCTION match_report_embeddings_1024 IS 'Búsqueda semántica (1024 dims) compatible con índice HNSW/ivfflat; ef_search/probes opcionales por consulta';
+
+-- ===================================
+-- 3. ADMINISTRACIÓN DEL ÍNDICE
+-- ===================================
+
+-- La reconstrucción del índice no se expone como RPC: DROP + CREATE INDEX
+-- dentro de una función bloquea la tabla (ACCESS EXCLUSIVE) durante toda la
+-- construcción y el statement_timeout de PostgREST la corta. Se hace con
+-- reindex_embeddings_ann.sql (CREATE INDEX CONCURRENTLY) desde psql.
+DROP FUNCTION IF EXISTS rebuild_report_embeddings_index(text, int, int, int);
+
+-- Estado de los índices de la tabla de embeddings
+CREATE OR REPLACE FUNCTION report_embeddings_index_info()
+RETURNS TABLE (
+    indice text,
+    definicion text,
+    tamano text,
+    filas bigint
+)
+LANGUAGE sql STABLE
+AS $$
+    SELECT
+        i.indexname::text,
+        i.indexdef::text,
+        pg_size_pretty(pg_relation_size(format('%I.%I', i.schemaname, i.indexname)::regclass)),
+        (SELECT count(*) FROM reporte_embeddings_new)
+    FROM pg_indexes i
+    WHERE i.tablename = 'reporte_embeddings_new';
+$$;
+
+COMMENT ON FUNCTION report_embeddings_index_info IS 'Definición y tamaño de los índices de reporte_embeddings_new (usado por GET /api/v1/admin/embeddings/index)';
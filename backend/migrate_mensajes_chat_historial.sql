@@ -0,0 +1,7 @@
+-- Migración: índice para cargar el final del historial del chat
+-- El contexto y el API de historial leen los mensajes más recientes de una
+-- conversación (ORDER BY timestamp_mensaje DESC LIMIT n) y paginan hacia
+-- atrás por cursor; este índice resuelve ambas lecturas sin ordenar en memoria
+
+CREATE INDEX IF NOT EXISTS idx_chat_conversacion_timestamp
+    ON mensajes_chat(conversacion_id, timestamp_mensaje DESC);
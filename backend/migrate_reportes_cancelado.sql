@@ -0,0 +1,8 @@
+-- Migración: estado 'Cancelado' para reportes
+-- Generaciones en streaming abandonadas por el cliente se guardan con el
+-- texto parcial y estado 'Cancelado' si la solicitud lo pide con
+-- guardar_parcial (no se indexan para RAG)
+
+ALTER TABLE reportes DROP CONSTRAINT IF EXISTS reportes_estado_check;
+ALTER TABLE reportes ADD CONSTRAINT reportes_estado_check
+    CHECK (estado IN ('Borrador', 'Pendiente Revisión', 'Firmado', 'Cancelado'));
@@ -42,6 +42,7 @@ class EstadoReporteEnum(str, Enum):
     BORRADOR = "Borrador"
     PENDIENTE_REVISION = "Pendiente Revisión"
     FIRMADO = "Firmado"
+    CANCELADO = "Cancelado"
 
 class EspecialidadEnum(str, Enum):
     GENERAL = "General"
@@ -56,6 +57,11 @@ class RolChatEnum(str, Enum):
     ASSISTANT = "assistant"
     SYSTEM = "system"
 
+class ModoBusquedaEnum(str, Enum):
+    VECTORIAL = "vectorial"
+    LEXICO = "lexico"
+    HIBRIDO = "hibrido"
+
 # ===================================
 # MODELOS BASE
 # ===================================
@@ -288,6 +294,7 @@ class ChatRequest(BaseModel):
     archivos_adjuntos: List[str] = Field(default_factory=list)
     contexto_adicional: Optional[str] = None
     idioma_usuario: Optional[str] = Field("es", description="Idioma del usuario (es, en, fr, etc.)")
+    usar_cache: bool = Field(True, description="Permitir respuesta desde la caché semántica")
 
 class ChatResponse(BaseModel):
     respuesta: str
@@ -295,6 +302,7 @@ class ChatResponse(BaseModel):
     confianza: Optional[float] = None
     tiempo_respuesta: Optional[float] = None
     modelo_usado: Optional[str] = None
+    tokens_prompt: Optional[int] = None
 
 # ===================================
 # MODELOS DE IA Y RAG
@@ -336,12 +344,23 @@ class ReportGenerationRequest(BaseModel):
     radiologo: str = Field(..., min_length=1, max_length=100)
     incluir_contexto_rag: bool = True
     temperatura: float = Field(0.3, ge=0.0, le=1.0)
+    prioridad: PrioridadEnum = Field(PrioridadEnum.NORMAL, description="Prioridad en la cola de inferencia")
+    usar_cache: bool = Field(True, description="Permitir reutilizar el reporte de una solicitud idéntica")
+    guardar_parcial: bool = Field(False, description="En streaming, guardar el texto parcial como 'Cancelado' si el cliente se desconecta")
+
+class ReportBatchRequest(BaseModel):
+    reportes: List[ReportGenerationRequest] = Field(..., min_length=1, max_length=500)
+    concurrencia: int = Field(4, ge=1, le=32, description="Reportes generados simultáneamente")
+    tamano_insercion: int = Field(20, ge=1, le=200, description="Reportes por inserción en bloque")
 
 class RAGSearchRequest(BaseModel):
     query: str = Field(..., min_length=1)
     paciente_id: Optional[UUID] = None
     limite_resultados: int = Field(5, ge=1, le=20)
     umbral_similitud: float = Field(0.5, ge=0.0, le=1.0)
+    ef_search: Optional[int] = Field(None, ge=1, le=1000, description="Candidatos HNSW a explorar (hnsw.ef_search)")
+    probes: Optional[int] = Field(None, ge=1, le=1000, description="Listas ivfflat a explorar (ivfflat.probes)")
+    modo: ModoBusquedaEnum = Field(ModoBusquedaEnum.VECTORIAL, description="vectorial, lexico (texto completo) o hibrido (fusión RRF)")
 
 class RAGSearchResult(BaseModel):
     id: UUID
@@ -349,6 +368,9 @@ class RAGSearchResult(BaseModel):
     paciente_id: UUID
     contenido: str
     similitud: float
+    seccion: Optional[str] = None
+    chunk_inicio: Optional[int] = None
+    chunk_fin: Optional[int] = None
 
 # ===================================
 # MODELOS DE ESTADÍSTICAS
@@ -0,0 +1,64 @@
+-- Reconstrucción del índice ANN de reporte_embeddings_new sin bloquear la tabla
+-- Requiere migrate_embeddings_hnsw.sql. CREATE INDEX CONCURRENTLY no puede
+-- ejecutarse dentro de una transacción ni de una función: usar psql directo
+-- contra la base de datos (no el editor SQL ni la API):
+--
+--   psql "$DATABASE_URL" -f reindex_embeddings_ann.sql
+--   psql "$DATABASE_URL" -v metodo=hnsw -v parametros='m = 24, ef_construction = 128' -f reindex_embeddings_ann.sql
+--   psql "$DATABASE_URL" -v metodo=ivfflat -v parametros='lists = 100' -f reindex_embeddings_ann.sql
+--
+-- El índice nuevo se construye con otro nombre mientras las búsquedas siguen
+-- usando el actual; después se intercambian los nombres (bloqueo breve) y el
+-- índice anterior se elimina también de forma concurrente.
+
+\set ON_ERROR_STOP on
+
+\if :{?metodo}
+\else
+    \set metodo hnsw
+\endif
+\if :{?parametros}
+\else
+    \set parametros 'm = 16, ef_construction = 64'
+\endif
+
+SET maintenance_work_mem = '512MB';
+SET statement_timeout = 0;
+
+-- Restos de una ejecución anterior interrumpida (un índice CONCURRENTLY fallido queda INVALID)
+DROP INDEX CONCURRENTLY IF EXISTS idx_reporte_embeddings_new_embedding_nuevo;
+DROP INDEX CONCURRENTLY IF EXISTS idx_reporte_embeddings_new_embedding_anterior;
+
+-- ===================================
+-- 1. CONSTRUIR EL ÍNDICE NUEVO
+-- ===================================
+
+CREATE INDEX CONCURRENTLY idx_reporte_embeddings_new_embedding_nuevo
+    ON reporte_embeddings_new
+    USING :metodo (embedding vector_cosine_ops)
+    WITH (:parametros);
+
+-- ===================================
+-- 2. INTERCAMBIAR NOMBRES
+-- ===================================
+
+BEGIN;
+ALTER INDEX IF EXISTS idx_reporte_embeddings_new_embedding
+    RENAME TO idx_reporte_embeddings_new_embedding_anterior;
+ALTER INDEX idx_reporte_embeddings_new_embedding_nuevo
+    RENAME TO idx_reporte_embeddings_new_embedding;
+COMMIT;
+
+-- ===================================
+-- 3. ELIMINAR EL ÍNDICE ANTERIOR
+-- ===================================
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_reporte_embeddings_new_embedding_anterior;
+
+ANALYZE reporte_embeddings_new;
+
+RESET statement_timeout;
+RESET maintenance_work_mem;
+
+-- Verificar: GET /api/v1/admin/embeddings/index o
+SELECT * FROM report_embeddings_index_info();
@@ -0,0 +1,373 @@
+# resilience.py - Radix IA
+"""
+Resiliencia para las llamadas a upstreams HTTP (TGI y embeddings).
+
+- Reintentos con backoff exponencial y jitter completo ante errores
+  transitorios (conexión, 429, 5xx de arranque en frío). Solo para
+  llamadas idempotentes: una generación o un embedding no tienen efectos
+  secundarios y pueden repetirse.
+- Peticiones de cobertura (hedging) opcionales: si la respuesta tarda más
+  que el percentil configurado de la latencia reciente se lanza una
+  segunda petición y se usa la primera que responda.
+- Circuit breaker: tras N fallos consecutivos las llamadas fallan de
+  inmediato durante `recovery_timeout` segundos; después se permite una
+  llamada de prueba (semiabierto) que cierra o vuelve a abrir el circuito.
+  Con varias réplicas (TGILoadBalancer) hay un circuito por réplica y cada
+  intento elige réplica de nuevo.
+"""
+
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+import httpx
+
+from load_balancer import TGILoadBalancer
+
+# Respuestas que indican un fallo transitorio del upstream
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+# Respuestas que además cuentan como fallo de la réplica (salud pasiva)
+ESTADOS_FALLO_REPLICA = ESTADOS_REINTENTABLES - {429}
+
+# Errores de transporte que se reintentan. ReadTimeout no se incluye: la
+# petición ya consumió el timeout completo y repetirla solo alarga la cola
+ERRORES_REINTENTABLES = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.PoolTimeout,
+    httpx.ReadError,
+    httpx.RemoteProtocolError,
+)
+
+
+class CircuitoAbiertoError(Exception):
+    """El circuit breaker del upstream está abierto: se falla sin llamar"""
+
+
+@dataclass
+class ResilienceConfig:
+    """Política de reintentos, cobertura y circuit breaker de un upstream"""
+    max_intentos: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    hedge_percentile: Optional[float] = None
+    hedge_min_samples: int = 20
+    failure_threshold: int = 5
+    recovery_timeout: float = 30.0
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults) -> "ResilienceConfig":
+        """Construir configuración leyendo variables <PREFIX>_RETRY_*, _HEDGE_*, _BREAKER_*"""
+        config = cls(**defaults)
+
+        def _env(name: str, cast, current):
+            value = os.environ.get(f"{prefix}_{name}")
+            return cast(value) if value not in (None, "") else current
+
+        config.max_intentos = _env("RETRY_ATTEMPTS", int, config.max_intentos)
+        config.base_delay = _env("RETRY_BASE_DELAY", float, config.base_delay)
+        config.max_delay = _env("RETRY_MAX_DELAY", float, config.max_delay)
+        config.hedge_percentile = _env("HEDGE_PERCENTILE", float, config.hedge_percentile)
+        config.failure_threshold = _env("BREAKER_THRESHOLD", int, config.failure_threshold)
+        config.recovery_timeout = _env("BREAKER_RECOVERY", float, config.recovery_timeout)
+        return config
+
+    def espera(self, intento: int, retry_after: Optional[str] = None) -> float:
+        """Segundos antes del siguiente intento (jitter completo, respeta Retry-After)"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** intento)))
+
+
+class CircuitBreaker:
+    """Circuit breaker por fallos consecutivos (cerrado / abierto / semiabierto)"""
+
+    CERRADO = "closed"
+    ABIERTO = "open"
+    SEMIABIERTO = "half_open"
+
+    def __init__(self, nombre: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.nombre = nombre
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._estado = self.CERRADO
+        self._fallos = 0
+        self._abierto_desde = 0.0
+        self._prueba_desde: Optional[float] = None
+        self.aperturas = 0
+        self.rechazos = 0
+
+    @property
+    def estado(self) -> str:
+        if self._estado == self.ABIERTO and time.monotonic() - self._abierto_desde >= self.recovery_timeout:
+            self._estado = self.SEMIABIERTO
+            self._prueba_desde = None
+        return self._estado
+
+    def permitir(self) -> None:
+        """Lanzar CircuitoAbiertoError si la llamada no debe hacerse"""
+        estado = self.estado
+        if estado == self.CERRADO:
+            return
+        ahora = time.monotonic()
+        # En semiabierto pasa una sola llamada de prueba (o una nueva si la anterior se perdió)
+        if estado == self.SEMIABIERTO and (
+            self._prueba_desde is None or ahora - self._prueba_desde >= self.recovery_timeout
+        ):
+            self._prueba_desde = ahora
+            return
+        self.rechazos += 1
+        raise CircuitoAbiertoError(
+            f"Servicio {self.nombre} no disponible temporalmente (circuito abierto)"
+        )
+
+    def registrar_exito(self) -> None:
+        self._fallos = 0
+        self._estado = self.CERRADO
+        self._prueba_desde = None
+
+    def registrar_fallo(self) -> None:
+        self._fallos += 1
+        if self._estado == self.SEMIABIERTO or self._fallos >= self.failure_threshold:
+            if self._estado != self.ABIERTO:
+                self.aperturas += 1
+                print(f"⚠️ Circuito abierto para {self.nombre} tras {self._fallos} fallos")
+            self._estado = self.ABIERTO
+            self._abierto_desde = time.monotonic()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.estado,
+            "consecutive_failures": self._fallos,
+            "opened": self.aperturas,
+            "rejected": self.rechazos
+        }
+
+
+class ResilientUpstream:
+    """Llamadas a un upstream con reintentos, cobertura y circuit breaker
+
+    Con `balancer` la URL es una ruta relativa y cada intento (y cada
+    cobertura) elige su réplica: un reintento tras un fallo va a otra réplica
+    sana y cada réplica tiene su propio circuit breaker.
+    """
+
+    def __init__(self, nombre: str, client_factory: Callable[[], httpx.AsyncClient],
+                 config: Optional[ResilienceConfig] = None):
+        self.nombre = nombre
+        self.config = config or ResilienceConfig()
+        # Se resuelve en cada llamada: el cliente puede recrearse tras un cierre
+        self._client_factory = client_factory
+        self.breaker = CircuitBreaker(
+            nombre, self.config.failure_threshold, self.config.recovery_timeout
+        )
+        # Circuit breakers por réplica (llamadas con balancer)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencias: Deque[float] = deque(maxlen=200)
+        self.reintentos = 0
+        self.coberturas = 0
+
+    def breaker_de(self, replica: Optional[str]) -> CircuitBreaker:
+        """Circuit breaker de una réplica (el del upstream si no hay balancer)"""
+        if replica is None:
+            return self.breaker
+        breaker = self._breakers.get(replica)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                f"{self.nombre} ({replica})", self.config.failure_threshold, self.config.recovery_timeout
+            )
+            self._breakers[replica] = breaker
+        return breaker
+
+    @asynccontextmanager
+    async def _destino(self, url: str, balancer: Optional[TGILoadBalancer],
+                       clave: Optional[str], evitar: Set[str]) -> AsyncIterator[Tuple[str, CircuitBreaker]]:
+        """URL completa y circuit breaker para un intento
+
+        La réplica elegida se añade a `evitar` para que el siguiente intento o
+        la cobertura prefieran otra; las réplicas con el circuito abierto se
+        excluyen mientras quede alguna disponible.
+        """
+        if balancer is None:
+            self.breaker.permitir()
+            yield url, self.breaker
+            return
+
+        abiertas = {r for r, b in self._breakers.items() if b.estado == CircuitBreaker.ABIERTO}
+        async with balancer.usar(clave, excluir=evitar | abiertas) as replica:
+            evitar.add(replica)
+            breaker = self.breaker_de(replica)
+            breaker.permitir()
+            yield f"{replica}{url}", breaker
+
+    async def post(self, url: str, balancer: Optional[TGILoadBalancer] = None,
+                   clave: Optional[str] = None, **kwargs) -> httpx.Response:
+        """POST idempotente; devuelve la última respuesta aunque sea de error
+
+        Con `balancer`, `url` es la ruta dentro de la réplica y `clave` su afinidad.
+        """
+        evitar: Set[str] = set()
+
+        async def llamada() -> httpx.Response:
+            try:
+                async with self._destino(url, balancer, clave, evitar) as (destino, breaker):
+                    try:
+                        response = await self._client_factory().post(destino, **kwargs)
+                    except httpx.TransportError:
+                        breaker.registrar_fallo()
+                        raise
+                    _registrar_respuesta(breaker, response)
+                    if response.status_code in ESTADOS_FALLO_REPLICA:
+                        # Dentro del bloque para que el balanceador cuente el 5xx
+                        raise httpx.HTTPStatusError(
+                            f"Error {response.status_code} de {self.nombre}", request=None, response=response
+                        )
+                    return response
+            except httpx.HTTPStatusError as e:
+                return e.response
+
+        return await self._ejecutar(llamada)
+
+    async def _ejecutar(self, llamada: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        ultimo = self.config.max_intentos - 1
+        for intento in range(self.config.max_intentos):
+            inicio = time.perf_counter()
+            retry_after = None
+            try:
+                response = await self._con_cobertura(llamada)
+            except httpx.TransportError as e:
+                if intento == ultimo or not isinstance(e, ERRORES_REINTENTABLES):
+                    raise
+            else:
+                if response.status_code not in ESTADOS_REINTENTABLES:
+                    self._latencias.append(time.perf_counter() - inicio)
+                    return response
+                if intento == ultimo:
+                    return response
+                retry_after = response.headers.get("retry-after")
+
+            self.reintentos += 1
+            await asyncio.sleep(self.config.espera(intento, retry_after))
+        raise RuntimeError("max_intentos debe ser al menos 1")
+
+    def _retraso_cobertura(self) -> Optional[float]:
+        """Latencia (percentil configurado) tras la que se lanza la cobertura"""
+        if self.config.hedge_percentile is None or len(self._latencias) < self.config.hedge_min_samples:
+            return None
+        latencias = sorted(self._latencias)
+        indice = min(int(len(latencias) * self.config.hedge_percentile / 100), len(latencias) - 1)
+        return latencias[indice]
+
+    async def _con_cobertura(self, llamada: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        retraso = self._retraso_cobertura()
+        if retraso is None:
+            return await llamada()
+
+        primera = asyncio.ensure_future(llamada())
+        hecho, _ = await asyncio.wait({primera}, timeout=retraso)
+        if hecho:
+            return primera.result()
+
+        self.coberturas += 1
+        pendientes = {primera, asyncio.ensure_future(llamada())}
+        try:
+            while True:
+                hecho, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+                # Usar la primera respuesta válida; si ambas fallan, la última
+                validas = [
+                    tarea for tarea in hecho
+                    if tarea.exception() is None and tarea.result().status_code not in ESTADOS_REINTENTABLES
+                ]
+                if validas:
+                    return validas[0].result()
+                if not pendientes:
+                    return next(iter(hecho)).result()
+        finally:
+            for tarea in pendientes:
+                tarea.cancel()
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, balancer: Optional[TGILoadBalancer] = None,
+                     clave: Optional[str] = None, **kwargs) -> AsyncIterator[httpx.Response]:
+        """Stream con reintentos solo hasta recibir la cabecera de la respuesta
+
+        Una vez entregado el primer byte al cliente el stream no se repite.
+        Con `balancer`, cada intento elige réplica como en `post`.
+        """
+        ultimo = self.config.max_intentos - 1
+        evitar: Set[str] = set()
+        for intento in range(self.config.max_intentos):
+            stack = AsyncExitStack()
+            try:
+                destino, breaker = await stack.enter_async_context(
+                    self._destino(url, balancer, clave, evitar)
+                )
+                try:
+                    response = await stack.enter_async_context(
+                        self._client_factory().stream(method, destino, **kwargs)
+                    )
+                except httpx.TransportError:
+                    breaker.registrar_fallo()
+                    raise
+                _registrar_respuesta(breaker, response)
+                if response.status_code in ESTADOS_REINTENTABLES and intento < ultimo:
+                    # Dentro del bloque de la réplica para que cuente el 5xx
+                    if response.status_code in ESTADOS_FALLO_REPLICA:
+                        raise httpx.HTTPStatusError(
+                            f"Error {response.status_code} de {self.nombre}", request=None, response=response
+                        )
+                    await stack.aclose()
+                    self.reintentos += 1
+                    await asyncio.sleep(self.config.espera(intento, response.headers.get("retry-after")))
+                    continue
+            except httpx.HTTPStatusError as e:
+                await stack.__aexit__(type(e), e, e.__traceback__)
+                self.reintentos += 1
+                await asyncio.sleep(self.config.espera(intento, e.response.headers.get("retry-after")))
+                continue
+            except httpx.TransportError as e:
+                await stack.__aexit__(type(e), e, e.__traceback__)
+                if intento == ultimo or not isinstance(e, ERRORES_REINTENTABLES):
+                    raise
+                self.reintentos += 1
+                await asyncio.sleep(self.config.espera(intento))
+                continue
+            except BaseException:
+                await stack.aclose()
+                raise
+
+            async with stack:
+                yield response
+            return
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de resiliencia del upstream"""
+        latencias = sorted(self._latencias)
+        p95 = latencias[min(int(len(latencias) * 0.95), len(latencias) - 1)] if latencias else 0.0
+        stats = {
+            "circuit_breaker": self.breaker.get_stats(),
+            "retries": self.reintentos,
+            "hedged_requests": self.coberturas,
+            "hedge_percentile": self.config.hedge_percentile,
+            "p95_latency_ms": round(p95 * 1000, 2)
+        }
+        if self._breakers:
+            stats["replica_circuit_breakers"] = {r: b.get_stats() for r, b in self._breakers.items()}
+        return stats
+
+
+def _registrar_respuesta(breaker: CircuitBreaker, response: httpx.Response) -> None:
+    """Actualizar el circuit breaker según el estado HTTP de la respuesta"""
+    if response.status_code in ESTADOS_REINTENTABLES:
+        breaker.registrar_fallo()
+    else:
+        breaker.registrar_exito()
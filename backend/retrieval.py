@@ -0,0 +1,30 @@
+# retrieval.py - Radix IA
+"""
+Fusión de resultados de búsqueda para la recuperación híbrida (RAG).
+
+Reciprocal Rank Fusion (RRF): cada documento suma 1 / (k + posición) por
+cada lista en la que aparece. Solo usa posiciones, por lo que combina
+puntajes no comparables (similitud coseno vs. rango de texto completo).
+"""
+
+from typing import Any, Callable, Dict, List, Sequence, TypeVar
+
+T = TypeVar("T")
+
+RRF_K = 60
+
+
+def fusion_rrf(listas: Sequence[Sequence[T]], limite: int, k: int = RRF_K,
+               clave: Callable[[T], Any] = lambda r: r.id) -> List[T]:
+    """Fusionar listas ordenadas por relevancia y devolver las `limite` mejores"""
+    puntajes: Dict[Any, float] = {}
+    elementos: Dict[Any, T] = {}
+    for lista in listas:
+        for posicion, elemento in enumerate(lista, 1):
+            id_ = clave(elemento)
+            puntajes[id_] = puntajes.get(id_, 0.0) + 1.0 / (k + posicion)
+            # Conservar la primera aparición (la lista vectorial va primero)
+            elementos.setdefault(id_, elemento)
+
+    ordenados = sorted(puntajes, key=puntajes.get, reverse=True)
+    return [elementos[id_] for id_ in ordenados[:limite]]
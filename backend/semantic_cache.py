@@ -0,0 +1,210 @@
+# semantic_cache.py - Radix IA
+"""
+Caché semántica de respuestas del modelo (TGI).
+
+Guarda completions por endpoint + espacio de nombres (p. ej. especialidad
+e idioma) junto al embedding normalizado del prompt. Una consulta nueva
+reutiliza la respuesta si su similitud coseno con una entrada vigente
+supera el umbral. Las entradas expiran por TTL y se expulsan por LRU.
+
+La similitud solo se usa para el chat. Textos clínicos casi idénticos
+("derecho/izquierdo", "con/sin fiebre") superan con facilidad el umbral, así
+que los reportes se guardan por huella exacta (`buscar_exacta`): hash del
+prompt normalizado y de todos los parámetros de generación.
+
+Con NumPy (opcional) la similitud contra las entradas de un espacio de
+nombres es un único producto matriz-vector; sin él se calcula en Python.
+"""
+
+import math
+import time
+import json
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from itertools import count
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depende del entorno
+    np = None
+
+# Sufijo de `modelo_usado` para respuestas servidas desde la caché
+MARCA_CACHE = "cache-semantica"
+
+
+@dataclass
+class _Entrada:
+    clave: str
+    vector: Any  # embedding normalizado (ndarray o tupla); None en entradas exactas
+    respuesta: str
+    expira: float
+
+
+def _normalizar(embedding: Sequence[float]) -> Any:
+    if np is not None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norma = float(np.linalg.norm(vector)) or 1.0
+        return vector / norma
+    norma = math.sqrt(sum(x * x for x in embedding)) or 1.0
+    return tuple(x / norma for x in embedding)
+
+
+def huella(solicitud: Any) -> str:
+    """Hash estable de una solicitud (prompt y parámetros) serializable a JSON"""
+    data = json.dumps(solicitud, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class SemanticResponseCache:
+    """Caché de respuestas por similitud de embeddings con TTL y tamaño máximo"""
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: float = 3600,
+                 max_entries: int = 1000,
+                 endpoints: Iterable[str] = ("chat", "reportes")):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.endpoints = set(endpoints)
+        self._lru: "OrderedDict[int, _Entrada]" = OrderedDict()
+        self._por_clave: Dict[str, Dict[int, _Entrada]] = {}
+        self._exactas: Dict[str, int] = {}
+        # Matriz apilada de cada espacio de nombres; se invalida al cambiar sus entradas
+        self._matrices: Dict[str, Tuple[List[int], Any]] = {}
+        self._ids = count()
+        self.hits = 0
+        self.misses = 0
+
+    def habilitado(self, endpoint: str) -> bool:
+        """El endpoint no fue excluido de la caché"""
+        return endpoint in self.endpoints
+
+    def buscar(self, endpoint: str, namespace: str, embedding: Sequence[float],
+               threshold: Optional[float] = None) -> Optional[str]:
+        """Respuesta de la entrada más similar sobre el umbral (o None)"""
+        if not self.habilitado(endpoint):
+            return None
+
+        clave = f"{endpoint}|{namespace}"
+        ahora = time.time()
+        for entrada_id, entrada in list(self._por_clave.get(clave, {}).items()):
+            if entrada.expira <= ahora:
+                self._eliminar(entrada_id)
+        umbral = self.threshold if threshold is None else threshold
+
+        mejor_id, mejor_similitud = self._mas_similar(clave, _normalizar(embedding))
+        if mejor_id is None or mejor_similitud < umbral:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._lru.move_to_end(mejor_id)
+        return self._lru[mejor_id].respuesta
+
+    def _mas_similar(self, clave: str, query: Any) -> Tuple[Optional[int], float]:
+        """Entrada vigente del espacio de nombres con mayor similitud coseno"""
+        entradas = self._por_clave.get(clave)
+        if not entradas:
+            return None, -1.0
+        if np is None:
+            mejor_id, mejor_similitud = None, -1.0
+            for entrada_id, entrada in entradas.items():
+                similitud = sum(a * b for a, b in zip(query, entrada.vector))
+                if similitud > mejor_similitud:
+                    mejor_id, mejor_similitud = entrada_id, similitud
+            return mejor_id, mejor_similitud
+
+        apilada = self._matrices.get(clave)
+        if apilada is None:
+            ids = list(entradas)
+            apilada = (ids, np.stack([entradas[i].vector for i in ids]))
+            self._matrices[clave] = apilada
+        ids, matriz = apilada
+        similitudes = matriz @ query
+        mejor = int(np.argmax(similitudes))
+        return ids[mejor], float(similitudes[mejor])
+
+    def guardar(self, endpoint: str, namespace: str, embedding: Sequence[float],
+                respuesta: str) -> None:
+        """Guardar una respuesta generada"""
+        if not self.habilitado(endpoint) or not respuesta:
+            return
+
+        clave = f"{endpoint}|{namespace}"
+        entrada_id = next(self._ids)
+        entrada = _Entrada(clave, _normalizar(embedding), respuesta, time.time() + self.ttl_seconds)
+        self._lru[entrada_id] = entrada
+        self._por_clave.setdefault(clave, {})[entrada_id] = entrada
+        self._matrices.pop(clave, None)
+        self._recortar()
+
+    def buscar_exacta(self, endpoint: str, huella_solicitud: str) -> Optional[str]:
+        """Respuesta guardada para exactamente la misma solicitud (o None)"""
+        if not self.habilitado(endpoint):
+            return None
+
+        entrada_id = self._exactas.get(f"{endpoint}#{huella_solicitud}")
+        entrada = self._lru.get(entrada_id) if entrada_id is not None else None
+        if entrada is not None and entrada.expira <= time.time():
+            self._eliminar(entrada_id)
+            entrada = None
+        if entrada is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._lru.move_to_end(entrada_id)
+        return entrada.respuesta
+
+    def guardar_exacta(self, endpoint: str, huella_solicitud: str, respuesta: str) -> None:
+        """Guardar la respuesta de una solicitud identificada por su huella"""
+        if not self.habilitado(endpoint) or not respuesta:
+            return
+
+        clave = f"{endpoint}#{huella_solicitud}"
+        anterior = self._exactas.get(clave)
+        if anterior is not None:
+            self._eliminar(anterior)
+        entrada_id = next(self._ids)
+        self._lru[entrada_id] = _Entrada(clave, None, respuesta, time.time() + self.ttl_seconds)
+        self._exactas[clave] = entrada_id
+        self._recortar()
+
+    def _recortar(self) -> None:
+        while len(self._lru) > self.max_entries:
+            self._eliminar(next(iter(self._lru)))
+
+    def _eliminar(self, entrada_id: int) -> None:
+        entrada = self._lru.pop(entrada_id, None)
+        if entrada is None:
+            return
+        if entrada.vector is None:
+            self._exactas.pop(entrada.clave, None)
+            return
+        self._matrices.pop(entrada.clave, None)
+        entradas = self._por_clave.get(entrada.clave)
+        if entradas is not None:
+            entradas.pop(entrada_id, None)
+            if not entradas:
+                del self._por_clave[entrada.clave]
+
+    def clear(self) -> None:
+        self._lru.clear()
+        self._por_clave.clear()
+        self._exactas.clear()
+        self._matrices.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de la caché"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "max_entries": self.max_entries,
+            "endpoints": sorted(self.endpoints),
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
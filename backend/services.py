@@ -15,7 +15,25 @@ from math import ceil
 
 import httpx
 from supabase import Client
-from context_manager import ContextManager, get_context_manager
+from context_manager import (
+    ContextManager, MensajeContexto, get_context_manager, consultar_mensajes_recientes, COLUMNAS_HISTORIAL
+)
+from http_client import HTTPClientManager, get_http_clients, TGI_UPSTREAM, EMBEDDINGS_UPSTREAM
+from resilience import ResilientUpstream, CircuitoAbiertoError
+from load_balancer import TGILoadBalancer
+from token_counter import get_token_counter
+from db import SupabaseExecutor, get_db_executor
+from embedding_cache import EmbeddingCache
+from batching import MicroBatcher
+from chunking import dividir_por_secciones
+from vector_index import LocalVectorIndex
+from retrieval import fusion_rrf
+from semantic_cache import SemanticResponseCache, MARCA_CACHE, huella
+from streaming import SSE_HEADERS, evento_sse, iterar_contenido_tgi, cliente_desconectado, linea_ndjson
+from inference_scheduler import (
+    InferenceScheduler, ColaInferenciaLlenaError, get_inference_scheduler,
+    prioridad_reporte, prioridad_lote, PRIORIDAD_CHAT, PRIORIDAD_URGENTE, PRIORIDAD_LOTE
+)
 
 from models import (
     # Pacientes
@@ -24,12 +42,12 @@ from models import (
     Estudio, EstudioCreate, EstudioUpdate, EstadisticasEstudios,
     # Reportes
     Reporte, ReporteCreate, ReporteUpdate, ReportGenerationRequest, 
-    FirmaReporte, EstadisticasReportes,
+    ReportBatchRequest, FirmaReporte, EstadisticasReportes,
     # Chat
     ConversacionChat, ConversacionChatCreate, MensajeChat, MensajeChatCreate,
     ChatRequest, ChatResponse, ChatMessage,
     # RAG
-    RAGSearchRequest, RAGSearchResult,
+    RAGSearchRequest, RAGSearchResult, ModoBusquedaEnum,
     # Órdenes de Compra
     OrdenCompra, OrdenCompraCreate, OrdenCompraUpdate, OrdenDetalle,
     OrdenDetalleCreate, EstadisticasOrdenes, EstadoOrdenEnum,
@@ -50,8 +68,20 @@ from models import (
 class EmbeddingService:
     """Servicio para generar embeddings usando API externa de Hugging Face"""
     
-    def __init__(self, api_url: str):
+    def __init__(self, api_url: str, http_clients: Optional[HTTPClientManager] = None,
+                 cache: Optional[EmbeddingCache] = None,
+                 max_batch_size: int = 32, coalesce_window_ms: float = 5.0):
         self.api_url = api_url
+        self.http_clients = http_clients or get_http_clients()
+        # Caché por hash de contenido (LRU en memoria + SQLite opcional)
+        self.cache = cache or EmbeddingCache(namespace=api_url)
+        self.max_batch_size = max_batch_size
+        # Agrupa llamadas concurrentes a encode() en una sola petición upstream
+        self.batcher = MicroBatcher(
+            self._encode_uncached_batch,
+            max_batch_size=max_batch_size,
+            max_wait_ms=coalesce_window_ms
+        )
         self.headers = {
             "Accept": "application/json",
             "Content-Type": "application/json"
@@ -59,48 +89,86 @@ class EmbeddingService:
     
     async def encode(self, text: str) -> List[float]:
         """Generar embedding para un texto usando la API externa"""
+        cached = await self.cache.get(text)
+        if cached is not None:
+            return cached
+        
+        return await self.batcher.submit(text)
+    
+    async def encode_batch(self, texts: List[str]) -> List[List[float]]:
+        """Generar embeddings para varios textos con el mínimo de peticiones"""
+        resultados: Dict[str, List[float]] = {}
+        pendientes: List[str] = []
+        
+        for text in dict.fromkeys(texts):  # Deduplicar preservando orden
+            cached = await self.cache.get(text)
+            if cached is not None:
+                resultados[text] = cached
+            else:
+                pendientes.append(text)
+        
+        for i in range(0, len(pendientes), self.max_batch_size):
+            lote = pendientes[i:i + self.max_batch_size]
+            for text, embedding in zip(lote, await self._encode_uncached_batch(lote)):
+                resultados[text] = embedding
+        
+        return [resultados[text] for text in texts]
+    
+    async def _encode_uncached_batch(self, texts: List[str]) -> List[List[float]]:
+        """Solicitar un lote al endpoint y guardar los resultados en caché"""
+        unicos = list(dict.fromkeys(texts))
+        if len(unicos) == 1:
+            embeddings = [await self._request_embedding(unicos[0])]
+        else:
+            embeddings = await self._request_embeddings(unicos)
+        
+        por_texto = dict(zip(unicos, embeddings))
+        for text, embedding in por_texto.items():
+            await self.cache.put(text, embedding)
+        return [por_texto[text] for text in texts]
+    
+    async def _request_embedding(self, text: str) -> List[float]:
+        """Solicitar el embedding de un texto al endpoint remoto"""
+        return self._parse_embedding(await self._post_inputs(text))
+    
+    async def _request_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Solicitar embeddings de varios textos en una sola petición"""
+        result = await self._post_inputs(texts)
+        
+        if isinstance(result, dict):
+            result = result.get('embeddings', result.get('embedding'))
+        if isinstance(result, list) and len(result) == len(texts):
+            vectores = []
+            for item in result:
+                if isinstance(item, dict) and 'embedding' in item:
+                    item = item['embedding']
+                if not (isinstance(item, list) and item and isinstance(item[0], (int, float))):
+                    break
+                vectores.append(item)
+            else:
+                return vectores
+        
+        # El endpoint no soporta lotes: recurrir a peticiones individuales
+        print(f"⚠️ Respuesta de lote no reconocida, usando peticiones individuales ({len(texts)} textos)")
+        return list(await asyncio.gather(*(self._request_embedding(t) for t in texts)))
+    
+    async def _post_inputs(self, inputs: Any) -> Any:
+        """POST al endpoint de embeddings con `inputs` (texto o lista de textos)"""
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json={
-                        "inputs": text,
-                        "parameters": {}
-                    }
-                )
-                
-                if not response.is_success:
-                    raise Exception(f"Error en API de embeddings: {response.status_code} - {response.text}")
-                
-                result = response.json()
-                
-                # El resultado puede venir en diferentes formatos
-                if isinstance(result, list):
-                    # Si es una lista directa de números
-                    if result and isinstance(result[0], (int, float)):
-                        return result
-                    # Si es una lista con un vector anidado (caso actual)
-                    elif result and isinstance(result[0], list):
-                        return result[0]  # El vector está en el primer elemento
-                    # Si es una lista con objetos
-                    elif result and isinstance(result[0], dict) and 'embedding' in result[0]:
-                        return result[0]['embedding']
-                    else:
-                        return result[0] if result else []  # Asumir que el primer elemento es el vector
-                elif isinstance(result, dict):
-                    # Si es un objeto con la clave embedding
-                    if 'embedding' in result:
-                        return result['embedding']
-                    elif 'embeddings' in result:
-                        return result['embeddings'][0] if isinstance(result['embeddings'][0], list) else result['embeddings']
-                    else:
-                        # Buscar cualquier lista de números
-                        for value in result.values():
-                            if isinstance(value, list) and len(value) > 0 and isinstance(value[0], (int, float)):
-                                return value
-                
-                raise ValueError(f"Formato de respuesta inesperado: {result}")
+            # Reintentos, cobertura y circuit breaker del upstream de embeddings
+            response = await self.http_clients.upstream(EMBEDDINGS_UPSTREAM).post(
+                self.api_url,
+                headers=self.headers,
+                json={
+                    "inputs": inputs,
+                    "parameters": {}
+                }
+            )
+            
+            if not response.is_success:
+                raise Exception(f"Error en API de embeddings: {response.status_code} - {response.text}")
+            
+            return response.json()
                 
         except httpx.TimeoutException:
             raise Exception("Timeout al generar embedding")
@@ -108,6 +176,34 @@ class EmbeddingService:
             print(f"Error generando embedding: {e}")
             raise e
     
+    def _parse_embedding(self, result: Any) -> List[float]:
+        """Extraer el vector de la respuesta (el formato varía según el endpoint)"""
+        if isinstance(result, list):
+            # Si es una lista directa de números
+            if result and isinstance(result[0], (int, float)):
+                return result
+            # Si es una lista con un vector anidado (caso actual)
+            elif result and isinstance(result[0], list):
+                return result[0]  # El vector está en el primer elemento
+            # Si es una lista con objetos
+            elif result and isinstance(result[0], dict) and 'embedding' in result[0]:
+                return result[0]['embedding']
+            else:
+                return result[0] if result else []  # Asumir que el primer elemento es el vector
+        elif isinstance(result, dict):
+            # Si es un objeto con la clave embedding
+            if 'embedding' in result:
+                return result['embedding']
+            elif 'embeddings' in result:
+                return result['embeddings'][0] if isinstance(result['embeddings'][0], list) else result['embeddings']
+            else:
+                # Buscar cualquier lista de números
+                for value in result.values():
+                    if isinstance(value, list) and len(value) > 0 and isinstance(value[0], (int, float)):
+                        return value
+        
+        raise ValueError(f"Formato de respuesta inesperado: {result}")
+    
     def encode_sync(self, text: str) -> List[float]:
         """Versión síncrona para compatibilidad (usar encode() preferentemente)"""
         import asyncio
@@ -116,8 +212,10 @@ class EmbeddingService:
 class DatabaseService:
     """Clase base para servicios que interactúan con la base de datos"""
     
-    def __init__(self, supabase: Client):
+    def __init__(self, supabase: Client, db: Optional[SupabaseExecutor] = None):
         self.supabase = supabase
+        # Ejecutor no bloqueante para las queries síncronas de supabase-py
+        self.db = db or get_db_executor()
     
     def handle_db_error(self, error: Exception) -> Dict[str, Any]:
         """Maneja errores de base de datos de forma consistente"""
@@ -138,7 +236,7 @@ class PacienteService(DatabaseService):
         """Crear un nuevo paciente con número automático"""
         try:
             # Generar número de paciente automático
-            numero_result = self.supabase.rpc('generate_patient_number').execute()
+            numero_result = await self.db.execute(self.supabase.rpc('generate_patient_number'))
             numero_paciente = numero_result.data
             
             # Preparar datos para inserción
@@ -150,7 +248,7 @@ class PacienteService(DatabaseService):
                 paciente_dict['contacto_emergencia'] = paciente_dict['contacto_emergencia']
             
             # Insertar en base de datos
-            result = self.supabase.table('pacientes').insert(paciente_dict).execute()
+            result = await self.db.execute(self.supabase.table('pacientes').insert(paciente_dict))
             
             return BaseResponse(
                 success=True,
@@ -180,7 +278,7 @@ class PacienteService(DatabaseService):
             # Aplicar paginación y ordenamiento
             query = query.range(offset, offset + limit - 1).order('created_at', desc=True)
             
-            result = query.execute()
+            result = await self.db.execute(query)
             
             # Calcular metadatos de paginación
             total = result.count if result.count else 0
@@ -206,7 +304,7 @@ class PacienteService(DatabaseService):
     async def obtener_paciente(self, paciente_id: UUID) -> BaseResponse:
         """Obtener un paciente específico por ID"""
         try:
-            result = self.supabase.table('pacientes').select('*').eq('id', str(paciente_id)).execute()
+            result = await self.db.execute(self.supabase.table('pacientes').select('*').eq('id', str(paciente_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -239,7 +337,7 @@ class PacienteService(DatabaseService):
                     data=None
                 )
             
-            result = self.supabase.table('pacientes').update(update_data).eq('id', str(paciente_id)).execute()
+            result = await self.db.execute(self.supabase.table('pacientes').update(update_data).eq('id', str(paciente_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -261,9 +359,9 @@ class PacienteService(DatabaseService):
         """Eliminar un paciente (soft delete)"""
         try:
             # Cambiar estado a 'Inactivo' en lugar de eliminar físicamente
-            result = self.supabase.table('pacientes').update({
+            result = await self.db.execute(self.supabase.table('pacientes').update({
                 'estado': 'Inactivo'
-            }).eq('id', str(paciente_id)).execute()
+            }).eq('id', str(paciente_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -284,7 +382,7 @@ class PacienteService(DatabaseService):
     async def obtener_estadisticas(self) -> EstadisticasPacientes:
         """Obtener estadísticas de pacientes"""
         try:
-            result = self.supabase.rpc('v_estadisticas_pacientes').execute()
+            result = await self.db.execute(self.supabase.rpc('v_estadisticas_pacientes'))
             
             if result.data:
                 stats = result.data[0]
@@ -328,7 +426,7 @@ class EstudioService(DatabaseService):
         """Crear un nuevo estudio médico"""
         try:
             # Generar número de estudio automático
-            numero_result = self.supabase.rpc('generate_study_number').execute()
+            numero_result = await self.db.execute(self.supabase.rpc('generate_study_number'))
             numero_estudio = numero_result.data
             
             # Preparar datos para inserción
@@ -340,7 +438,7 @@ class EstudioService(DatabaseService):
             if estudio_dict.get('metadatos_dicom'):
                 estudio_dict['metadatos_dicom'] = estudio_dict['metadatos_dicom']
             
-            result = self.supabase.table('estudios').insert(estudio_dict).execute()
+            result = await self.db.execute(self.supabase.table('estudios').insert(estudio_dict))
             
             return BaseResponse(
                 success=True,
@@ -376,7 +474,7 @@ class EstudioService(DatabaseService):
             # Aplicar paginación y ordenamiento
             query = query.range(offset, offset + limit - 1).order('fecha_estudio', desc=True)
             
-            result = query.execute()
+            result = await self.db.execute(query)
             
             total = result.count if result.count else 0
             pages = ceil(total / limit) if total > 0 else 1
@@ -401,9 +499,9 @@ class EstudioService(DatabaseService):
     async def obtener_estudio(self, estudio_id: UUID) -> BaseResponse:
         """Obtener un estudio específico con datos del paciente"""
         try:
-            result = self.supabase.table('estudios').select(
+            result = await self.db.execute(self.supabase.table('estudios').select(
                 '*,pacientes(nombre,apellido,numero_paciente,fecha_nacimiento)'
-            ).eq('id', str(estudio_id)).execute()
+            ).eq('id', str(estudio_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -435,7 +533,7 @@ class EstudioService(DatabaseService):
                     data=None
                 )
             
-            result = self.supabase.table('estudios').update(update_data).eq('id', str(estudio_id)).execute()
+            result = await self.db.execute(self.supabase.table('estudios').update(update_data).eq('id', str(estudio_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -467,10 +565,10 @@ class EstudioService(DatabaseService):
             archivos_actuales.append(archivo.url)
             
             # Actualizar estudio con el nuevo archivo
-            result = self.supabase.table('estudios').update({
+            result = await self.db.execute(self.supabase.table('estudios').update({
                 'archivos_dicom': archivos_actuales,
                 'estado': 'En Proceso'  # Cambiar estado cuando se sube archivo
-            }).eq('id', str(estudio_id)).execute()
+            }).eq('id', str(estudio_id)))
             
             return BaseResponse(
                 success=True,
@@ -485,12 +583,12 @@ class EstudioService(DatabaseService):
         """Obtener estadísticas de estudios"""
         try:
             # Obtener estadísticas básicas
-            result = self.supabase.from_('v_estadisticas_estudios').select('*').execute()
+            result = await self.db.execute(self.supabase.from_('v_estadisticas_estudios').select('*'))
             
             # Obtener distribución por modalidad
-            modalidad_result = self.supabase.table('estudios').select(
+            modalidad_result = await self.db.execute(self.supabase.table('estudios').select(
                 'tipo_estudio'
-            ).execute()
+            ))
             
             # Contar por modalidad
             modalidades = {}
@@ -547,51 +645,162 @@ class IAService:
     """Servicio para funcionalidades de IA, incluyendo generación de reportes y RAG"""
     
     def __init__(self, supabase: Client, embedding_service: EmbeddingService, 
-                 tgi_url: str):
+                 tgi_url: str, http_clients: Optional[HTTPClientManager] = None,
+                 db: Optional[SupabaseExecutor] = None,
+                 vector_index: Optional[LocalVectorIndex] = None,
+                 response_cache: Optional[SemanticResponseCache] = None,
+                 scheduler: Optional[InferenceScheduler] = None,
+                 tgi_balancer: Optional[TGILoadBalancer] = None):
         self.supabase = supabase
+        self.db = db or get_db_executor()
         self.embedding_service = embedding_service
         self.tgi_url = tgi_url  # URL del endpoint TGI de Hugging Face
         # Mantener compatibilidad temporal
         self.lm_studio_url = tgi_url
+        # Réplicas de TGI (una sola si no se configura TGI_URLS)
+        self.tgi_balancer = tgi_balancer or TGILoadBalancer([tgi_url])
+        # Cliente HTTP compartido (keep-alive) para las llamadas a TGI
+        self.http_clients = http_clients or get_http_clients()
+        # Índice vectorial local opcional (fallback a la RPC de Supabase)
+        self.vector_index = vector_index
+        # Caché semántica de respuestas de TGI (opcional)
+        self.response_cache = response_cache
+        # Límite de concurrencia y cola de prioridad hacia TGI
+        self.scheduler = scheduler or get_inference_scheduler()
+        # Métricas de generaciones de reportes en streaming
+        self.streaming_stats = {
+            "iniciadas": 0,
+            "completadas": 0,
+            "canceladas": 0,
+            "errores": 0,
+            "caracteres_descartados": 0
+        }
+    
+    @property
+    def tgi_client(self) -> httpx.AsyncClient:
+        """Cliente HTTP compartido del upstream TGI"""
+        return self.http_clients.client(TGI_UPSTREAM)
+    
+    @property
+    def tgi_upstream(self) -> ResilientUpstream:
+        """Upstream TGI con reintentos y circuit breaker"""
+        return self.http_clients.upstream(TGI_UPSTREAM)
     
     async def buscar_rag(self, request: RAGSearchRequest) -> List[RAGSearchResult]:
-        """Realizar búsqueda semántica usando RAG"""
+        """Realizar búsqueda RAG (vectorial, léxica o híbrida según `request.modo`)"""
         try:
-            # Generar embedding de la consulta
-            query_embedding = await self.embedding_service.encode(request.query)
-            
-            # Parámetros para la función RPC
-            rpc_params = {
-                'query_embedding': query_embedding,
-                'match_threshold': request.umbral_similitud,
-                'match_count': request.limite_resultados
-            }
-            
-            # Filtrar por paciente si se especifica
-            if request.paciente_id:
-                rpc_params['paciente_filter'] = str(request.paciente_id)
-            
-            # Ejecutar búsqueda (usar función temporal para 1024 dimensiones)
-            result = self.supabase.rpc('match_report_embeddings_1024', rpc_params).execute()
-            
-            # Convertir resultados
-            resultados = []
-            if result.data:
-                for item in result.data:
-                    resultados.append(RAGSearchResult(
-                        id=item['id'],
-                        reporte_id=item['reporte_id'],
-                        paciente_id=item['paciente_id'],
-                        contenido=item['contenido'],
-                        similitud=item['similarity']
-                    ))
+            if request.modo == ModoBusquedaEnum.LEXICO:
+                return await self._buscar_lexico(request, request.limite_resultados)
+            
+            if request.modo == ModoBusquedaEnum.HIBRIDO:
+                # Ampliar candidatos de cada recuperador y fusionar por rango (RRF)
+                candidatos = min(request.limite_resultados * 3, 50)
+                vectoriales, lexicos = await asyncio.gather(
+                    self._buscar_vectorial(request, candidatos),
+                    self._buscar_lexico(request, candidatos),
+                    return_exceptions=True
+                )
+                listas = []
+                for nombre, resultado in (("vectorial", vectoriales), ("léxica", lexicos)):
+                    if isinstance(resultado, Exception):
+                        print(f"⚠️ Búsqueda {nombre} falló en modo híbrido: {resultado}")
+                    else:
+                        listas.append(resultado)
+                return fusion_rrf(listas, limite=request.limite_resultados)
             
-            return resultados
+            return await self._buscar_vectorial(request, request.limite_resultados)
             
         except Exception as e:
             print(f"Error en búsqueda RAG: {e}")
             return []
     
+    async def _buscar_vectorial(self, request: RAGSearchRequest, limite: int) -> List[RAGSearchResult]:
+        """Búsqueda por similitud de embeddings (índice local o RPC)"""
+        # Generar embedding de la consulta
+        query_embedding = await self.embedding_service.encode(request.query)
+        
+        # Usar el índice local si está cargado
+        if self.vector_index is not None and self.vector_index.listo:
+            try:
+                items = await self.vector_index.buscar(
+                    query_embedding,
+                    k=limite,
+                    threshold=request.umbral_similitud,
+                    paciente_id=str(request.paciente_id) if request.paciente_id else None
+                )
+                # El índice no guarda texto: se lee de la BD (y se omiten filas ya borradas)
+                contenidos = await self._contenidos_fragmentos([item['id'] for item in items])
+                return [
+                    self._resultado_rag({**item, 'contenido': contenidos[item['id']]}, item['similarity'])
+                    for item in items if item['id'] in contenidos
+                ]
+            except Exception as e:
+                print(f"⚠️ Índice vectorial local falló, usando RPC: {e}")
+        
+        # Parámetros para la función RPC
+        rpc_params = {
+            'query_embedding': query_embedding,
+            'match_threshold': request.umbral_similitud,
+            'match_count': limite
+        }
+        
+        # Filtrar por paciente si se especifica
+        if request.paciente_id:
+            rpc_params['paciente_filter'] = str(request.paciente_id)
+        
+        # Ajuste de recall/latencia del índice ANN por consulta
+        if request.ef_search:
+            rpc_params['ef_search'] = request.ef_search
+        if request.probes:
+            rpc_params['probes'] = request.probes
+        
+        # Ejecutar búsqueda (usar función temporal para 1024 dimensiones)
+        result = await self.db.execute(self.supabase.rpc('match_report_embeddings_1024', rpc_params))
+        return [self._resultado_rag(item, item['similarity']) for item in result.data or []]
+    
+    async def _contenidos_fragmentos(self, ids: List[str]) -> Dict[str, str]:
+        """Texto de los fragmentos de reporte por id"""
+        if not ids:
+            return {}
+        result = await self.db.execute(
+            self.supabase.table('reporte_embeddings_new').select('id,contenido').in_('id', ids)
+        )
+        return {str(row['id']): row['contenido'] for row in result.data or []}
+    
+    async def _buscar_lexico(self, request: RAGSearchRequest, limite: int) -> List[RAGSearchResult]:
+        """Búsqueda de texto completo (tsvector) sobre los fragmentos de reportes"""
+        rpc_params = {
+            'query_text': request.query,
+            'match_count': limite
+        }
+        if request.paciente_id:
+            rpc_params['paciente_filter'] = str(request.paciente_id)
+        
+        result = await self.db.execute(self.supabase.rpc('search_report_embeddings_text', rpc_params))
+        return [self._resultado_rag(item, item['rank']) for item in result.data or []]
+    
+    @staticmethod
+    def _resultado_rag(item: Dict[str, Any], similitud: float) -> RAGSearchResult:
+        return RAGSearchResult(
+            id=item['id'],
+            reporte_id=item['reporte_id'],
+            paciente_id=item['paciente_id'],
+            contenido=item['contenido'],
+            similitud=similitud,
+            seccion=item.get('seccion'),
+            chunk_inicio=item.get('chunk_inicio'),
+            chunk_fin=item.get('chunk_fin')
+        )
+    
+    async def obtener_indice_embeddings(self) -> BaseResponse:
+        """Consultar los índices existentes de reporte_embeddings_new"""
+        try:
+            result = await self.db.execute(self.supabase.rpc('report_embeddings_index_info', {}))
+            return BaseResponse(success=True, message="Índices de embeddings", data=result.data or [])
+        except Exception as e:
+            print(f"Error consultando índice de embeddings: {e}")
+            return BaseResponse(success=False, message=f"Error consultando índice: {str(e)}")
+    
     async def analizar_imagen_dicom(self, request: DicomAnalysisRequest) -> BaseResponse:
         """Analizar imagen DICOM usando modelo multimodal con TGI"""
         start_time = time.time()
@@ -638,13 +847,14 @@ Mantén un lenguaje médico profesional y preciso."""
             )
             
             # Realizar solicitud a TGI
-            async with httpx.AsyncClient(timeout=300.0) as client:  # Más tiempo para análisis de imagen
-                response = await client.post(
-                    f"{self.tgi_url}/v1/chat/completions",
+            async with self.scheduler.slot(PRIORIDAD_URGENTE, "dicom"):
+                response = await self.tgi_upstream.post(
+                    "/v1/chat/completions",
+                    balancer=self.tgi_balancer,
                     json=tgi_request.model_dump(),
                     headers={"Content-Type": "application/json"}
                 )
-                response.raise_for_status()
+            response.raise_for_status()
             
             ai_response = response.json()
             analisis_resultado = ai_response['choices'][0]['message']['content']
@@ -678,105 +888,171 @@ Mantén un lenguaje médico profesional y preciso."""
                 data=None
             )
     
+    async def _solicitud_reporte(self, request: ReportGenerationRequest) -> TGIRequest:
+        """Construir la solicitud a TGI (prompt con contexto RAG opcional)"""
+        # Obtener contexto RAG si se solicita
+        contexto_rag = ""
+        if request.incluir_contexto_rag:
+            rag_request = RAGSearchRequest(
+                query=f"{request.tipo_estudio} {request.contexto_clinico}",
+                paciente_id=request.paciente_id,
+                limite_resultados=3,
+                umbral_similitud=0.6,
+                # Términos exactos (fármacos, códigos, medidas) además de la similitud semántica
+                modo=ModoBusquedaEnum.HIBRIDO
+            )
+            rag_results = await self.buscar_rag(rag_request)
+            
+            if rag_results:
+                contexto_rag = "\\n\\nCONTEXTO DE CASOS SIMILARES:\\n"
+                for i, result in enumerate(rag_results, 1):
+                    # Cada resultado ya es el fragmento relevante (una sección), no el reporte completo
+                    seccion = f" ({result.seccion})" if result.seccion else ""
+                    contexto_rag += f"Caso {i}{seccion}: {result.contenido}\\n"
+        
+        # Construir prompt especializado
+        prompt = f"""
+        Eres un radiólogo experto especializado en {request.tipo_estudio}. 
+        Genera un reporte radiológico completo, estructurado y profesional en español.
+        
+        INFORMACIÓN DEL CASO:
+        - Tipo de Estudio: {request.tipo_estudio}
+        - Contexto Clínico: {request.contexto_clinico}
+        - Radiólogo: {request.radiologo}
+        
+        {contexto_rag}
+        
+        INSTRUCCIONES:
+        1. Genera un reporte con las siguientes secciones obligatorias:
+           - TÉCNICA: Descripción de la técnica radiológica utilizada
+           - HALLAZGOS: Descripción detallada de los hallazgos observados
+           - IMPRESIÓN DIAGNÓSTICA: Conclusiones diagnósticas principales
+           - RECOMENDACIONES: Recomendaciones clínicas si corresponde
+        
+        2. Utiliza terminología médica precisa y profesional
+        3. Sé específico pero conciso
+        4. Mantén un tono profesional y objetivo
+        5. Si hay hallazgos normales, indícalo claramente
+        
+        Genera el reporte ahora:
+        """
+        
+        # Preparar solicitud a TGI
+        messages = [ChatMessage(role=RolChatEnum.USER, content=prompt)]
+        return TGIRequest(
+            messages=messages,
+            temperature=request.temperatura,
+            max_tokens=2048,
+            stream=False
+        )
+    
+    async def _completar_reporte(self, request: ReportGenerationRequest, tgi_request: TGIRequest,
+                                 prioridad: Optional[int] = None) -> str:
+        """Obtener el reporte de TGI"""
+        # Realizar solicitud a TGI (en cola según la prioridad del estudio)
+        if prioridad is None:
+            prioridad = prioridad_reporte(request.prioridad)
+        async with self.scheduler.slot(prioridad, "reporte"):
+            response = await self.tgi_upstream.post(
+                "/v1/chat/completions",
+                balancer=self.tgi_balancer,
+                clave=self._afinidad_reporte(request),
+                json=tgi_request.model_dump(),
+                headers={"Content-Type": "application/json"}
+            )
+        response.raise_for_status()
+        
+        ai_response = response.json()
+        reporte_generado = ai_response['choices'][0]['message']['content']
+        return reporte_generado
+    
+    @staticmethod
+    def _afinidad_reporte(request: ReportGenerationRequest) -> str:
+        """Los prompts del mismo tipo de estudio comparten prefijo: misma réplica"""
+        return f"reporte|{request.tipo_estudio}"
+    
+    @staticmethod
+    def _huella_reporte(tgi_request: TGIRequest) -> str:
+        """Huella exacta de la solicitud: prompt normalizado y todos los parámetros de generación"""
+        solicitud = tgi_request.model_dump(mode="json")
+        for message in solicitud["messages"]:
+            message["content"] = " ".join(message["content"].split())
+        return huella(solicitud)
+    
+    async def embedding_para_cache(self, endpoint: str, texto: str,
+                                    usar_cache: bool = True) -> Optional[List[float]]:
+        """Embedding del prompt si la caché semántica aplica al endpoint (o None)"""
+        if not usar_cache or self.response_cache is None or not self.response_cache.habilitado(endpoint):
+            return None
+        try:
+            return await self.embedding_service.encode(texto)
+        except Exception as e:
+            print(f"⚠️ Caché semántica no disponible: {e}")
+            return None
+    
+    async def _obtener_reporte_generado(self, request: ReportGenerationRequest,
+                                        prioridad: Optional[int] = None) -> Tuple[str, str]:
+        """Texto del reporte y modelo usado (caché o TGI)"""
+        tgi_request = await self._solicitud_reporte(request)
+        
+        # Solo se reutiliza el reporte de una solicitud idéntica (nunca por similitud:
+        # "derecho/izquierdo" o "con/sin fiebre" darían un borrador clínicamente erróneo)
+        huella_solicitud = None
+        if request.usar_cache and self.response_cache is not None and self.response_cache.habilitado('reportes'):
+            huella_solicitud = self._huella_reporte(tgi_request)
+            reporte_generado = self.response_cache.buscar_exacta('reportes', huella_solicitud)
+            if reporte_generado is not None:
+                print("♻️ Reporte servido desde caché (solicitud idéntica)")
+                return reporte_generado, f"tgi-{MARCA_CACHE}"
+        
+        reporte_generado = await self._completar_reporte(request, tgi_request, prioridad)
+        if huella_solicitud is not None:
+            self.response_cache.guardar_exacta('reportes', huella_solicitud, reporte_generado)
+        return reporte_generado, "tgi"
+    
+    def _fila_reporte(self, request: ReportGenerationRequest, reporte_generado: str,
+                      tiempo_generacion: float, modelo_usado: str, numero_reporte: str,
+                      estado: EstadoReporteEnum = EstadoReporteEnum.BORRADOR) -> Dict[str, Any]:
+        """Fila de la tabla reportes para un reporte generado por IA"""
+        return {
+            'numero_reporte': numero_reporte,
+            'paciente_id': str(request.paciente_id),
+            'estudio_id': str(request.estudio_id) if request.estudio_id else None,
+            'tipo_estudio': request.tipo_estudio,
+            'radiologo': request.radiologo,
+            'reporte_generado': reporte_generado,
+            'confianza_ia': self._calcular_confianza_reporte(reporte_generado),
+            'tiempo_generacion': int(tiempo_generacion),
+            'modelo_ia_usado': modelo_usado,
+            'estado': estado,
+            # Extraer secciones del reporte
+            'hallazgos': self._extraer_seccion(reporte_generado, 'HALLAZGOS'),
+            'impresion_diagnostica': self._extraer_seccion(reporte_generado, 'IMPRESIÓN DIAGNÓSTICA'),
+            'tecnica': self._extraer_seccion(reporte_generado, 'TÉCNICA'),
+            'recomendaciones': self._extraer_seccion(reporte_generado, 'RECOMENDACIONES')
+        }
+    
     async def generar_reporte_con_ia(self, request: ReportGenerationRequest) -> BaseResponse:
         """Generar reporte médico usando IA con contexto RAG opcional"""
         start_time = time.time()
         
         try:
-            # Obtener contexto RAG si se solicita
-            contexto_rag = ""
-            if request.incluir_contexto_rag:
-                rag_request = RAGSearchRequest(
-                    query=f"{request.tipo_estudio} {request.contexto_clinico}",
-                    paciente_id=request.paciente_id,
-                    limite_resultados=3,
-                    umbral_similitud=0.6
-                )
-                rag_results = await self.buscar_rag(rag_request)
-                
-                if rag_results:
-                    contexto_rag = "\\n\\nCONTEXTO DE CASOS SIMILARES:\\n"
-                    for i, result in enumerate(rag_results, 1):
-                        contexto_rag += f"Caso {i}: {result.contenido[:200]}...\\n"
-            
-            # Construir prompt especializado
-            prompt = f"""
-            Eres un radiólogo experto especializado en {request.tipo_estudio}. 
-            Genera un reporte radiológico completo, estructurado y profesional en español.
-            
-            INFORMACIÓN DEL CASO:
-            - Tipo de Estudio: {request.tipo_estudio}
-            - Contexto Clínico: {request.contexto_clinico}
-            - Radiólogo: {request.radiologo}
-            
-            {contexto_rag}
-            
-            INSTRUCCIONES:
-            1. Genera un reporte con las siguientes secciones obligatorias:
-               - TÉCNICA: Descripción de la técnica radiológica utilizada
-               - HALLAZGOS: Descripción detallada de los hallazgos observados
-               - IMPRESIÓN DIAGNÓSTICA: Conclusiones diagnósticas principales
-               - RECOMENDACIONES: Recomendaciones clínicas si corresponde
-            
-            2. Utiliza terminología médica precisa y profesional
-            3. Sé específico pero conciso
-            4. Mantén un tono profesional y objetivo
-            5. Si hay hallazgos normales, indícalo claramente
-            
-            Genera el reporte ahora:
-            """
-            
-            # Preparar solicitud a TGI
-            messages = [ChatMessage(role=RolChatEnum.USER, content=prompt)]
-            tgi_request = TGIRequest(
-                messages=messages,
-                temperature=request.temperatura,
-                max_tokens=2048,
-                stream=False
-            )
-            
-            # Realizar solicitud a TGI
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(
-                    f"{self.tgi_url}/v1/chat/completions", 
-                    json=tgi_request.model_dump(),
-                    headers={"Content-Type": "application/json"}
-                )
-                response.raise_for_status()
-            
-            ai_response = response.json()
-            reporte_generado = ai_response['choices'][0]['message']['content']
+            reporte_generado, modelo_usado = await self._obtener_reporte_generado(request)
             
             # Calcular tiempo de generación
             tiempo_generacion = int(time.time() - start_time)
             
-            # Estimar confianza basada en longitud y palabras clave
-            confianza = self._calcular_confianza_reporte(reporte_generado)
-            
             # Generar número de reporte
-            numero_result = self.supabase.rpc('generate_report_number').execute()
+            numero_result = await self.db.execute(self.supabase.rpc('generate_report_number'))
             numero_reporte = numero_result.data if numero_result.data else f"REP{int(time.time())}"
             
-            # Guardar reporte en base de datos
-            reporte_data = {
-                'numero_reporte': numero_reporte,
-                'paciente_id': str(request.paciente_id),
-                'estudio_id': str(request.estudio_id) if request.estudio_id else None,
-                'tipo_estudio': request.tipo_estudio,
-                'radiologo': request.radiologo,
-                'reporte_generado': reporte_generado,
-                'confianza_ia': confianza,
-                'tiempo_generacion': tiempo_generacion,
-                'modelo_ia_usado': tgi_request.model,
-                'estado': EstadoReporteEnum.BORRADOR,
-                # Extraer secciones del reporte
-                'hallazgos': self._extraer_seccion(reporte_generado, 'HALLAZGOS'),
-                'impresion_diagnostica': self._extraer_seccion(reporte_generado, 'IMPRESIÓN DIAGNÓSTICA'),
-                'tecnica': self._extraer_seccion(reporte_generado, 'TÉCNICA'),
-                'recomendaciones': self._extraer_seccion(reporte_generado, 'RECOMENDACIONES')
-            }
+            # Guardar reporte en base de datos (confianza estimada por longitud y palabras clave)
+            reporte_data = self._fila_reporte(
+                request, reporte_generado, tiempo_generacion, modelo_usado, numero_reporte
+            )
+            confianza = reporte_data['confianza_ia']
             
-            insert_result = self.supabase.table('reportes').insert(reporte_data).execute()
+            insert_result = await self.db.execute(self.supabase.table('reportes').insert(reporte_data))
             
             if insert_result.data:
                 reporte_id = insert_result.data[0]['id']
@@ -792,7 +1068,8 @@ Mantén un lenguaje médico profesional y preciso."""
                     data={
                         "reporte": insert_result.data[0],
                         "tiempo_generacion": tiempo_generacion,
-                        "confianza_ia": confianza
+                        "confianza_ia": confianza,
+                        "modelo_usado": modelo_usado
                     }
                 )
             
@@ -865,27 +1142,60 @@ Mantén un lenguaje médico profesional y preciso."""
     
     async def _generar_embedding_reporte(self, reporte_id: str, paciente_id: UUID, 
                                        contenido: str):
-        """Generar y guardar embedding para búsqueda RAG"""
+        """Generar y guardar embeddings (uno por fragmento) para búsqueda RAG"""
+        await self._generar_embeddings_reportes([(reporte_id, paciente_id, contenido)])
+    
+    async def _generar_embeddings_reportes(self, reportes: List[Tuple[str, UUID, str]]):
+        """Embeddings de varios reportes guardados en una sola inserción"""
         try:
-            embedding = await self.embedding_service.encode(contenido)
-            
-            self.supabase.table('reporte_embeddings_new').insert({
-                'reporte_id': reporte_id,
-                'paciente_id': str(paciente_id),
-                'contenido': contenido,
-                'embedding': embedding
-            }).execute()
+            por_reporte = await asyncio.gather(*(
+                self._construir_filas_embedding(reporte_id, paciente_id, contenido)
+                for reporte_id, paciente_id, contenido in reportes
+            ))
+            filas = [fila for filas_reporte in por_reporte for fila in filas_reporte]
+            if filas:
+                result = await self.db.execute(self.supabase.table('reporte_embeddings_new').insert(filas))
+                # Mantener el índice local al día con las filas insertadas
+                if self.vector_index is not None and self.vector_index.listo and result.data:
+                    await self.vector_index.agregar([
+                        {**fila, 'id': row.get('id')}
+                        for fila, row in zip(filas, result.data)
+                    ])
             
         except Exception as e:
             print(f"Error generando embedding: {e}")
     
-    async def generar_reporte_con_ia_streaming(self, request: ReportGenerationRequest):
-        """Generar reporte médico usando IA con streaming"""
+    async def _construir_filas_embedding(self, reporte_id: str, paciente_id: UUID,
+                                         contenido: str) -> List[Dict[str, Any]]:
+        """Dividir el reporte por secciones y calcular los embeddings en lote"""
+        chunks = dividir_por_secciones(contenido)
+        if not chunks:
+            return []
+        
+        embeddings = await self.embedding_service.encode_batch([c.contenido for c in chunks])
+        return [
+            {
+                'reporte_id': str(reporte_id),
+                'paciente_id': str(paciente_id),
+                'contenido': chunk.contenido,
+                'seccion': chunk.seccion,
+                'chunk_inicio': chunk.inicio,
+                'chunk_fin': chunk.fin,
+                'embedding': embedding
+            }
+            for chunk, embedding in zip(chunks, embeddings)
+        ]
+    
+    async def generar_reporte_con_ia_streaming(self, request: ReportGenerationRequest,
+                                               http_request: Optional[Any] = None):
+        """Generar reporte médico usando IA con streaming (se cancela si el cliente se desconecta)"""
         from fastapi.responses import StreamingResponse
-        import json
         
         async def generate():
             start_time = time.time()
+            reporte_completo = ""
+            cancelado = False
+            self.streaming_stats["iniciadas"] += 1
             
             try:
                 # Obtener contexto RAG si se solicita (simplificado para evitar errores)
@@ -930,101 +1240,208 @@ Mantén un lenguaje médico profesional y preciso."""
                     "stream": True  # Habilitar streaming
                 }
                 
-                # Realizar solicitud a TGI con streaming
-                async with httpx.AsyncClient(timeout=180.0) as client:
-                    async with client.stream(
+                # Realizar solicitud a TGI con streaming; al salir del bloque
+                # (fin, desconexión o cancelación) se cierra el stream upstream
+                async with self.scheduler.slot(prioridad_reporte(request.prioridad), "reporte"):
+                    async with self.tgi_upstream.stream(
                         "POST",
-                        f"{self.tgi_url}/v1/chat/completions",
+                        "/v1/chat/completions",
+                        balancer=self.tgi_balancer,
+                        clave=self._afinidad_reporte(request),
                         json=tgi_request,
                         headers={"Content-Type": "application/json"}
                     ) as response:
                         response.raise_for_status()
                         
-                        reporte_completo = ""
-                        
-                        async for line in response.aiter_lines():
-                            if line.strip():
-                                if line.startswith("data: "):
-                                    data_str = line[6:].strip()
-                                    
-                                    if data_str == "[DONE]":
-                                        break
-                                    
-                                    try:
-                                        data = json.loads(data_str)
-                                        if "choices" in data and len(data["choices"]) > 0:
-                                            choice = data["choices"][0]
-                                            if "delta" in choice and "content" in choice["delta"]:
-                                                content = choice["delta"]["content"]
-                                                reporte_completo += content
-                                                
-                                                # Enviar chunk al frontend
-                                                yield f"data: {json.dumps(data)}\n\n"
-                                    
-                                    except json.JSONDecodeError:
-                                        continue
+                        async for content in iterar_contenido_tgi(response):
+                            if await cliente_desconectado(http_request):
+                                cancelado = True
+                                break
+                            reporte_completo += content
+                            # Enviar chunk al frontend (formato delta de TGI)
+                            yield evento_sse({"choices": [{"delta": {"content": content}}]})
+                
+                if cancelado:
+                    self._registrar_cancelacion(request, reporte_completo, start_time)
+                    return
                 
                 # Al final, enviar mensaje de finalización
-                yield f"data: [DONE]\n\n"
+                yield evento_sse("[DONE]")
+                self.streaming_stats["completadas"] += 1
                 
                 # Guardar reporte en base de datos (en segundo plano)
                 asyncio.create_task(self._guardar_reporte_async(request, reporte_completo, time.time() - start_time))
                 
+            except (asyncio.CancelledError, GeneratorExit):
+                # El servidor cerró el generador porque el cliente se desconectó
+                self._registrar_cancelacion(request, reporte_completo, start_time)
+                raise
             except Exception as e:
+                self.streaming_stats["errores"] += 1
                 error_data = {
                     "error": True,
                     "message": f"Error generando reporte: {str(e)}"
                 }
-                yield f"data: {json.dumps(error_data)}\n\n"
+                yield evento_sse(error_data)
         
-        return StreamingResponse(
-            generate(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "*",
-            }
-        )
+        return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
     
-    async def _guardar_reporte_async(self, request: ReportGenerationRequest, reporte_generado: str, tiempo_generacion: float):
+    def _registrar_cancelacion(self, request: ReportGenerationRequest, reporte_parcial: str,
+                               start_time: float) -> None:
+        """Contabilizar una generación abandonada
+        
+        No se guarda nada (ni se consume un número de reporte) salvo que la
+        solicitud pida conservar el texto parcial.
+        """
+        self.streaming_stats["canceladas"] += 1
+        self.streaming_stats["caracteres_descartados"] += len(reporte_parcial)
+        print(f"⚠️ Cliente desconectado: generación de reporte cancelada ({len(reporte_parcial)} caracteres)")
+        if request.guardar_parcial and reporte_parcial.strip():
+            asyncio.create_task(self._guardar_reporte_async(
+                request, reporte_parcial, time.time() - start_time, estado=EstadoReporteEnum.CANCELADO
+            ))
+    
+    async def _guardar_reporte_async(self, request: ReportGenerationRequest, reporte_generado: str, tiempo_generacion: float,
+                                     estado: EstadoReporteEnum = EstadoReporteEnum.BORRADOR):
         """Guardar reporte en base de datos de forma asíncrona"""
         try:
             # Generar número de reporte
-            numero_result = self.supabase.rpc('generate_report_number').execute()
+            numero_result = await self.db.execute(self.supabase.rpc('generate_report_number'))
             numero_reporte = numero_result.data if numero_result.data else f"REP{int(time.time())}"
             
-            # Calcular confianza
-            confianza = self._calcular_confianza_reporte(reporte_generado)
-            
             # Guardar reporte en base de datos
-            reporte_data = {
-                'numero_reporte': numero_reporte,
-                'paciente_id': str(request.paciente_id),
-                'estudio_id': str(request.estudio_id) if request.estudio_id else None,
-                'tipo_estudio': request.tipo_estudio,
-                'radiologo': request.radiologo,
-                'reporte_generado': reporte_generado,
-                'confianza_ia': confianza,
-                'tiempo_generacion': int(tiempo_generacion),
-                'modelo_ia_usado': "medgemma-4b-it-mlx",
-                'estado': EstadoReporteEnum.BORRADOR,
-                'hallazgos': self._extraer_seccion(reporte_generado, 'HALLAZGOS'),
-                'impresion_diagnostica': self._extraer_seccion(reporte_generado, 'IMPRESIÓN DIAGNÓSTICA'),
-                'tecnica': self._extraer_seccion(reporte_generado, 'TÉCNICA'),
-                'recomendaciones': self._extraer_seccion(reporte_generado, 'RECOMENDACIONES')
-            }
+            reporte_data = self._fila_reporte(
+                request, reporte_generado, tiempo_generacion, "medgemma-4b-it-mlx", numero_reporte, estado
+            )
             
-            insert_result = self.supabase.table('reportes').insert(reporte_data).execute()
+            insert_result = await self.db.execute(self.supabase.table('reportes').insert(reporte_data))
             
-            if insert_result.data:
+            # Los reportes cancelados (parciales) no se indexan para RAG
+            if insert_result.data and estado != EstadoReporteEnum.CANCELADO:
                 reporte_id = insert_result.data[0]['id']
                 # Generar embedding para RAG
                 await self._generar_embedding_reporte(reporte_id, request.paciente_id, reporte_generado)
                 
         except Exception as e:
             print(f"Error guardando reporte: {e}")
+    
+    async def generar_reportes_lote(self, request: ReportBatchRequest,
+                                    http_request: Optional[Any] = None):
+        """Generar un lote de reportes con concurrencia acotada (resultados en NDJSON)
+
+        Cada reporte se emite en una línea al quedar guardado (o al fallar);
+        los generados se insertan en bloques de `tamano_insercion`. La última
+        línea contiene el resumen del lote.
+        """
+        from fastapi.responses import StreamingResponse
+        
+        async def generate():
+            start_time = time.time()
+            semaforo = asyncio.Semaphore(request.concurrencia)
+            resumen = {"total": len(request.reportes), "exitosos": 0, "fallidos": 0}
+            generados: List[Dict[str, Any]] = []
+            
+            async def generar(indice: int, item: ReportGenerationRequest) -> Dict[str, Any]:
+                async with semaforo:
+                    inicio = time.time()
+                    try:
+                        reporte, modelo_usado = await self._obtener_reporte_generado(
+                            item, prioridad_lote(item.prioridad)
+                        )
+                    except Exception as e:
+                        return {"indice": indice, "success": False,
+                                "message": f"Error generando reporte: {str(e)}"}
+                    return {"indice": indice, "success": True, "request": item, "reporte": reporte,
+                            "modelo_usado": modelo_usado, "tiempo_generacion": time.time() - inicio}
+            
+            def contabilizar(resultado: Dict[str, Any]) -> str:
+                resumen["exitosos" if resultado["success"] else "fallidos"] += 1
+                return linea_ndjson(resultado)
+            
+            tareas = [asyncio.create_task(generar(i, item)) for i, item in enumerate(request.reportes)]
+            recibidos = set()  # índices ya sacados de as_completed
+            try:
+                for siguiente in asyncio.as_completed(tareas):
+                    resultado = await siguiente
+                    recibidos.add(resultado["indice"])
+                    if resultado["success"]:
+                        generados.append(resultado)
+                    else:
+                        yield contabilizar(resultado)
+                    
+                    if len(generados) >= request.tamano_insercion:
+                        lote, generados = generados, []
+                        for guardado in await self._insertar_reportes_lote(lote):
+                            yield contabilizar(guardado)
+                    
+                    if await cliente_desconectado(http_request):
+                        print(f"⚠️ Cliente desconectado: lote de reportes interrumpido "
+                              f"({resumen['exitosos'] + resumen['fallidos']}/{resumen['total']})")
+                        return
+                
+                if generados:
+                    lote, generados = generados, []
+                    for guardado in await self._insertar_reportes_lote(lote):
+                        yield contabilizar(guardado)
+                
+                resumen["tiempo_total"] = round(time.time() - start_time, 2)
+                yield linea_ndjson({"resumen": resumen})
+            finally:
+                # Reportes que ya terminaron pero as_completed no llegó a entregar:
+                # se guardan junto con los pendientes de inserción en vez de cancelarse
+                for tarea in tareas:
+                    if tarea.done() and not tarea.cancelled():
+                        resultado = tarea.result()
+                        if resultado["indice"] not in recibidos and resultado["success"]:
+                            generados.append(resultado)
+                    else:
+                        tarea.cancel()
+                # No perder los reportes ya generados si el lote se interrumpe
+                if generados:
+                    asyncio.create_task(self._insertar_reportes_lote(generados))
+        
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+    
+    async def _insertar_reportes_lote(self, generados: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insertar en bloque reportes generados e indexarlos para RAG"""
+        try:
+            numeros = await asyncio.gather(*(
+                self.db.execute(self.supabase.rpc('generate_report_number')) for _ in generados
+            ))
+            filas = [
+                self._fila_reporte(
+                    g["request"], g["reporte"], g["tiempo_generacion"], g["modelo_usado"],
+                    numero.data if numero.data else f"REP{int(time.time())}{i:03d}"
+                )
+                for i, (g, numero) in enumerate(zip(generados, numeros))
+            ]
+            insert_result = await self.db.execute(self.supabase.table('reportes').insert(filas))
+            insertados = insert_result.data or []
+            if len(insertados) != len(generados):
+                raise RuntimeError("la inserción en bloque no devolvió todos los reportes")
+        except Exception as e:
+            print(f"Error guardando lote de reportes: {e}")
+            return [
+                {"indice": g["indice"], "success": False, "message": f"Error guardando reporte: {str(e)}"}
+                for g in generados
+            ]
+        
+        await self._generar_embeddings_reportes([
+            (fila['id'], g["request"].paciente_id, g["reporte"])
+            for g, fila in zip(generados, insertados)
+        ])
+        return [
+            {
+                "indice": g["indice"],
+                "success": True,
+                "reporte_id": fila['id'],
+                "numero_reporte": fila.get('numero_reporte'),
+                "confianza_ia": fila.get('confianza_ia'),
+                "tiempo_generacion": int(g["tiempo_generacion"]),
+                "modelo_usado": g["modelo_usado"]
+            }
+            for g, fila in zip(generados, insertados)
+        ]
 
 # ===================================
 # SERVICIO DE REPORTES
@@ -1041,7 +1458,7 @@ class ReporteService(DatabaseService):
         """Crear un nuevo reporte médico manualmente"""
         try:
             # Generar número de reporte
-            numero_result = self.supabase.rpc('generate_report_number').execute()
+            numero_result = await self.db.execute(self.supabase.rpc('generate_report_number'))
             numero_reporte = numero_result.data if numero_result.data else f"REP{int(time.time())}"
             
             reporte_dict = reporte_data.model_dump()
@@ -1050,7 +1467,7 @@ class ReporteService(DatabaseService):
             if reporte_dict.get('estudio_id'):
                 reporte_dict['estudio_id'] = str(reporte_dict['estudio_id'])
             
-            result = self.supabase.table('reportes').insert(reporte_dict).execute()
+            result = await self.db.execute(self.supabase.table('reportes').insert(reporte_dict))
             
             return BaseResponse(
                 success=True,
@@ -1065,9 +1482,15 @@ class ReporteService(DatabaseService):
         """Generar reporte usando IA"""
         return await self.ia_service.generar_reporte_con_ia(request)
     
-    async def generar_reporte_ia_streaming(self, request: ReportGenerationRequest):
+    async def generar_reporte_ia_streaming(self, request: ReportGenerationRequest,
+                                           http_request: Optional[Any] = None):
         """Generar reporte usando IA con streaming"""
-        return await self.ia_service.generar_reporte_con_ia_streaming(request)
+        return await self.ia_service.generar_reporte_con_ia_streaming(request, http_request)
+    
+    async def generar_reportes_lote(self, request: ReportBatchRequest,
+                                    http_request: Optional[Any] = None):
+        """Generar un lote de reportes usando IA (NDJSON)"""
+        return await self.ia_service.generar_reportes_lote(request, http_request)
     
     async def obtener_reportes(self, page: int = 1, limit: int = 10,
                               paciente_id: Optional[UUID] = None,
@@ -1088,7 +1511,7 @@ class ReporteService(DatabaseService):
             
             query = query.range(offset, offset + limit - 1).order('fecha_reporte', desc=True)
             
-            result = query.execute()
+            result = await self.db.execute(query)
             
             total = result.count if result.count else 0
             pages = ceil(total / limit) if total > 0 else 1
@@ -1113,9 +1536,9 @@ class ReporteService(DatabaseService):
     async def obtener_reporte(self, reporte_id: UUID) -> BaseResponse:
         """Obtener un reporte específico"""
         try:
-            result = self.supabase.table('reportes').select(
+            result = await self.db.execute(self.supabase.table('reportes').select(
                 '*,pacientes(nombre,apellido,numero_paciente),estudios(numero_estudio,tipo_estudio)'
-            ).eq('id', str(reporte_id)).execute()
+            ).eq('id', str(reporte_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -1147,7 +1570,7 @@ class ReporteService(DatabaseService):
                     data=None
                 )
             
-            result = self.supabase.table('reportes').update(update_data).eq('id', str(reporte_id)).execute()
+            result = await self.db.execute(self.supabase.table('reportes').update(update_data).eq('id', str(reporte_id)))
             
             if not result.data:
                 return BaseResponse(
@@ -1195,7 +1618,7 @@ class ReporteService(DatabaseService):
                 'hash_firma': hash_firma
             }
             
-            result = self.supabase.table('reportes').update(update_data).eq('id', str(reporte_id)).execute()
+            result = await self.db.execute(self.supabase.table('reportes').update(update_data).eq('id', str(reporte_id)))
             
             return BaseResponse(
                 success=True,
@@ -1209,7 +1632,7 @@ class ReporteService(DatabaseService):
     async def obtener_estadisticas(self) -> EstadisticasReportes:
         """Obtener estadísticas de reportes"""
         try:
-            result = self.supabase.from_('v_estadisticas_reportes').select('*').execute()
+            result = await self.db.execute(self.supabase.from_('v_estadisticas_reportes').select('*'))
             
             if result.data:
                 stats = result.data[0]
@@ -1253,6 +1676,14 @@ class ChatService(DatabaseService):
         super().__init__(supabase)
         self.ia_service = ia_service
         self.context_manager = get_context_manager(supabase)
+        # Mismo contador que usa el contexto para recortar (tokenizer o heurística)
+        self.token_counter = self.context_manager.token_counter if self.context_manager else get_token_counter()
+        # Resumen progresivo de los turnos que salen del contexto (CHAT_ROLLING_SUMMARY)
+        if (self.context_manager is not None and self.context_manager.summarizer is None
+                and os.environ.get("CHAT_ROLLING_SUMMARY", "true").lower() == "true"):
+            self.context_manager.summarizer = self._resumir_turnos
+        # Tamaño máximo del prompt de cada llamada de resumen (plantilla + resumen previo + turnos)
+        self.summary_prompt_tokens = int(os.environ.get("CHAT_SUMMARY_PROMPT_TOKENS", 3000))
     
     async def procesar_mensaje_chat(self, request: ChatRequest, user_id: str = "default_user") -> ChatResponse:
         """Procesar mensaje del chat y generar respuesta con IA usando gestión avanzada de contexto"""
@@ -1265,25 +1696,7 @@ class ChatService(DatabaseService):
             print(f"🏥 Especialidad: {request.especialidad}")
             
             # Obtener o crear conversación
-            conversacion_id = request.conversacion_id
-            if not conversacion_id:
-                print(f"🆕 Creando nueva conversación...")
-                # Crear nueva conversación
-                conversacion_data = ConversacionChatCreate(
-                    titulo=f"Consulta {request.especialidad.value}",
-                    especialidad=request.especialidad,
-                    usuario=user_id
-                )
-                
-                conv_result = await self.crear_conversacion(conversacion_data)
-                if not conv_result.success:
-                    print(f"❌ Error creando conversación: {conv_result.message}")
-                    raise Exception(f"No se pudo crear la conversación: {conv_result.message}")
-                
-                conversacion_id = UUID(conv_result.data['id'])
-                print(f"✅ Conversación creada con ID: {conversacion_id}")
-            else:
-                print(f"📋 Usando conversación existente: {conversacion_id}")
+            conversacion_id = await self._obtener_o_crear_conversacion(request, user_id)
             
             # Crear mensaje del usuario usando context manager
             mensaje_usuario = ChatMessage(
@@ -1300,8 +1713,32 @@ class ChatService(DatabaseService):
             )
             
             # Determinar si incluir contexto RAG
-            include_rag = any(keyword in request.mensaje.lower() 
-                            for keyword in ['similar', 'caso', 'antecedente', 'historial', 'previo'])
+            include_rag = self._requiere_rag(request.mensaje)
+            
+            # Caché semántica solo para el primer turno sin contexto específico del caso
+            cache_embedding = None
+            cache_namespace = f"{request.especialidad.value}|{request.idioma_usuario or 'es'}"
+            if (not request.conversacion_id and not include_rag
+                    and not request.archivos_adjuntos and not request.contexto_adicional):
+                cache_embedding = await self.ia_service.embedding_para_cache(
+                    'chat', request.mensaje, request.usar_cache
+                )
+            if cache_embedding is not None:
+                respuesta_cache = self.ia_service.response_cache.buscar('chat', cache_namespace, cache_embedding)
+                if respuesta_cache is not None:
+                    print(f"♻️ Respuesta servida desde caché semántica")
+                    await self.context_manager.add_message_to_context(
+                        conversacion_id,
+                        ChatMessage(role=RolChatEnum.ASSISTANT, content=respuesta_cache),
+                        user_id
+                    )
+                    return ChatResponse(
+                        respuesta=respuesta_cache,
+                        conversacion_id=conversacion_id,
+                        confianza=0.8,
+                        tiempo_respuesta=time.time() - start_time,
+                        modelo_usado=f"tgi-{MARCA_CACHE}"
+                    )
             
             print(f"🧠 Obteniendo contexto para IA (RAG: {include_rag})...")
             # Obtener contexto optimizado para IA
@@ -1312,38 +1749,10 @@ class ChatService(DatabaseService):
             )
             
             print(f"🤖 Generando respuesta con IA...")
-            # Generar respuesta con IA usando TGI
-            # Convertir mensajes al formato que espera la API
-            formatted_messages = []
-            for msg in messages:
-                formatted_messages.append({
-                    "role": msg.role.value,
-                    "content": msg.content
-                })
-            
-            # Agregar instrucción específica para español si no hay system prompt
-            if not formatted_messages or formatted_messages[0]["role"] != "system":
-                # Determinar el idioma del usuario
-                idioma_usuario = getattr(request, 'idioma_usuario', 'es') or 'es'
-                
-                # Crear prompt de sistema con instrucciones de idioma
-                idioma_instrucciones = {
-                    'es': "Eres un asistente médico IA. Responde SIEMPRE en español. Sé profesional y empático.",
-                    'en': "You are a medical AI assistant. Always respond in English. Be professional and empathetic.",
-                    'fr': "Vous êtes un assistant médical IA. Répondez TOUJOURS en français. Soyez professionnel et empathique.",
-                    'de': "Sie sind ein medizinischer KI-Assistent. Antworten Sie IMMER auf Deutsch. Seien Sie professionell und einfühlsam.",
-                    'pt': "Você é um assistente médico de IA. Sempre responda em português. Seja profissional e empático.",
-                    'it': "Sei un assistente medico IA. Rispondi SEMPRE in italiano. Sii professionale ed empatico."
-                }
-                
-                system_prompt = idioma_instrucciones.get(idioma_usuario, idioma_instrucciones['es'])
-                
-                formatted_messages.insert(0, {
-                    "role": "system",
-                    "content": system_prompt
-                })
+            formatted_messages = self._formatear_mensajes(messages, request)
+            tokens_prompt = self.token_counter.contar_mensajes(formatted_messages)
             
-            print(f"📝 Mensajes formateados para API: {len(formatted_messages)} mensajes")
+            print(f"📝 Mensajes formateados para API: {len(formatted_messages)} mensajes ({tokens_prompt} tokens)")
             
             tgi_request = {
                 "model": "tgi",
@@ -1353,24 +1762,31 @@ class ChatService(DatabaseService):
                 "stream": False
             }
             
-            print(f"📤 Enviando request a TGI: {self.ia_service.tgi_url}")
-            
             # API key para Hugging Face (en producción, usar variable de entorno)
             api_key = os.environ.get("HF_API_KEY", "hf_XXXXX")
             
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    f"{self.ia_service.tgi_url}/v1/chat/completions",
+            # La conversación vuelve a la misma réplica (caché de prefijos)
+            async with self.ia_service.scheduler.slot(PRIORIDAD_CHAT, "chat"):
+                print(f"📤 Enviando request a TGI (conversación {conversacion_id})")
+                response = await self.ia_service.tgi_upstream.post(
+                    "/v1/chat/completions",
+                    balancer=self.ia_service.tgi_balancer,
+                    clave=str(conversacion_id),
                     json=tgi_request,
                     headers={
                         "Content-Type": "application/json",
                         "Authorization": f"Bearer {api_key}"
                     }
                 )
-                response.raise_for_status()
+            response.raise_for_status()
             
             ai_response = response.json()
             respuesta_ia = ai_response['choices'][0]['message']['content']
+            # Tamaño real del prompt según TGI cuando lo informa
+            tokens_prompt = (ai_response.get('usage') or {}).get('prompt_tokens', tokens_prompt)
+            
+            if cache_embedding is not None:
+                self.ia_service.response_cache.guardar('chat', cache_namespace, cache_embedding, respuesta_ia)
             
             # Calcular tiempo de respuesta
             tiempo_respuesta = time.time() - start_time
@@ -1395,7 +1811,8 @@ class ChatService(DatabaseService):
                 conversacion_id=conversacion_id,
                 confianza=0.8,  # Calcular confianza real en producción
                 tiempo_respuesta=tiempo_respuesta,
-                modelo_usado="tgi"
+                modelo_usado="tgi",
+                tokens_prompt=tokens_prompt
             )
             
         except Exception as e:
@@ -1406,7 +1823,11 @@ class ChatService(DatabaseService):
             
             # Proporcionar mensaje de error más informativo
             error_message = "Lo siento, ha ocurrido un error. Por favor, intenta de nuevo."
-            if "permission denied" in str(e).lower():
+            if isinstance(e, ColaInferenciaLlenaError):
+                error_message = "El servicio de IA está saturado en este momento. Por favor, intenta de nuevo en unos segundos."
+            elif isinstance(e, CircuitoAbiertoError):
+                error_message = "El servicio de IA no está disponible temporalmente. Por favor, intenta de nuevo en unos segundos."
+            elif "permission denied" in str(e).lower():
                 error_message = "Error de permisos en la base de datos. Contacta al administrador."
             elif "no se pudo crear la conversación" in str(e).lower():
                 error_message = "Error al crear la conversación. Verifica la configuración de la base de datos."
@@ -1430,6 +1851,216 @@ class ChatService(DatabaseService):
                 modelo_usado=None
             )
     
+    async def procesar_mensaje_chat_streaming(self, request: ChatRequest, user_id: str = "default_user",
+                                              http_request: Optional[Any] = None):
+        """Procesar mensaje del chat devolviendo la respuesta de IA como SSE token a token"""
+        from fastapi.responses import StreamingResponse
+        
+        async def generate():
+            start_time = time.time()
+            respuesta_ia = ""
+            
+            try:
+                conversacion_id = await self._obtener_o_crear_conversacion(request, user_id)
+                await self.context_manager.add_message_to_context(
+                    conversacion_id,
+                    ChatMessage(role=RolChatEnum.USER, content=request.mensaje),
+                    user_id
+                )
+                # El cliente conoce la conversación antes del primer token
+                yield evento_sse({"conversacion_id": str(conversacion_id)})
+                
+                include_rag = self._requiere_rag(request.mensaje)
+                messages = await self.context_manager.get_context_for_ai(
+                    conversacion_id,
+                    include_rag=include_rag,
+                    rag_query=request.mensaje if include_rag else None
+                )
+                formatted_messages = self._formatear_mensajes(messages, request)
+                tokens_prompt = self.token_counter.contar_mensajes(formatted_messages)
+                tgi_request = {
+                    "model": "tgi",
+                    "messages": formatted_messages,
+                    "temperature": 0.7,
+                    "max_tokens": 1024,
+                    "stream": True
+                }
+                api_key = os.environ.get("HF_API_KEY", "hf_XXXXX")
+                
+                # Al salir del bloque (fin, desconexión o cancelación) se cierra el stream de TGI
+                async with self.ia_service.scheduler.slot(PRIORIDAD_CHAT, "chat"):
+                    async with self.ia_service.tgi_upstream.stream(
+                        "POST",
+                        "/v1/chat/completions",
+                        balancer=self.ia_service.tgi_balancer,
+                        clave=str(conversacion_id),
+                        json=tgi_request,
+                        headers={
+                            "Content-Type": "application/json",
+                            "Authorization": f"Bearer {api_key}"
+                        }
+                    ) as response:
+                        response.raise_for_status()
+                        async for content in iterar_contenido_tgi(response):
+                            if await cliente_desconectado(http_request):
+                                print(f"⚠️ Cliente desconectado, cancelando stream de chat {conversacion_id}")
+                                return
+                            respuesta_ia += content
+                            yield evento_sse({"content": content})
+                
+                # Persistir la respuesta completa en el contexto
+                await self.context_manager.add_message_to_context(
+                    conversacion_id,
+                    ChatMessage(role=RolChatEnum.ASSISTANT, content=respuesta_ia),
+                    user_id
+                )
+                yield evento_sse({
+                    "done": True,
+                    "conversacion_id": str(conversacion_id),
+                    "tiempo_respuesta": time.time() - start_time,
+                    "modelo_usado": "tgi",
+                    "tokens_prompt": tokens_prompt
+                })
+                yield evento_sse("[DONE]")
+                
+            except Exception as e:
+                print(f"❌ Error en chat IA (streaming): {e}")
+                yield evento_sse({"error": True, "message": f"Error generando respuesta: {str(e)}"})
+        
+        return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
+    
+    async def _resumir_turnos(self, resumen_previo: Optional[str], turnos: List[MensajeContexto]) -> str:
+        """Resumir turnos antiguos de la consulta (prioridad baja, fuera del camino crítico)
+
+        La transcripción se reparte en lotes que caben en CHAT_SUMMARY_PROMPT_TOKENS;
+        cada lote se integra en el resumen del anterior.
+        """
+        resumen = resumen_previo
+        for lote in self._lotes_resumen(resumen_previo, turnos):
+            resumen = await self._resumir_lote(resumen, lote)
+        return resumen or ""
+    
+    @staticmethod
+    def _prompt_resumen(resumen_previo: Optional[str], transcripcion: str) -> str:
+        return f"""Resume de forma concisa la siguiente parte de una consulta médica.
+Conserva todos los datos clínicos relevantes: síntomas, antecedentes, medicamentos y dosis,
+alergias, resultados de estudios, diagnósticos planteados y recomendaciones dadas.
+Integra el resumen previo si existe. Responde solo con el resumen, en español.
+
+RESUMEN PREVIO:
+{resumen_previo or "(ninguno)"}
+
+TURNOS A INCORPORAR:
+{transcripcion}"""
+    
+    def _lotes_resumen(self, resumen_previo: Optional[str], turnos: List[MensajeContexto]) -> List[str]:
+        """Transcripciones que, con la plantilla y el resumen previo, caben en el presupuesto"""
+        contar = self.token_counter.contar
+        # El resumen previo de cada lote es el generado por el anterior (como mucho summary_max_tokens)
+        previo = max(contar(resumen_previo) if resumen_previo else 0, self.context_manager.summary_max_tokens)
+        presupuesto = max(self.summary_prompt_tokens - contar(self._prompt_resumen(None, "")) - previo, 1)
+        
+        lotes: List[str] = []
+        lineas: List[str] = []
+        usados = 0
+        for m in turnos:
+            linea = f"{m.role.value.upper()}: {m.content}"
+            tokens = contar(linea)
+            if tokens > presupuesto:
+                # Un turno que por sí solo no cabe se trunca
+                linea = linea[:max(int(len(linea) * presupuesto / tokens) - 1, 1)]
+                while len(linea) > 1 and contar(linea) > presupuesto:
+                    linea = linea[:int(len(linea) * 0.9)]
+                tokens = contar(linea)
+            if lineas and usados + tokens > presupuesto:
+                lotes.append("\n".join(lineas))
+                lineas, usados = [], 0
+            lineas.append(linea)
+            usados += tokens
+        if lineas:
+            lotes.append("\n".join(lineas))
+        return lotes
+    
+    async def _resumir_lote(self, resumen_previo: Optional[str], transcripcion: str) -> str:
+        tgi_request = {
+            "model": "tgi",
+            "messages": [{"role": "user", "content": self._prompt_resumen(resumen_previo, transcripcion)}],
+            "temperature": 0.2,
+            "max_tokens": self.context_manager.summary_max_tokens,
+            "stream": False
+        }
+        api_key = os.environ.get("HF_API_KEY", "hf_XXXXX")
+        
+        async with self.ia_service.scheduler.slot(PRIORIDAD_LOTE, "resumen"):
+            response = await self.ia_service.tgi_upstream.post(
+                "/v1/chat/completions",
+                balancer=self.ia_service.tgi_balancer,
+                json=tgi_request,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {api_key}"
+                }
+            )
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content'].strip()
+    
+    @staticmethod
+    def _requiere_rag(mensaje: str) -> bool:
+        """El mensaje pide casos o antecedentes (activar contexto RAG)"""
+        return any(keyword in mensaje.lower()
+                   for keyword in ['similar', 'caso', 'antecedente', 'historial', 'previo'])
+    
+    async def _obtener_o_crear_conversacion(self, request: ChatRequest, user_id: str) -> UUID:
+        """Usar la conversación de la solicitud o crear una nueva"""
+        conversacion_id = request.conversacion_id
+        if not conversacion_id:
+            print(f"🆕 Creando nueva conversación...")
+            # Crear nueva conversación
+            conversacion_data = ConversacionChatCreate(
+                titulo=f"Consulta {request.especialidad.value}",
+                especialidad=request.especialidad,
+                usuario=user_id
+            )
+        
+            conv_result = await self.crear_conversacion(conversacion_data)
+            if not conv_result.success:
+                print(f"❌ Error creando conversación: {conv_result.message}")
+                raise Exception(f"No se pudo crear la conversación: {conv_result.message}")
+        
+            conversacion_id = UUID(conv_result.data['id'])
+            print(f"✅ Conversación creada con ID: {conversacion_id}")
+        else:
+            print(f"📋 Usando conversación existente: {conversacion_id}")
+        return conversacion_id
+    
+    def _formatear_mensajes(self, messages: List[MensajeContexto], request: ChatRequest) -> List[Dict[str, str]]:
+        """Convertir el contexto al formato de TGI, con prompt de sistema de idioma"""
+        # Los diccionarios de la API se crean solo aquí, al armar el payload
+        formatted_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
+        
+        # Agregar instrucción específica para español si no hay system prompt
+        if not formatted_messages or formatted_messages[0]["role"] != "system":
+            # Determinar el idioma del usuario
+            idioma_usuario = getattr(request, 'idioma_usuario', 'es') or 'es'
+        
+            # Crear prompt de sistema con instrucciones de idioma
+            idioma_instrucciones = {
+                'es': "Eres un asistente médico IA. Responde SIEMPRE en español. Sé profesional y empático.",
+                'en': "You are a medical AI assistant. Always respond in English. Be professional and empathetic.",
+                'fr': "Vous êtes un assistant médical IA. Répondez TOUJOURS en français. Soyez professionnel et empathique.",
+                'de': "Sie sind ein medizinischer KI-Assistent. Antworten Sie IMMER auf Deutsch. Seien Sie professionell und einfühlsam.",
+                'pt': "Você é um assistente médico de IA. Sempre responda em português. Seja profissional e empático.",
+                'it': "Sei un assistente medico IA. Rispondi SEMPRE in italiano. Sii professionale ed empatico."
+            }
+        
+            system_prompt = idioma_instrucciones.get(idioma_usuario, idioma_instrucciones['es'])
+        
+            formatted_messages.insert(0, {
+                "role": "system",
+                "content": system_prompt
+            })
+        return formatted_messages
+    
     def _generar_prompt_especialidad(self, especialidad: EspecialidadEnum) -> str:
         """Generar prompt especializado según la especialidad médica"""
         prompts = {
@@ -1484,7 +2115,7 @@ class ChatService(DatabaseService):
             
             # Verificar que la tabla existe y es accesible
             try:
-                test_query = self.supabase.table('conversaciones_chat').select('count').limit(1).execute()
+                test_query = await self.db.execute(self.supabase.table('conversaciones_chat').select('count').limit(1))
                 print(f"✅ Tabla conversaciones_chat accesible")
             except Exception as table_error:
                 print(f"❌ Error accediendo a tabla conversaciones_chat: {table_error}")
@@ -1499,7 +2130,7 @@ class ChatService(DatabaseService):
             print(f"📝 Datos preparados: {conversacion_dict}")
             
             # Insertar en base de datos
-            result = self.supabase.table('conversaciones_chat').insert(conversacion_dict).execute()
+            result = await self.db.execute(self.supabase.table('conversaciones_chat').insert(conversacion_dict))
             
             if not result.data:
                 print(f"❌ No se recibieron datos de la inserción")
@@ -1544,7 +2175,7 @@ class ChatService(DatabaseService):
             mensaje_dict = mensaje_data.model_dump()
             mensaje_dict['conversacion_id'] = str(conversacion_id)
             
-            result = self.supabase.table('mensajes_chat').insert(mensaje_dict).execute()
+            result = await self.db.execute(self.supabase.table('mensajes_chat').insert(mensaje_dict))
             
             return BaseResponse(
                 success=True,
@@ -1567,7 +2198,7 @@ class ChatService(DatabaseService):
             
             query = query.range(offset, offset + limit - 1).order('updated_at', desc=True)
             
-            result = query.execute()
+            result = await self.db.execute(query)
             
             total = result.count if result.count else 0
             pages = ceil(total / limit) if total > 0 else 1
@@ -1589,18 +2220,41 @@ class ChatService(DatabaseService):
                 pages=1
             )
     
-    async def obtener_historial_conversacion(self, conversacion_id: UUID) -> List[Dict]:
-        """Obtener historial de mensajes de una conversación"""
+    async def obtener_historial_conversacion(
+        self,
+        conversacion_id: UUID,
+        limit: int = 100,
+        cursor: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Obtener historial de mensajes de una conversación
+        
+        Devuelve los `limit` mensajes más recientes (o los anteriores a `cursor`)
+        en orden cronológico y `next_cursor` para pedir los anteriores.
+        """
         try:
-            result = self.supabase.table('mensajes_chat').select('*').eq(
-                'conversacion_id', str(conversacion_id)
-            ).order('timestamp_mensaje', desc=False).execute()
+            filas, next_cursor = await consultar_mensajes_recientes(
+                self.db, self.supabase, conversacion_id, limit, cursor, columnas=COLUMNAS_HISTORIAL
+            )
+            filas.reverse()
             
-            return result.data or []
+            return {
+                "success": True,
+                "data": filas,
+                "next_cursor": next_cursor,
+                "has_more": next_cursor is not None
+            }
             
+        except ValueError as e:
+            return {"success": False, "message": str(e), "data": [], "next_cursor": None, "has_more": False}
         except Exception as e:
             print(f"Error obteniendo historial: {e}")
-            return []
+            return {
+                "success": False,
+                "message": f"Error obteniendo historial: {str(e)}",
+                "data": [],
+                "next_cursor": None,
+                "has_more": False
+            }
     
     async def obtener_sesiones_activas_usuario(self, user_id: str) -> Dict[str, Any]:
         """Obtener todas las sesiones activas de un usuario"""
@@ -1626,10 +2280,11 @@ class ChatService(DatabaseService):
         """Obtener estadísticas del sistema de contexto"""
         try:
             cache_stats = {
-                "conversations_in_cache": len(self.context_manager.cache.cache),
-                "max_cache_size": self.context_manager.cache.max_size,
-                "cache_utilization": len(self.context_manager.cache.cache) / self.context_manager.cache.max_size,
-                "active_users": len(self.context_manager.cache.user_conversations)
+                **await self.context_manager.cache.get_stats(),
+                "token_counter": self.token_counter.get_stats(),
+                "summaries": self.context_manager.summary_stats,
+                "persistence": self.context_manager.persistencia.get_stats(),
+                "snapshot": self.context_manager.snapshot_stats
             }
             
             return {
@@ -1651,8 +2306,9 @@ class ChatService(DatabaseService):
 class OrdenCompraService:
     """Servicio para gestión de órdenes de compra"""
     
-    def __init__(self, supabase: Client):
+    def __init__(self, supabase: Client, db: Optional[SupabaseExecutor] = None):
         self.supabase = supabase
+        self.db = db or get_db_executor()
     
     def handle_db_error(self, error) -> Dict[str, Any]:
         """Manejo estándar de errores de base de datos"""
@@ -1667,12 +2323,12 @@ class OrdenCompraService:
         else:
             return {"success": False, "message": f"Error de base de datos: {str(error)}"}
     
-    def generar_numero_orden(self) -> str:
+    async def generar_numero_orden(self) -> str:
         """Generar número de orden secuencial"""
         try:
-            result = self.supabase.table('ordenes_compra').select('numero_orden').order(
+            result = await self.db.execute(self.supabase.table('ordenes_compra').select('numero_orden').order(
                 'numero_orden', desc=True
-            ).limit(1).execute()
+            ).limit(1))
             
             if result.data:
                 ultimo_numero = result.data[0]['numero_orden']
@@ -1696,14 +2352,14 @@ class OrdenCompraService:
             # Preparar datos de la orden
             orden_dict = orden_data.model_dump(exclude={'detalles'})
             orden_dict.update({
-                'numero_orden': self.generar_numero_orden(),
+                'numero_orden': await self.generar_numero_orden(),
                 'total_orden': total_orden,
                 'iva': iva,
                 'total_con_iva': total_con_iva
             })
             
             # Insertar orden
-            result = self.supabase.table('ordenes_compra').insert(orden_dict).execute()
+            result = await self.db.execute(self.supabase.table('ordenes_compra').insert(orden_dict))
             
             if not result.data:
                 raise Exception("Error al crear la orden")
@@ -1718,7 +2374,7 @@ class OrdenCompraService:
                     'subtotal': detalle.cantidad * detalle.precio_unitario
                 })
                 
-                self.supabase.table('orden_detalles').insert(detalle_dict).execute()
+                await self.db.execute(self.supabase.table('orden_detalles').insert(detalle_dict))
             
             return BaseResponse(
                 success=True,
@@ -1761,7 +2417,7 @@ class OrdenCompraService:
             
             # Ejecutar query con paginación
             query = query.range(offset, offset + limit - 1).order('created_at', desc=True)
-            result = query.execute()
+            result = await self.db.execute(query)
             
             total = result.count if result.count else 0
             pages = ceil(total / limit) if total > 0 else 1
@@ -1787,9 +2443,9 @@ class OrdenCompraService:
         """Obtener una orden específica con sus detalles"""
         try:
             # Obtener orden
-            result = self.supabase.table('ordenes_compra').select('*').eq(
+            result = await self.db.execute(self.supabase.table('ordenes_compra').select('*').eq(
                 'id', str(orden_id)
-            ).execute()
+            ))
             
             if not result.data:
                 return BaseResponse(success=False, message="Orden no encontrada")
@@ -1797,9 +2453,9 @@ class OrdenCompraService:
             orden = result.data[0]
             
             # Obtener detalles de la orden
-            detalles_result = self.supabase.table('orden_detalles').select(
+            detalles_result = await self.db.execute(self.supabase.table('orden_detalles').select(
                 '*, inventarios(nombre_item, unidad_medida)'
-            ).eq('orden_id', str(orden_id)).execute()
+            ).eq('orden_id', str(orden_id)))
             
             orden['detalles'] = detalles_result.data or []
             
@@ -1831,7 +2487,7 @@ class OrdenCompraService:
                 })
                 
                 # Eliminar detalles existentes
-                self.supabase.table('orden_detalles').delete().eq('orden_id', str(orden_id)).execute()
+                await self.db.execute(self.supabase.table('orden_detalles').delete().eq('orden_id', str(orden_id)))
                 
                 # Insertar nuevos detalles
                 for detalle in orden_data.detalles:
@@ -1841,12 +2497,12 @@ class OrdenCompraService:
                         'subtotal': detalle.cantidad * detalle.precio_unitario
                     })
                     
-                    self.supabase.table('orden_detalles').insert(detalle_dict).execute()
+                    await self.db.execute(self.supabase.table('orden_detalles').insert(detalle_dict))
             
             # Actualizar orden
-            result = self.supabase.table('ordenes_compra').update(update_data).eq(
+            result = await self.db.execute(self.supabase.table('ordenes_compra').update(update_data).eq(
                 'id', str(orden_id)
-            ).execute()
+            ))
             
             if not result.data:
                 return BaseResponse(success=False, message="Orden no encontrada")
@@ -1864,9 +2520,9 @@ class OrdenCompraService:
         """Eliminar una orden de compra"""
         try:
             # Verificar que la orden existe y no está aprobada/enviada
-            result = self.supabase.table('ordenes_compra').select('estado').eq(
+            result = await self.db.execute(self.supabase.table('ordenes_compra').select('estado').eq(
                 'id', str(orden_id)
-            ).execute()
+            ))
             
             if not result.data:
                 return BaseResponse(success=False, message="Orden no encontrada")
@@ -1879,9 +2535,9 @@ class OrdenCompraService:
                 )
             
             # Eliminar orden (los detalles se eliminan por CASCADE)
-            delete_result = self.supabase.table('ordenes_compra').delete().eq(
+            delete_result = await self.db.execute(self.supabase.table('ordenes_compra').delete().eq(
                 'id', str(orden_id)
-            ).execute()
+            ))
             
             if not delete_result.data:
                 return BaseResponse(success=False, message="Error al eliminar la orden")
@@ -1898,7 +2554,7 @@ class OrdenCompraService:
         """Obtener estadísticas de órdenes de compra"""
         try:
             # Obtener conteos por estado
-            result = self.supabase.table('ordenes_compra').select('estado, total_orden').execute()
+            result = await self.db.execute(self.supabase.table('ordenes_compra').select('estado, total_orden'))
             
             if not result.data:
                 return EstadisticasOrdenes(
@@ -1969,7 +2625,7 @@ class PersonalService(DatabaseService):
                 'updated_at': datetime.now().isoformat()
             })
             
-            result = self.supabase.table(self.table).insert(empleado_dict).execute()
+            result = await self.db.execute(self.supabase.table(self.table).insert(empleado_dict))
             
             if result.data and len(result.data) > 0:
                 return BaseResponse(
@@ -2001,11 +2657,11 @@ class PersonalService(DatabaseService):
                 query = query.or_(f"nombre.ilike.%{search}%,apellido.ilike.%{search}%,puesto.ilike.%{search}%,departamento.ilike.%{search}%")
             
             # Obtener total de registros
-            count_result = query.execute()
+            count_result = await self.db.execute(query)
             total = len(count_result.data) if count_result.data else 0
             
             # Obtener datos paginados
-            result = query.range(offset, offset + limit - 1).order('created_at', desc=True).execute()
+            result = await self.db.execute(query.range(offset, offset + limit - 1).order('created_at', desc=True))
             
             pages = ceil(total / limit)
             
@@ -2030,7 +2686,7 @@ class PersonalService(DatabaseService):
     async def obtener_empleado(self, empleado_id: UUID) -> dict:
         """Obtener empleado específico"""
         try:
-            result = self.supabase.table(self.table).select("*").eq('id', str(empleado_id)).execute()
+            result = await self.db.execute(self.supabase.table(self.table).select("*").eq('id', str(empleado_id)))
             
             if result.data and len(result.data) > 0:
                 return BaseResponse(
@@ -2058,7 +2714,7 @@ class PersonalService(DatabaseService):
             update_data = {k: v for k, v in personal_data.model_dump().items() if v is not None}
             update_data['updated_at'] = datetime.now().isoformat()
             
-            result = self.supabase.table(self.table).update(update_data).eq('id', str(empleado_id)).execute()
+            result = await self.db.execute(self.supabase.table(self.table).update(update_data).eq('id', str(empleado_id)))
             
             if result.data and len(result.data) > 0:
                 return BaseResponse(
@@ -2082,10 +2738,10 @@ class PersonalService(DatabaseService):
     async def eliminar_empleado(self, empleado_id: UUID) -> dict:
         """Eliminar empleado (soft delete cambiando estado a Inactivo)"""
         try:
-            result = self.supabase.table(self.table).update({
+            result = await self.db.execute(self.supabase.table(self.table).update({
                 'estado': EstadoPersonalEnum.INACTIVO.value,
                 'updated_at': datetime.now().isoformat()
-            }).eq('id', str(empleado_id)).execute()
+            }).eq('id', str(empleado_id)))
             
             if result.data and len(result.data) > 0:
                 return BaseResponse(
@@ -2109,7 +2765,7 @@ class PersonalService(DatabaseService):
         """Obtener estadísticas del personal"""
         try:
             # Obtener todos los empleados
-            result = self.supabase.table(self.table).select("*").execute()
+            result = await self.db.execute(self.supabase.table(self.table).select("*"))
             empleados = result.data or []
             
             # Calcular estadísticas
@@ -2161,9 +2817,9 @@ class PersonalService(DatabaseService):
         """Buscar empleados por término de búsqueda"""
         try:
             search_lower = query.lower()
-            result = self.supabase.table(self.table).select("*").or_(
+            result = await self.db.execute(self.supabase.table(self.table).select("*").or_(
                 f"nombre.ilike.%{query}%,apellido.ilike.%{query}%,puesto.ilike.%{query}%,departamento.ilike.%{query}%,especialidad.ilike.%{query}%"
-            ).execute()
+            ))
             
             return BaseResponse(
                 success=True,
@@ -2182,10 +2838,10 @@ class PersonalService(DatabaseService):
     async def actualizar_actividad(self, empleado_id: UUID) -> dict:
         """Actualizar última actividad del empleado"""
         try:
-            result = self.supabase.table(self.table).update({
+            result = await self.db.execute(self.supabase.table(self.table).update({
                 'ultima_actividad': datetime.now().isoformat(),
                 'updated_at': datetime.now().isoformat()
-            }).eq('id', str(empleado_id)).execute()
+            }).eq('id', str(empleado_id)))
             
             return BaseResponse(
                 success=True,
@@ -0,0 +1,63 @@
+# streaming.py - Radix IA
+"""
+Utilidades para respuestas en streaming (Server-Sent Events) sobre TGI.
+
+- `evento_sse`: formatear un evento SSE
+- `iterar_contenido_tgi`: extraer los fragmentos de texto de un stream
+  `/v1/chat/completions` de TGI
+- `cliente_desconectado`: detectar que el cliente cerró la conexión para
+  abortar la generación en el upstream
+- `linea_ndjson`: formatear una línea de una respuesta NDJSON (lotes)
+"""
+
+import json
+from typing import Any, AsyncIterator, Optional
+
+import httpx
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "*",
+}
+
+
+def evento_sse(payload: Any) -> str:
+    """Formatear un evento SSE (`data: ...`)"""
+    data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+    return f"data: {data}\n\n"
+
+
+def linea_ndjson(payload: Any) -> str:
+    """Formatear una línea NDJSON (un objeto JSON por línea)"""
+    return json.dumps(payload, ensure_ascii=False, default=str) + "\n"
+
+
+async def iterar_contenido_tgi(response: httpx.Response) -> AsyncIterator[str]:
+    """Texto incremental (delta.content) de un stream de TGI hasta [DONE]"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data: "):
+            continue
+        data_str = line[6:].strip()
+        if data_str == "[DONE]":
+            return
+        try:
+            data = json.loads(data_str)
+        except json.JSONDecodeError:
+            continue
+        choices = data.get("choices") or []
+        if choices:
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                yield content
+
+
+async def cliente_desconectado(http_request: Optional[Any]) -> bool:
+    """True si el cliente HTTP (Starlette Request) ya cerró la conexión"""
+    if http_request is None:
+        return False
+    try:
+        return await http_request.is_disconnected()
+    except Exception:
+        return False
@@ -4,15 +4,20 @@ Configuración de fixtures para los tests de Radix IA
 """
 
 import pytest
+import pytest_asyncio
 import asyncio
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, AsyncMock
 import os
 import sys
+import tempfile
 
 # Agregar el directorio padre al path para importar los módulos
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# Los mensajes que no se pudieron persistir van a un directorio temporal, nunca al repo
+os.environ["CHAT_PERSIST_DEAD_LETTER"] = os.path.join(tempfile.mkdtemp(), "mensajes_chat_pendientes.jsonl")
+
 from main import app
 from services import PacienteService, EstudioService, ReporteService, ChatService, IAService
 
@@ -28,6 +33,19 @@ def client():
     """Cliente de test para FastAPI"""
     return TestClient(app)
 
+@pytest_asyncio.fixture
+async def al_cerrar():
+    """Registrar objetos con `close()` asíncrono (gestores de contexto, colas) para cerrarlos al terminar el test"""
+    registrados = []
+    
+    def registrar(objeto):
+        registrados.append(objeto)
+        return objeto
+    
+    yield registrar
+    for objeto in reversed(registrados):
+        await objeto.close()
+
 @pytest.fixture
 def mock_supabase():
     """Mock del cliente Supabase"""
@@ -131,4 +149,36 @@ def chat_request_ejemplo():
         "mensaje": "¿Cuáles son los síntomas de la neumonía?",
         "especialidad": "General",
         "contexto_adicional": "Paciente con fiebre"
-    }
\ No newline at end of file
+    }
+
+
+class FakeTGIStream:
+    """Respuesta en streaming de TGI (async context manager de httpx)"""
+    
+    status_code = 200
+    
+    def __init__(self, tokens):
+        self.lineas = [
+            'data: {"choices": [{"delta": {"content": "%s"}}]}' % token for token in tokens
+        ] + ["data: [DONE]"]
+        self.lineas_leidas = 0
+        self.cerrado = False
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        self.cerrado = True
+    
+    def raise_for_status(self):
+        return None
+    
+    async def aiter_lines(self):
+        for linea in self.lineas:
+            self.lineas_leidas += 1
+            yield linea
+
+@pytest.fixture
+def fake_tgi_stream():
+    """Fábrica de streams de TGI simulados a partir de una lista de tokens"""
+    return FakeTGIStream
@@ -145,8 +145,8 @@ class TestChatService:
         
         chat_service.obtener_historial_conversacion = mock_obtener_historial
         
-        # Mock para la respuesta de IA
-        with patch('httpx.AsyncClient') as mock_client:
+        # Mock para la respuesta de IA (cliente HTTP compartido)
+        with patch.object(chat_service.ia_service.http_clients, 'client') as mock_client:
             mock_response = Mock()
             mock_response.json.return_value = {
                 "choices": [
@@ -159,7 +159,7 @@ class TestChatService:
             }
             mock_response.raise_for_status.return_value = None
             
-            mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+            mock_client.return_value.post = AsyncMock(return_value=mock_response)
             
             result = await chat_service.procesar_mensaje_chat(request)
             
@@ -167,6 +167,130 @@ class TestChatService:
             assert result.conversacion_id is not None
             assert result.tiempo_respuesta is not None
     
+    @pytest.mark.asyncio
+    async def test_primer_turno_repetido_usa_cache_semantica(self, chat_service):
+        """Test que una pregunta de primer turno repetida no vuelve a llamar a TGI"""
+        from semantic_cache import SemanticResponseCache
+        from models import ChatMessage
+        
+        async def mock_crear_conversacion(data):
+            return type('obj', (object,), {'success': True, 'data': {'id': str(uuid4())}})
+        
+        chat_service.crear_conversacion = mock_crear_conversacion
+        chat_service.context_manager = Mock()
+        chat_service.context_manager.add_message_to_context = AsyncMock()
+        chat_service.context_manager.get_context_for_ai = AsyncMock(
+            return_value=[ChatMessage(role="user", content="¿Qué es una neumonía?")]
+        )
+        chat_service.ia_service.response_cache = SemanticResponseCache(threshold=0.95)
+        chat_service.ia_service.embedding_service.encode = AsyncMock(return_value=[0.3, 0.4, 0.5])
+        
+        with patch.object(chat_service.ia_service.http_clients, 'client') as mock_client:
+            mock_response = Mock()
+            mock_response.json.return_value = {
+                "choices": [{"message": {"content": "La neumonía es una infección pulmonar..."}}]
+            }
+            mock_response.raise_for_status.return_value = None
+            mock_client.return_value.post = AsyncMock(return_value=mock_response)
+            
+            request = ChatRequest(mensaje="¿Qué es una neumonía?", especialidad="General")
+            primera = await chat_service.procesar_mensaje_chat(request)
+            segunda = await chat_service.procesar_mensaje_chat(request)
+            sin_cache = await chat_service.procesar_mensaje_chat(
+                ChatRequest(mensaje="¿Qué es una neumonía?", especialidad="General", usar_cache=False)
+            )
+            
+            assert primera.modelo_usado == "tgi"
+            assert segunda.modelo_usado == "tgi-cache-semantica"
+            assert segunda.respuesta == primera.respuesta
+            assert sin_cache.modelo_usado == "tgi"
+            assert mock_client.return_value.post.await_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_procesar_mensaje_chat_streaming(self, chat_service, fake_tgi_stream):
+        """Test que el streaming emite tokens y persiste la respuesta completa"""
+        from models import ChatMessage
+        
+        upstream = fake_tgi_stream(["La neumonía ", "es una infección."])
+        conversacion_id = uuid4()
+        chat_service._obtener_o_crear_conversacion = AsyncMock(return_value=conversacion_id)
+        chat_service.context_manager = Mock()
+        chat_service.context_manager.add_message_to_context = AsyncMock()
+        chat_service.context_manager.get_context_for_ai = AsyncMock(
+            return_value=[ChatMessage(role="user", content="¿Qué es una neumonía?")]
+        )
+        
+        with patch.object(chat_service.ia_service.http_clients, 'client') as mock_client:
+            mock_client.return_value.stream = Mock(return_value=upstream)
+            response = await chat_service.procesar_mensaje_chat_streaming(
+                ChatRequest(mensaje="¿Qué es una neumonía?")
+            )
+            eventos = [e async for e in response.body_iterator]
+        
+        assert str(conversacion_id) in eventos[0]
+        assert any("La neumonía" in e for e in eventos)
+        assert eventos[-1] == "data: [DONE]\n\n"
+        assert upstream.cerrado
+        respuesta = chat_service.context_manager.add_message_to_context.await_args_list[-1].args[1]
+        assert respuesta.content == "La neumonía es una infección."
+    
+    @pytest.mark.asyncio
+    async def test_streaming_cancela_upstream_si_cliente_se_desconecta(self, chat_service, fake_tgi_stream):
+        """Test que una desconexión cierra el stream de TGI sin persistir respuesta parcial"""
+        from models import ChatMessage
+        
+        upstream = fake_tgi_stream(["uno ", "dos ", "tres"])
+        chat_service._obtener_o_crear_conversacion = AsyncMock(return_value=uuid4())
+        chat_service.context_manager = Mock()
+        chat_service.context_manager.add_message_to_context = AsyncMock()
+        chat_service.context_manager.get_context_for_ai = AsyncMock(
+            return_value=[ChatMessage(role="user", content="hola")]
+        )
+        http_request = Mock()
+        http_request.is_disconnected = AsyncMock(side_effect=[False, True, True])
+        
+        with patch.object(chat_service.ia_service.http_clients, 'client') as mock_client:
+            mock_client.return_value.stream = Mock(return_value=upstream)
+            response = await chat_service.procesar_mensaje_chat_streaming(
+                ChatRequest(mensaje="hola"), http_request=http_request
+            )
+            eventos = [e async for e in response.body_iterator]
+        
+        assert upstream.cerrado
+        assert upstream.lineas_leidas < 4
+        assert not any("[DONE]" in e for e in eventos)
+        # Solo se persistió el mensaje del usuario
+        assert chat_service.context_manager.add_message_to_context.await_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_resumen_por_lotes_dentro_del_presupuesto(self, chat_service):
+        """Test que una transcripción larga se resume en varias llamadas que caben en el prompt"""
+        from context_manager import MensajeContexto
+        from models import RolChatEnum
+        
+        chat_service.summary_prompt_tokens = 600
+        turnos = [
+            MensajeContexto(RolChatEnum.USER, f"turno {i}: " + "dolor torácico opresivo " * 20)
+            for i in range(40)
+        ]
+        respuestas = []
+        for i in range(40):
+            respuesta = Mock()
+            respuesta.json.return_value = {"choices": [{"message": {"content": f"resumen {i}"}}]}
+            respuestas.append(respuesta)
+        
+        with patch.object(chat_service.ia_service.http_clients, 'client') as mock_client:
+            mock_client.return_value.post = AsyncMock(side_effect=respuestas)
+            resumen = await chat_service._resumir_turnos(None, turnos)
+            llamadas = mock_client.return_value.post.await_args_list
+        
+        assert len(llamadas) > 1
+        assert resumen == f"resumen {len(llamadas) - 1}"
+        prompts = [c.kwargs["json"]["messages"][0]["content"] for c in llamadas]
+        assert all(chat_service.token_counter.contar(p) <= 600 for p in prompts)
+        assert "resumen 0" in prompts[1]
+        assert "turno 39" in prompts[-1]
+    
     @pytest.mark.asyncio
     async def test_crear_conversacion_service(self, chat_service):
         """Test crear conversación en el servicio"""
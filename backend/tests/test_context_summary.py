@@ -0,0 +1,109 @@
+# tests/test_context_summary.py
+"""
+Tests para el resumen progresivo de conversaciones en el gestor de contexto
+"""
+
+import asyncio
+from unittest.mock import AsyncMock, Mock
+from uuid import uuid4
+
+import pytest
+import pytest_asyncio
+
+from context_manager import ContextManager
+from models import ChatMessage, RolChatEnum
+from token_counter import TokenCounter
+
+class PalabrasCounter(TokenCounter):
+    """Un token por palabra, sin plantilla de chat"""
+    
+    def __init__(self):
+        super().__init__(tokens_por_mensaje=0)
+    
+    def _contar(self, texto):
+        return len(texto.split())
+
+# Gestores creados por el test en curso (se cierran al terminar)
+_gestores = []
+
+def gestor(summarizer, summary_max_tokens=5):
+    db = Mock()
+    db.execute = AsyncMock(return_value=Mock(data=[]))
+    manager = ContextManager(
+        Mock(), db=db, token_counter=PalabrasCounter(),
+        summarizer=summarizer, summary_max_tokens=summary_max_tokens
+    )
+    _gestores.append(manager)
+    return manager
+
+@pytest_asyncio.fixture(autouse=True)
+async def cerrar_gestores():
+    """Cerrar los gestores del test: vacía la persistencia y detiene sus tareas"""
+    yield
+    while _gestores:
+        await _gestores.pop().close()
+
+class TestResumenProgresivo:
+    """Tests para el modo de resumen progresivo"""
+    
+    @pytest.mark.asyncio
+    async def test_turnos_recortados_pasan_al_resumen(self):
+        """Test que los turnos que salen del contexto se resumen tras el system prompt"""
+        summarizer = AsyncMock(return_value="Paciente con tos y fiebre")
+        manager = gestor(summarizer)
+        conv_id = uuid4()
+        
+        context = await manager.add_message_to_context(
+            conv_id, ChatMessage(role=RolChatEnum.USER, content="tengo tos desde hace tres días"), "u1"
+        )
+        context.context_window = context._system_prompt_tokens() + context.summary_max_tokens + 8
+        for texto in ["¿fiebre?", "sí, treinta y ocho grados", "¿qué tomo para la fiebre?"]:
+            await manager.add_message_to_context(conv_id, ChatMessage(role=RolChatEnum.USER, content=texto), "u1")
+        await asyncio.sleep(0)
+        
+        previo, turnos = summarizer.await_args.args
+        assert previo is None
+        assert turnos[0].content == "tengo tos desde hace tres días"
+        
+        messages = context.get_context_messages()
+        assert messages[0].role == RolChatEnum.SYSTEM
+        assert "Paciente con tos y fiebre" in messages[1].content
+        assert messages[-1].content == "¿qué tomo para la fiebre?"
+        assert manager.summary_stats["generados"] >= 1
+    
+    @pytest.mark.asyncio
+    async def test_error_del_resumen_conserva_turnos(self):
+        """Test que un fallo del resumen no pierde los turnos pendientes"""
+        manager = gestor(AsyncMock(side_effect=RuntimeError("TGI no disponible")))
+        conv_id = uuid4()
+        
+        context = await manager.add_message_to_context(
+            conv_id, ChatMessage(role=RolChatEnum.USER, content="uno dos tres"), "u1"
+        )
+        context.context_window = context._system_prompt_tokens() + context.summary_max_tokens + 4
+        await manager.add_message_to_context(conv_id, ChatMessage(role=RolChatEnum.USER, content="cuatro cinco"), "u1")
+        await manager.add_message_to_context(conv_id, ChatMessage(role=RolChatEnum.USER, content="seis siete"), "u1")
+        await asyncio.sleep(0)
+        
+        assert context.summary is None
+        assert [m.content for m in context.pending_summary] == ["uno dos tres"]
+        assert manager.summary_stats["errores"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_resumen_actualiza_bytes_de_la_cache(self):
+        """Test que publicar el resumen recalcula el tamaño del contexto en la caché"""
+        manager = gestor(AsyncMock(return_value="resumen clínico " * 200))
+        conv_id = uuid4()
+        
+        context = await manager.add_message_to_context(
+            conv_id, ChatMessage(role=RolChatEnum.USER, content="uno dos tres"), "u1"
+        )
+        context.context_window = context._system_prompt_tokens() + context.summary_max_tokens + 4
+        for texto in ["cuatro cinco", "seis siete"]:
+            await manager.add_message_to_context(conv_id, ChatMessage(role=RolChatEnum.USER, content=texto), "u1")
+        await asyncio.gather(*manager._summary_tasks.values())
+        
+        shard = manager.cache._shard(conv_id)
+        assert context.summary
+        assert shard.sizes[conv_id] == context.estimated_bytes()
+        assert shard.bytes == sum(shard.sizes.values())
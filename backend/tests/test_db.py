@@ -0,0 +1,69 @@
+# tests/test_db.py
+"""
+Tests para el ejecutor no bloqueante de queries de Supabase
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+from unittest.mock import Mock
+
+from db import SupabaseExecutor, DatabaseSaturadaError
+
+class TestSupabaseExecutor:
+    """Tests para SupabaseExecutor"""
+    
+    @pytest.mark.asyncio
+    async def test_execute_en_pool_de_hilos(self):
+        """Test que execute() corre la query fuera del hilo del event loop"""
+        executor = SupabaseExecutor(max_workers=2, max_pending=4)
+        hilo_loop = threading.get_ident()
+        hilos = []
+        
+        query = Mock()
+        query.execute.side_effect = lambda: hilos.append(threading.get_ident()) or Mock(data=[{"id": "1"}])
+        
+        result = await executor.execute(query)
+        
+        assert result.data == [{"id": "1"}]
+        assert hilos and hilos[0] != hilo_loop
+        assert executor.get_stats()["total_queries"] == 1
+        executor.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_queries_lentas_no_bloquean_loop(self):
+        """Test que una query lenta no detiene otras corrutinas"""
+        executor = SupabaseExecutor(max_workers=2, max_pending=4)
+        query = Mock()
+        query.execute.side_effect = lambda: time.sleep(0.2)
+        
+        ticks = 0
+        async def contador():
+            nonlocal ticks
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+                ticks += 1
+        
+        await asyncio.gather(executor.execute(query), contador())
+        
+        assert ticks == 5
+        executor.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_backpressure_rechaza_cuando_saturado(self):
+        """Test que se rechaza la query si no hay cupo en el tiempo máximo"""
+        executor = SupabaseExecutor(max_workers=1, max_pending=1, acquire_timeout=0.05)
+        query = Mock()
+        query.execute.side_effect = lambda: time.sleep(0.3)
+        
+        lenta = asyncio.ensure_future(executor.execute(query))
+        await asyncio.sleep(0.01)
+        
+        with pytest.raises(DatabaseSaturadaError):
+            await executor.execute(query)
+        
+        await lenta
+        assert executor.get_stats()["rejected"] == 1
+        executor.shutdown()
@@ -0,0 +1,219 @@
+# tests/test_embeddings.py
+"""
+Tests para el servicio de embeddings y su caché
+"""
+
+import pytest
+from unittest.mock import AsyncMock, Mock
+
+from embedding_cache import EmbeddingCache
+from http_client import HTTPClientManager
+from services import EmbeddingService
+
+class TestEmbeddingCache:
+    """Tests para la caché de embeddings"""
+    
+    @pytest.mark.asyncio
+    async def test_lru_expulsa_entrada_mas_antigua(self):
+        """Test que el LRU respeta el tamaño máximo"""
+        cache = EmbeddingCache(max_entries=2)
+        await cache.put("a", [1.0])
+        await cache.put("b", [2.0])
+        await cache.get("a")  # "a" pasa a ser la más reciente
+        await cache.put("c", [3.0])
+        
+        assert await cache.get("b") is None
+        assert await cache.get("a") == [1.0]
+        assert await cache.get("c") == [3.0]
+        
+        stats = cache.get_stats()
+        assert stats["entries_in_memory"] == 2
+        assert stats["hits"] == 3
+        assert stats["misses"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_tier_sqlite_sobrevive_reinicio(self, tmp_path):
+        """Test que los vectores persisten en SQLite entre instancias"""
+        db_path = str(tmp_path / "embeddings.sqlite3")
+        cache = EmbeddingCache(db_path=db_path, namespace="modelo")
+        await cache.put("radiografía de tórax", [0.5, 0.25])
+        cache.close()
+        
+        reiniciada = EmbeddingCache(db_path=db_path, namespace="modelo")
+        assert await reiniciada.get("radiografía de tórax") == [0.5, 0.25]
+        assert reiniciada.get_stats()["disk_hits"] == 1
+        reiniciada.close()
+    
+    def test_namespace_separa_modelos(self):
+        """Test que el mismo texto tiene claves distintas por modelo"""
+        assert EmbeddingCache(namespace="a").key("texto") != EmbeddingCache(namespace="b").key("texto")
+
+class TestEmbeddingService:
+    """Tests para el servicio de embeddings"""
+    
+    @pytest.mark.asyncio
+    async def test_encode_usa_cache(self):
+        """Test que textos repetidos no vuelven a llamar al endpoint"""
+        http_clients = HTTPClientManager()
+        http_clients.client = Mock()
+        mock_response = Mock(is_success=True)
+        mock_response.json.return_value = [[0.1, 0.2, 0.3]]
+        http_clients.client.return_value.post = AsyncMock(return_value=mock_response)
+        
+        service = EmbeddingService("http://test-embeddings", http_clients)
+        
+        primero = await service.encode("dolor torácico")
+        segundo = await service.encode("dolor torácico")
+        
+        assert primero == segundo == [0.1, 0.2, 0.3]
+        assert http_clients.client.return_value.post.await_count == 1
+        assert service.cache.get_stats()["hits"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_encode_concurrente_se_agrupa(self):
+        """Test que llamadas concurrentes se coalescen en una sola petición"""
+        import asyncio
+        
+        http_clients = HTTPClientManager()
+        http_clients.client = Mock()
+        
+        async def mock_post(url, headers=None, json=None):
+            response = Mock(is_success=True)
+            response.json.return_value = [[float(len(t))] for t in json["inputs"]]
+            return response
+        
+        http_clients.client.return_value.post = AsyncMock(side_effect=mock_post)
+        service = EmbeddingService("http://test-embeddings", http_clients, coalesce_window_ms=20)
+        
+        textos = ["a", "bb", "ccc", "bb"]
+        resultados = await asyncio.gather(*(service.encode(t) for t in textos))
+        
+        assert resultados == [[1.0], [2.0], [3.0], [2.0]]
+        assert http_clients.client.return_value.post.await_count == 1
+        assert service.batcher.get_stats()["batches"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_encode_batch_solo_pide_faltantes(self):
+        """Test que encode_batch reutiliza la caché y respeta el orden"""
+        http_clients = HTTPClientManager()
+        http_clients.client = Mock()
+        mock_response = Mock(is_success=True)
+        mock_response.json.return_value = [[2.0], [3.0]]
+        http_clients.client.return_value.post = AsyncMock(return_value=mock_response)
+        
+        service = EmbeddingService("http://test-embeddings", http_clients)
+        await service.cache.put("uno", [1.0])
+        
+        resultados = await service.encode_batch(["dos", "uno", "tres"])
+        
+        assert resultados == [[2.0], [1.0], [3.0]]
+        enviado = http_clients.client.return_value.post.await_args.kwargs["json"]["inputs"]
+        assert enviado == ["dos", "tres"]
+
+class TestChunking:
+    """Tests para la división de reportes en fragmentos"""
+    
+    def test_texto_corto_un_solo_fragmento(self):
+        """Test que un texto corto produce un único fragmento"""
+        from chunking import dividir_texto
+        
+        chunks = dividir_texto("  HALLAZGOS: campos pulmonares claros.  ")
+        
+        assert len(chunks) == 1
+        assert chunks[0].contenido == "HALLAZGOS: campos pulmonares claros."
+    
+    def test_texto_largo_respeta_limite_y_offsets(self):
+        """Test que los fragmentos respetan el tamaño y apuntan al texto original"""
+        from chunking import dividir_texto
+        
+        texto = " ".join(f"Oración número {i} del reporte." for i in range(200))
+        chunks = dividir_texto(texto, max_chars=300, solapamiento=50)
+        
+        assert len(chunks) > 1
+        for chunk in chunks:
+            assert len(chunk.contenido) <= 300
+            assert texto[chunk.inicio:chunk.fin] == chunk.contenido
+        assert chunks[-1].fin == len(texto)
+    
+    def test_division_por_secciones(self):
+        """Test que cada fragmento pertenece a una sola sección del reporte"""
+        from chunking import dividir_por_secciones
+        
+        texto = (
+            "REPORTE RADIOLÓGICO\n\n"
+            "TÉCNICA: Radiografía PA y lateral de tórax.\n\n"
+            "**HALLAZGOS:**\nHallazgos compatibles con consolidación basal derecha.\n\n"
+            "IMPRESIÓN DIAGNÓSTICA: Neumonía basal derecha.\n\n"
+            "Recomendaciones:\nControl radiológico en 4 semanas."
+        )
+        chunks = dividir_por_secciones(texto)
+        
+        assert [c.seccion for c in chunks] == [
+            None, "TÉCNICA", "HALLAZGOS", "IMPRESIÓN DIAGNÓSTICA", "RECOMENDACIONES"
+        ]
+        for chunk in chunks:
+            assert texto[chunk.inicio:chunk.fin] == chunk.contenido
+        assert "consolidación" in chunks[2].contenido
+    
+    def test_sin_secciones_usa_division_simple(self):
+        """Test que un texto sin encabezados se divide normalmente"""
+        from chunking import dividir_por_secciones
+        
+        chunks = dividir_por_secciones("Estudio sin alteraciones significativas.")
+        
+        assert len(chunks) == 1
+        assert chunks[0].seccion is None
+
+class TestEmbeddingBackfill:
+    """Tests para el pipeline de backfill de embeddings"""
+    
+    class _FakeDB:
+        async def execute(self, query):
+            return query.execute()
+    
+    def _mock_supabase(self, pagina, indexados):
+        supabase = Mock()
+        reportes, embeddings = Mock(), Mock()
+        supabase.table.side_effect = lambda nombre: reportes if nombre == 'reportes' else embeddings
+        
+        consulta = reportes.select.return_value.order.return_value
+        consulta.limit.return_value.execute.return_value.data = pagina
+        consulta.gt.return_value.limit.return_value.execute.return_value.data = []
+        embeddings.select.return_value.in_.return_value.execute.return_value.data = [
+            {"reporte_id": rid} for rid in indexados
+        ]
+        embeddings.insert.return_value.execute.return_value.data = []
+        return supabase, embeddings
+    
+    @pytest.mark.asyncio
+    async def test_backfill_omite_indexados_y_guarda_checkpoint(self, tmp_path):
+        """Test que el backfill inserta solo lo pendiente y es reanudable"""
+        from backfill_embeddings import EmbeddingBackfill, BackfillCheckpoint
+        
+        pagina = [
+            {"id": "a", "paciente_id": "p1", "reporte_generado": "HALLAZGOS: normal."},
+            {"id": "b", "paciente_id": "p2", "reporte_generado": "HALLAZGOS: nódulo."},
+        ]
+        supabase, embeddings = self._mock_supabase(pagina, indexados=["b"])
+        embedding_service = Mock()
+        embedding_service.encode_batch = AsyncMock(side_effect=lambda textos: [[0.1]] * len(textos))
+        checkpoint = str(tmp_path / "checkpoint.json")
+        
+        backfill = EmbeddingBackfill(supabase, self._FakeDB(), embedding_service,
+                                     page_size=10, checkpoint_path=checkpoint)
+        metricas = await backfill.run()
+        
+        filas = embeddings.insert.call_args.args[0]
+        assert [f["reporte_id"] for f in filas] == ["a"]
+        assert filas[0]["embedding"] == [0.1]
+        assert metricas["reportes"] == 1
+        
+        guardado = BackfillCheckpoint.load(checkpoint)
+        assert guardado.last_id == "b"
+        assert guardado.reportes_omitidos == 1
+        
+        # Una segunda ejecución reanuda desde el checkpoint
+        reanudado = EmbeddingBackfill(supabase, self._FakeDB(), embedding_service,
+                                      page_size=10, checkpoint_path=checkpoint)
+        await reanudado.run()
+        supabase.table('reportes').select.return_value.order.return_value.gt.assert_called_with('id', 'b')
@@ -0,0 +1,162 @@
+# tests/test_historial.py
+"""
+Tests para la carga del final del historial y la paginación por cursor
+"""
+
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, Mock
+from uuid import uuid4
+
+import pytest
+
+from context_manager import ContextManager, consultar_mensajes_recientes
+from services import ChatService
+from token_counter import HeuristicTokenCounter
+
+class ConsultaFalsa:
+    """Query builder mínimo de supabase-py sobre filas en memoria"""
+    
+    def __init__(self, tabla, filas):
+        self.tabla = tabla
+        self.filas = filas
+        self.filtros = []
+        self.columnas = None
+        self.descendente = False
+        self.limite = None
+        self._negar = False
+    
+    def select(self, columnas):
+        self.columnas = columnas.split(",")
+        return self
+    
+    def eq(self, columna, valor):
+        self.filtros.append(lambda f: f.get(columna) == valor)
+        return self
+    
+    def lte(self, columna, valor):
+        self.filtros.append(lambda f: f[columna] <= valor)
+        return self
+    
+    @property
+    def not_(self):
+        self._negar = True
+        return self
+    
+    def in_(self, columna, valores):
+        negar, self._negar = self._negar, False
+        self.filtros.append(lambda f: (f[columna] in valores) != negar)
+        return self
+    
+    def order(self, columna, desc=False):
+        self.descendente = desc
+        self.orden = columna
+        return self
+    
+    def limit(self, n):
+        self.limite = n
+        return self
+    
+    def execute(self):
+        filas = [f for f in self.filas if all(filtro(f) for filtro in self.filtros)]
+        if self.tabla == 'mensajes_chat':
+            filas.sort(key=lambda f: f[self.orden], reverse=self.descendente)
+        if self.limite is not None:
+            filas = filas[:self.limite]
+        return Mock(data=[{c: f[c] for c in self.columnas if c in f} for f in filas])
+
+def base_de_datos(conversacion_id, n, empates_cada=None):
+    """Supabase falso con `n` mensajes (con marcas de tiempo repetidas si se pide)"""
+    inicio = datetime(2024, 1, 15, 10, 0, 0)
+    mensajes = []
+    for i in range(n):
+        segundo = i // empates_cada if empates_cada else i
+        mensajes.append({
+            'id': str(uuid4()),
+            'conversacion_id': str(conversacion_id),
+            'rol': 'user' if i % 2 == 0 else 'assistant',
+            'contenido': f"mensaje {i}",
+            'archivos_adjuntos': None,
+            'metadatos': None,
+            'timestamp_mensaje': (inicio + timedelta(seconds=segundo)).isoformat()
+        })
+    conversaciones = [{'id': str(conversacion_id), 'especialidad': 'General'}]
+    supabase = Mock()
+    supabase.table.side_effect = lambda t: ConsultaFalsa(
+        t, mensajes if t == 'mensajes_chat' else conversaciones
+    )
+    db = Mock()
+    db.execute = AsyncMock(side_effect=lambda consulta: consulta.execute())
+    return supabase, db
+
+class TestHistorialPorCursor:
+    """Tests para la paginación del historial"""
+    
+    @pytest.mark.asyncio
+    async def test_recorre_todo_sin_duplicar_con_empates(self):
+        """Test que el cursor recorre el historial completo aunque se repitan marcas de tiempo"""
+        conv_id = uuid4()
+        supabase, db = base_de_datos(conv_id, 23, empates_cada=3)
+        
+        vistos, cursor = [], None
+        while True:
+            filas, cursor = await consultar_mensajes_recientes(db, supabase, conv_id, 4, cursor)
+            vistos.extend(f['contenido'] for f in filas)
+            if cursor is None:
+                break
+        
+        assert len(vistos) == 23
+        assert set(vistos) == {f"mensaje {i}" for i in range(23)}
+        # Los dos más recientes comparten marca de tiempo
+        assert set(vistos[:2]) == {"mensaje 21", "mensaje 22"}
+    
+    @pytest.mark.asyncio
+    async def test_servicio_devuelve_pagina_cronologica(self):
+        """Test que el API devuelve los más recientes en orden cronológico y el cursor"""
+        conv_id = uuid4()
+        supabase, db = base_de_datos(conv_id, 10)
+        chat_service = ChatService.__new__(ChatService)
+        chat_service.supabase, chat_service.db = supabase, db
+        
+        pagina = await chat_service.obtener_historial_conversacion(conv_id, limit=4)
+        anterior = await chat_service.obtener_historial_conversacion(
+            conv_id, limit=4, cursor=pagina["next_cursor"]
+        )
+        
+        assert [m["contenido"] for m in pagina["data"]] == [f"mensaje {i}" for i in range(6, 10)]
+        assert [m["contenido"] for m in anterior["data"]] == [f"mensaje {i}" for i in range(2, 6)]
+        assert pagina["has_more"] and anterior["has_more"]
+        assert "archivos_adjuntos" in pagina["data"][0]
+    
+    @pytest.mark.asyncio
+    async def test_cursor_invalido(self):
+        """Test que un cursor manipulado se rechaza"""
+        conv_id = uuid4()
+        supabase, db = base_de_datos(conv_id, 3)
+        chat_service = ChatService.__new__(ChatService)
+        chat_service.supabase, chat_service.db = supabase, db
+        
+        respuesta = await chat_service.obtener_historial_conversacion(conv_id, cursor="no-es-un-cursor")
+        
+        assert respuesta["success"] is False
+        assert respuesta["data"] == []
+
+class TestCargaDelFinal:
+    """Tests para la carga del final del historial en el contexto"""
+    
+    @pytest.mark.asyncio
+    async def test_carga_solo_el_final_de_conversaciones_largas(self, al_cerrar):
+        """Test que una conversación larga se carga con pocas consultas y solo su final"""
+        conv_id = uuid4()
+        supabase, db = base_de_datos(conv_id, 300)
+        manager = al_cerrar(ContextManager(supabase, db=db, token_counter=HeuristicTokenCounter(), history_page_size=20))
+        
+        context = await manager.get_conversation_context(conv_id, "u1")
+        
+        contenidos = [m.content for m in context.messages]
+        assert contenidos[-1] == "mensaje 299"
+        assert contenidos == [f"mensaje {i}" for i in range(300 - len(contenidos), 300)]
+        consultas = [c.args[0] for c in db.execute.await_args_list]
+        mensajes = [c for c in consultas if c.tabla == 'mensajes_chat']
+        assert len(mensajes) <= 3
+        assert all(c.limite <= 21 and 'contenido' in c.columnas and 'metadatos' not in c.columnas
+                   for c in mensajes)
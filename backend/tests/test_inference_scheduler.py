@@ -0,0 +1,109 @@
+# tests/test_inference_scheduler.py
+"""
+Tests para el planificador de inferencia (concurrencia y cola de prioridad)
+"""
+
+import asyncio
+
+import pytest
+
+from inference_scheduler import (
+    InferenceScheduler, ColaInferenciaLlenaError,
+    PRIORIDAD_CHAT, PRIORIDAD_CRITICA, PRIORIDAD_REPORTE
+)
+
+class TestInferenceScheduler:
+    """Tests para InferenceScheduler"""
+    
+    @pytest.mark.asyncio
+    async def test_limita_peticiones_simultaneas(self):
+        """Test que nunca hay más de max_in_flight peticiones en curso"""
+        scheduler = InferenceScheduler(max_in_flight=2, max_queue=10)
+        activos, maximo = 0, 0
+        
+        async def tarea():
+            nonlocal activos, maximo
+            async with scheduler.slot(PRIORIDAD_CHAT, "chat"):
+                activos += 1
+                maximo = max(maximo, activos)
+                await asyncio.sleep(0.01)
+                activos -= 1
+        
+        await asyncio.gather(*(tarea() for _ in range(6)))
+        
+        stats = scheduler.get_stats()
+        assert maximo == 2
+        assert stats["completed"] == 6
+        assert stats["in_flight"] == 0
+        assert stats["by_type"] == {"chat": 6}
+    
+    @pytest.mark.asyncio
+    async def test_prioridad_critica_adelanta_al_chat(self):
+        """Test que un estudio crítico en cola se atiende antes que el chat"""
+        scheduler = InferenceScheduler(max_in_flight=1, max_queue=10)
+        orden = []
+        liberar = asyncio.Event()
+        
+        async def ocupar():
+            async with scheduler.slot(PRIORIDAD_REPORTE, "reporte"):
+                await liberar.wait()
+        
+        async def tarea(prioridad, nombre):
+            async with scheduler.slot(prioridad, nombre):
+                orden.append(nombre)
+        
+        bloqueo = asyncio.create_task(ocupar())
+        await asyncio.sleep(0)
+        esperando = [
+            asyncio.create_task(tarea(PRIORIDAD_CHAT, "chat")),
+            asyncio.create_task(tarea(PRIORIDAD_CRITICA, "critica")),
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()["queued"] == 2
+        
+        liberar.set()
+        await asyncio.gather(bloqueo, *esperando)
+        assert orden == ["critica", "chat"]
+    
+    @pytest.mark.asyncio
+    async def test_rechazo_inmediato_con_cola_llena(self):
+        """Test que se rechaza sin esperar cuando la cola está llena"""
+        scheduler = InferenceScheduler(max_in_flight=1, max_queue=1)
+        liberar = asyncio.Event()
+        
+        async def ocupar():
+            async with scheduler.slot():
+                await liberar.wait()
+        
+        tareas = [asyncio.create_task(ocupar()), asyncio.create_task(ocupar())]
+        await asyncio.sleep(0)
+        
+        with pytest.raises(ColaInferenciaLlenaError):
+            async with scheduler.slot():
+                pass
+        assert scheduler.get_stats()["rejected"] == 1
+        
+        liberar.set()
+        await asyncio.gather(*tareas)
+    
+    @pytest.mark.asyncio
+    async def test_timeout_en_cola_libera_la_entrada(self):
+        """Test que una espera expirada sale de la cola y no consume lugar"""
+        scheduler = InferenceScheduler(max_in_flight=1, max_queue=5, queue_timeout=0.01)
+        liberar = asyncio.Event()
+        
+        async def ocupar():
+            async with scheduler.slot():
+                await liberar.wait()
+        
+        bloqueo = asyncio.create_task(ocupar())
+        await asyncio.sleep(0)
+        
+        with pytest.raises(ColaInferenciaLlenaError):
+            async with scheduler.slot():
+                pass
+        assert scheduler.get_stats()["queued"] == 0
+        
+        liberar.set()
+        await bloqueo
+        assert scheduler.get_stats()["in_flight"] == 0
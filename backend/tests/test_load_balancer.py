@@ -0,0 +1,90 @@
+# tests/test_load_balancer.py
+"""
+Tests para el balanceo de carga entre réplicas de TGI
+"""
+
+from unittest.mock import AsyncMock, Mock
+
+import httpx
+import pytest
+
+from load_balancer import TGILoadBalancer
+
+URLS = ["http://tgi-a", "http://tgi-b"]
+
+class TestTGILoadBalancer:
+    """Tests para TGILoadBalancer"""
+    
+    @pytest.mark.asyncio
+    async def test_menor_numero_de_peticiones_en_curso(self):
+        """Test que se elige la réplica con menos peticiones en curso"""
+        balancer = TGILoadBalancer(URLS)
+        
+        async with balancer.usar() as primera:
+            async with balancer.usar() as segunda:
+                assert {primera, segunda} == set(URLS)
+        
+        stats = balancer.get_stats()["replicas"]
+        assert all(r["completed"] == 1 and r["in_flight"] == 0 for r in stats.values())
+    
+    @pytest.mark.asyncio
+    async def test_afinidad_de_conversacion(self):
+        """Test que una conversación vuelve a su réplica salvo sobrecarga"""
+        balancer = TGILoadBalancer(URLS, sticky_holgura=1)
+        
+        async with balancer.usar("conv-1") as url:
+            pass
+        assert balancer.elegir("conv-1").url == url
+        assert balancer.get_stats()["sticky_hits"] == 1
+        
+        # Réplica asignada muy cargada: se reasigna a la otra
+        next(r for r in balancer.replicas if r.url == url).en_curso = 5
+        assert balancer.elegir("conv-1").url != url
+    
+    @pytest.mark.asyncio
+    async def test_replica_con_errores_sale_de_rotacion(self):
+        """Test que los errores de transporte y /health retiran y reincorporan réplicas"""
+        balancer = TGILoadBalancer(URLS, max_errores=2)
+        caida = balancer.replicas[0]
+        
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                async with balancer.usar("conv-1") as url:
+                    assert url == caida.url
+                    raise httpx.ConnectError("sin conexión")
+        
+        assert caida.activa is False
+        assert all(balancer.elegir("conv-1").url == "http://tgi-b" for _ in range(3))
+        
+        client = Mock()
+        client.get = AsyncMock(return_value=Mock(status_code=200))
+        await balancer.verificar_salud(client)
+        assert caida.activa is True
+    
+    @pytest.mark.asyncio
+    async def test_errores_5xx_cuentan_para_la_salud_pasiva(self):
+        """Test que un HTTPStatusError 5xx en el bloque retira la réplica y un 4xx no"""
+        balancer = TGILoadBalancer(URLS, max_errores=1)
+        
+        with pytest.raises(httpx.HTTPStatusError):
+            async with balancer.usar(excluir={"http://tgi-b"}):
+                raise httpx.HTTPStatusError("400", request=None, response=Mock(status_code=400))
+        assert balancer.replicas[0].activa is True
+        
+        with pytest.raises(httpx.HTTPStatusError):
+            async with balancer.usar(excluir={"http://tgi-b"}):
+                raise httpx.HTTPStatusError("503", request=None, response=Mock(status_code=503))
+        assert balancer.replicas[0].activa is False
+    
+    @pytest.mark.asyncio
+    async def test_verificacion_de_salud_autenticada(self):
+        """Test que /health se consulta con las cabeceras indicadas"""
+        balancer = TGILoadBalancer(URLS)
+        client = Mock()
+        client.get = AsyncMock(return_value=Mock(status_code=200))
+        
+        await balancer.verificar_salud(client, headers={"Authorization": "Bearer hf_test"})
+        
+        assert client.get.await_count == 2
+        assert all(c.kwargs["headers"] == {"Authorization": "Bearer hf_test"}
+                   for c in client.get.await_args_list)
@@ -4,10 +4,11 @@ Tests para endpoints y servicios de reportes médicos
 """
 
 import pytest
+import asyncio
 from unittest.mock import AsyncMock, patch, Mock
 from uuid import uuid4
 
-from models import ReporteCreate, ReportGenerationRequest, FirmaReporte
+from models import ReporteCreate, ReportGenerationRequest, FirmaReporte, EstadoReporteEnum
 
 class TestReporteEndpoints:
     """Tests para endpoints de reportes"""
@@ -128,6 +129,29 @@ class TestReporteEndpoints:
             data = response.json()
             assert data["total_reportes"] == 75
             assert data["confianza_promedio"] == 0.82
+    
+    def test_buscar_rag_reenvia_modo(self, client):
+        """Test que el endpoint RAG pasa el modo de búsqueda al servicio"""
+        with patch('main.ia_service.buscar_rag', new=AsyncMock(return_value=[])) as mock_buscar:
+            response = client.get("/api/v1/rag/buscar", params={"query": "amoxicilina", "modo": "hibrido"})
+            
+            assert response.status_code == 200
+            assert mock_buscar.await_args[0][0].modo == "hibrido"
+            
+            response = client.get("/api/v1/rag/buscar", params={"query": "amoxicilina", "modo": "otro"})
+            assert response.status_code == 422
+    
+    def test_buscar_rag_reenvia_parametros_del_indice(self, client):
+        """Test que ef_search/probes del endpoint llegan a la búsqueda y se validan"""
+        with patch('main.ia_service.buscar_rag', new=AsyncMock(return_value=[])) as mock_buscar:
+            response = client.get("/api/v1/rag/buscar", params={"query": "nódulo", "ef_search": 120, "probes": 8})
+            
+            assert response.status_code == 200
+            request = mock_buscar.await_args[0][0]
+            assert request.ef_search == 120 and request.probes == 8
+            
+            response = client.get("/api/v1/rag/buscar", params={"query": "nódulo", "ef_search": 5000})
+            assert response.status_code == 422
 
 class TestReporteService:
     """Tests para el servicio de reportes"""
@@ -206,8 +230,8 @@ class TestIAService:
             }
         ]
         
-        # Mock para la respuesta de LM Studio
-        with patch('httpx.AsyncClient') as mock_client:
+        # Mock para la respuesta de TGI (cliente HTTP compartido)
+        with patch.object(ia_service.http_clients, 'client') as mock_client:
             mock_response = Mock()
             mock_response.json.return_value = {
                 "choices": [
@@ -220,13 +244,180 @@ class TestIAService:
             }
             mock_response.raise_for_status.return_value = None
             
-            mock_client.return_value.__aenter__.return_value.post.return_value = mock_response
+            mock_client.return_value.post = AsyncMock(return_value=mock_response)
             
             result = await ia_service.generar_reporte_con_ia(request)
             
             assert result.success is True
             assert "reporte" in result.data
     
+    @pytest.mark.asyncio
+    async def test_contexto_rag_del_reporte_usa_busqueda_hibrida(self, ia_service):
+        """Test que el contexto RAG del reporte combina búsqueda semántica y léxica"""
+        from models import ModoBusquedaEnum
+        
+        ia_service.buscar_rag = AsyncMock(return_value=[])
+        
+        await ia_service._solicitud_reporte(ReportGenerationRequest(
+            paciente_id=uuid4(),
+            tipo_estudio="Radiografía de tórax",
+            contexto_clinico="Tos y fiebre",
+            radiologo="Dr. García",
+            incluir_contexto_rag=True
+        ))
+        
+        assert ia_service.buscar_rag.await_args[0][0].modo == ModoBusquedaEnum.HIBRIDO
+    
+    @pytest.mark.asyncio
+    async def test_cache_de_reportes_solo_por_solicitud_identica(self, ia_service):
+        """Test que un reporte solo se reutiliza para una solicitud idéntica (no por similitud)"""
+        from semantic_cache import SemanticResponseCache, MARCA_CACHE
+        
+        ia_service.response_cache = SemanticResponseCache(threshold=0.5)
+        
+        def solicitud(contexto):
+            return ReportGenerationRequest(
+                paciente_id=uuid4(),
+                tipo_estudio="Radiografía de rodilla",
+                contexto_clinico=contexto,
+                radiologo="Dr. García",
+                incluir_contexto_rag=False
+            )
+        
+        with patch.object(ia_service.http_clients, 'client') as mock_client:
+            mock_response = Mock()
+            mock_response.json.return_value = {"choices": [{"message": {"content": "HALLAZGOS: ..."}}]}
+            mock_response.raise_for_status.return_value = None
+            mock_client.return_value.post = AsyncMock(return_value=mock_response)
+            
+            _, modelo = await ia_service._obtener_reporte_generado(solicitud("Dolor en rodilla derecha"))
+            _, modelo_lateral = await ia_service._obtener_reporte_generado(solicitud("Dolor en rodilla izquierda"))
+            _, modelo_repetido = await ia_service._obtener_reporte_generado(solicitud("Dolor en  rodilla derecha "))
+        
+        assert (modelo, modelo_lateral) == ("tgi", "tgi")
+        assert modelo_repetido == f"tgi-{MARCA_CACHE}"
+        assert mock_client.return_value.post.await_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_streaming_reporte_cancelado_por_desconexion(self, ia_service, fake_tgi_stream):
+        """Test que una desconexión aborta el stream de TGI y cuenta la cancelación"""
+        upstream = fake_tgi_stream(["TÉCNICA: ", "Radiografía ", "PA"])
+        http_request = Mock()
+        http_request.is_disconnected = AsyncMock(side_effect=[False, True, True])
+        ia_service._guardar_reporte_async = AsyncMock()
+        request = ReportGenerationRequest(
+            paciente_id=uuid4(),
+            tipo_estudio="Radiografía",
+            contexto_clinico="Dolor torácico",
+            radiologo="Dr. García"
+        )
+        
+        with patch.object(ia_service.http_clients, 'client') as mock_client:
+            mock_client.return_value.stream = Mock(return_value=upstream)
+            response = await ia_service.generar_reporte_con_ia_streaming(request, http_request)
+            eventos = [e async for e in response.body_iterator]
+            await asyncio.sleep(0)
+        
+        assert upstream.cerrado
+        assert not any("[DONE]" in e for e in eventos)
+        assert ia_service.streaming_stats["canceladas"] == 1
+        assert ia_service.streaming_stats["completadas"] == 0
+        # Sin guardar_parcial no se guarda nada ni se consume un número de reporte
+        ia_service._guardar_reporte_async.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_streaming_cancelado_guarda_parcial_si_se_pide(self, ia_service, fake_tgi_stream):
+        """Test que con guardar_parcial el texto parcial se guarda como cancelado"""
+        upstream = fake_tgi_stream(["TÉCNICA: ", "Radiografía ", "PA"])
+        http_request = Mock()
+        http_request.is_disconnected = AsyncMock(side_effect=[False, True, True])
+        ia_service._guardar_reporte_async = AsyncMock()
+        request = ReportGenerationRequest(
+            paciente_id=uuid4(),
+            tipo_estudio="Radiografía",
+            contexto_clinico="Dolor torácico",
+            radiologo="Dr. García",
+            guardar_parcial=True
+        )
+        
+        with patch.object(ia_service.http_clients, 'client') as mock_client:
+            mock_client.return_value.stream = Mock(return_value=upstream)
+            response = await ia_service.generar_reporte_con_ia_streaming(request, http_request)
+            [e async for e in response.body_iterator]
+            await asyncio.sleep(0)
+        
+        args, kwargs = ia_service._guardar_reporte_async.await_args
+        assert args[1] == "TÉCNICA: "
+        assert kwargs["estado"] == EstadoReporteEnum.CANCELADO
+    
+    @pytest.mark.asyncio
+    async def test_generar_reportes_lote_ndjson(self, ia_service):
+        """Test que el lote emite NDJSON por reporte e inserta los generados en bloque"""
+        import json
+        from models import ReportBatchRequest
+        
+        def item(contexto):
+            return ReportGenerationRequest(
+                paciente_id=uuid4(), tipo_estudio="Radiografía",
+                contexto_clinico=contexto, radiologo="Dr. García"
+            )
+        
+        async def generar(request, prioridad):
+            if request.contexto_clinico == "falla":
+                raise RuntimeError("TGI no disponible")
+            return f"HALLAZGOS: {request.contexto_clinico}", "tgi"
+        
+        ia_service._obtener_reporte_generado = AsyncMock(side_effect=generar)
+        ia_service._generar_embeddings_reportes = AsyncMock()
+        tabla = ia_service.supabase.table.return_value
+        tabla.insert.side_effect = lambda filas: Mock(execute=Mock(return_value=Mock(
+            data=[{"id": f"rep-{i}", **fila} for i, fila in enumerate(filas)]
+        )))
+        
+        lote = ReportBatchRequest(reportes=[item("tos"), item("falla"), item("fiebre")], tamano_insercion=5)
+        response = await ia_service.generar_reportes_lote(lote)
+        lineas = [json.loads(l) async for l in response.body_iterator]
+        
+        resumen = lineas[-1]["resumen"]
+        assert resumen["total"] == 3 and resumen["exitosos"] == 2 and resumen["fallidos"] == 1
+        por_indice = {l["indice"]: l for l in lineas[:-1]}
+        assert por_indice[1]["success"] is False
+        assert por_indice[0]["success"] and por_indice[2]["success"]
+        # Una sola inserción con los dos reportes generados
+        assert tabla.insert.call_count == 1
+        assert len(tabla.insert.call_args[0][0]) == 2
+        assert len(ia_service._generar_embeddings_reportes.await_args[0][0]) == 2
+    
+    @pytest.mark.asyncio
+    async def test_lote_interrumpido_guarda_los_reportes_terminados(self, ia_service):
+        """Test que al desconectarse el cliente se guardan también los reportes ya terminados sin emitir"""
+        from models import ReportBatchRequest
+        
+        terminados = asyncio.Event()
+        
+        async def generar(request, prioridad):
+            if request.contexto_clinico == "lento":
+                await asyncio.Event().wait()
+            return f"HALLAZGOS: {request.contexto_clinico}", "tgi"
+        
+        ia_service._obtener_reporte_generado = AsyncMock(side_effect=generar)
+        insertar = AsyncMock(side_effect=lambda generados: terminados.set() or [])
+        ia_service._insertar_reportes_lote = insertar
+        http_request = Mock()
+        http_request.is_disconnected = AsyncMock(return_value=True)
+        
+        lote = ReportBatchRequest(reportes=[
+            ReportGenerationRequest(paciente_id=uuid4(), tipo_estudio="Radiografía",
+                                    contexto_clinico=contexto, radiologo="Dr. García")
+            for contexto in ("tos", "fiebre", "disnea", "lento")
+        ], tamano_insercion=10)
+        response = await ia_service.generar_reportes_lote(lote, http_request)
+        assert [l async for l in response.body_iterator] == []
+        await asyncio.wait_for(terminados.wait(), 1)
+        
+        guardados = insertar.await_args[0][0]
+        assert sorted(g["indice"] for g in guardados) == [0, 1, 2]
+    
     @pytest.mark.asyncio
     async def test_buscar_rag(self, ia_service):
         """Test búsqueda RAG"""
@@ -254,4 +445,67 @@ class TestIAService:
         assert len(results) >= 0
         if results:
             assert results[0].similitud >= 0.6
-            assert "dolor" in results[0].contenido.lower() or "torácico" in results[0].contenido.lower()
\ No newline at end of file
+            assert "dolor" in results[0].contenido.lower() or "torácico" in results[0].contenido.lower()
+    
+    @pytest.mark.asyncio
+    async def test_buscar_rag_parametros_indice(self, ia_service):
+        """Test que ef_search/probes y el filtro de paciente llegan a la RPC"""
+        from models import RAGSearchRequest
+        
+        paciente_id = uuid4()
+        request = RAGSearchRequest(
+            query="nódulo pulmonar",
+            paciente_id=paciente_id,
+            ef_search=80,
+            probes=10
+        )
+        ia_service.embedding_service.encode = AsyncMock(return_value=[0.1, 0.2, 0.3])
+        ia_service.supabase.rpc.return_value.execute.return_value.data = []
+        
+        await ia_service.buscar_rag(request)
+        
+        nombre, params = ia_service.supabase.rpc.call_args[0]
+        assert nombre == 'match_report_embeddings_1024'
+        assert params['paciente_filter'] == str(paciente_id)
+        assert params['ef_search'] == 80
+        assert params['probes'] == 10
+    
+    @pytest.mark.asyncio
+    async def test_buscar_rag_hibrido_fusiona_por_rango(self, ia_service):
+        """Test que el modo híbrido combina resultados vectoriales y léxicos (RRF)"""
+        from models import RAGSearchRequest
+        
+        def fila(id_, contenido, **extra):
+            return {"id": id_, "reporte_id": str(uuid4()), "paciente_id": str(uuid4()),
+                    "contenido": contenido, **extra}
+        
+        comun, solo_vector, solo_texto = str(uuid4()), str(uuid4()), str(uuid4())
+        respuestas = {
+            'match_report_embeddings_1024': [
+                fila(solo_vector, "Neumonía basal derecha", similarity=0.9),
+                fila(comun, "Consolidación tratada con amoxicilina", similarity=0.8),
+            ],
+            'search_report_embeddings_text': [
+                fila(comun, "Consolidación tratada con amoxicilina", rank=0.4),
+                fila(solo_texto, "Amoxicilina 875 mg", rank=0.3),
+            ],
+        }
+        ia_service.supabase.rpc.side_effect = lambda nombre, params: Mock(
+            execute=Mock(return_value=Mock(data=respuestas[nombre]))
+        )
+        ia_service.embedding_service.encode = AsyncMock(return_value=[0.1, 0.2, 0.3])
+        
+        results = await ia_service.buscar_rag(RAGSearchRequest(
+            query="amoxicilina", modo="hibrido", limite_resultados=2
+        ))
+        
+        assert [str(r.id) for r in results] == [comun, solo_vector]
+        assert results[0].similitud == 0.8  # conserva la similitud vectorial
+    
+    def test_fusion_rrf(self):
+        """Test que RRF premia documentos presentes en varias listas"""
+        from retrieval import fusion_rrf
+        
+        fusion = fusion_rrf([["a", "b", "c"], ["c", "d"]], limite=3, clave=lambda r: r)
+        
+        assert fusion == ["c", "a", "b"]
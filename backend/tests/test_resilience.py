@@ -0,0 +1,158 @@
+# tests/test_resilience.py
+"""
+Tests para reintentos, cobertura y circuit breaker de los upstreams
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, Mock
+
+import httpx
+import pytest
+
+from load_balancer import TGILoadBalancer
+from resilience import (
+    CircuitBreaker, CircuitoAbiertoError, ResilienceConfig, ResilientUpstream
+)
+
+def respuesta(status_code):
+    return Mock(status_code=status_code, headers={})
+
+def upstream_con(post, **config):
+    client = Mock()
+    client.post = post
+    return ResilientUpstream("tgi", lambda: client, ResilienceConfig(base_delay=0, **config))
+
+class TestResilientUpstream:
+    """Tests para ResilientUpstream"""
+    
+    @pytest.mark.asyncio
+    async def test_reintenta_errores_transitorios(self):
+        """Test que un 503 de arranque en frío y un error de conexión se reintentan"""
+        post = AsyncMock(side_effect=[
+            respuesta(503), httpx.ConnectError("sin conexión"), respuesta(200)
+        ])
+        upstream = upstream_con(post)
+        
+        response = await upstream.post("http://tgi/v1/chat/completions", json={})
+        
+        assert response.status_code == 200
+        assert post.await_count == 3
+        assert upstream.get_stats()["retries"] == 2
+        assert upstream.breaker.estado == CircuitBreaker.CERRADO
+    
+    @pytest.mark.asyncio
+    async def test_no_reintenta_errores_del_cliente(self):
+        """Test que un 400 se devuelve sin reintentos ni fallo del circuito"""
+        post = AsyncMock(return_value=respuesta(400))
+        upstream = upstream_con(post)
+        
+        response = await upstream.post("http://tgi")
+        
+        assert response.status_code == 400
+        assert post.await_count == 1
+        assert upstream.breaker.get_stats()["consecutive_failures"] == 0
+    
+    @pytest.mark.asyncio
+    async def test_circuito_abierto_falla_rapido_y_se_recupera(self):
+        """Test que el circuito se abre tras N fallos y se cierra con una prueba exitosa"""
+        post = AsyncMock(return_value=respuesta(503))
+        upstream = upstream_con(post, max_intentos=1, failure_threshold=2, recovery_timeout=0.05)
+        
+        await upstream.post("http://tgi")
+        await upstream.post("http://tgi")
+        with pytest.raises(CircuitoAbiertoError):
+            await upstream.post("http://tgi")
+        assert post.await_count == 2
+        assert upstream.get_stats()["circuit_breaker"]["state"] == "open"
+        
+        await asyncio.sleep(0.06)
+        post.return_value = respuesta(200)
+        assert (await upstream.post("http://tgi")).status_code == 200
+        assert upstream.breaker.estado == CircuitBreaker.CERRADO
+    
+    @pytest.mark.asyncio
+    async def test_cobertura_tras_percentil_de_latencia(self):
+        """Test que una petición lenta lanza una segunda y se usa la más rápida"""
+        llamadas = 0
+        
+        async def post(url, **kwargs):
+            nonlocal llamadas
+            llamadas += 1
+            if llamadas == 1:
+                await asyncio.sleep(1)
+            return respuesta(200)
+        
+        upstream = upstream_con(post, hedge_percentile=95, hedge_min_samples=3)
+        upstream._latencias.extend([0.01, 0.01, 0.01])
+        
+        response = await asyncio.wait_for(upstream.post("http://embeddings"), timeout=0.5)
+        
+        assert response.status_code == 200
+        assert llamadas == 2
+        assert upstream.get_stats()["hedged_requests"] == 1
+
+class TestResilientUpstreamConReplicas:
+    """Tests para ResilientUpstream con varias réplicas de TGI"""
+    
+    @pytest.mark.asyncio
+    async def test_cada_reintento_elige_replica(self):
+        """Test que tras un 503 el reintento va a otra réplica y el 5xx cuenta en su salud"""
+        balancer = TGILoadBalancer(["http://tgi-a", "http://tgi-b"], max_errores=1)
+        urls = []
+        
+        async def post(url, **kwargs):
+            urls.append(url)
+            return respuesta(503 if url.startswith("http://tgi-a") else 200)
+        
+        upstream = upstream_con(post)
+        balancer.elegir = Mock(wraps=balancer.elegir)
+        
+        response = await upstream.post("/v1/chat/completions", balancer=balancer, clave="conv-1")
+        
+        assert response.status_code == 200
+        assert urls == ["http://tgi-a/v1/chat/completions", "http://tgi-b/v1/chat/completions"]
+        assert balancer.elegir.call_count == 2
+        assert balancer.replicas[0].activa is False
+    
+    @pytest.mark.asyncio
+    async def test_circuito_por_replica(self):
+        """Test que el circuito abierto de una réplica no bloquea a las demás"""
+        balancer = TGILoadBalancer(["http://tgi-a", "http://tgi-b"], max_errores=100)
+        post = AsyncMock(side_effect=lambda url, **kwargs: respuesta(
+            503 if url.startswith("http://tgi-a") else 200
+        ))
+        upstream = upstream_con(post, max_intentos=1, failure_threshold=1)
+        
+        estados = [
+            (await upstream.post("/v1/chat/completions", balancer=balancer)).status_code
+            for _ in range(4)
+        ]
+        
+        assert estados.count(503) == 1
+        assert upstream.breaker_de("http://tgi-a").estado == CircuitBreaker.ABIERTO
+        assert upstream.breaker_de("http://tgi-b").estado == CircuitBreaker.CERRADO
+        stats = upstream.get_stats()["replica_circuit_breakers"]
+        assert stats["http://tgi-a"]["state"] == "open"
+    
+    @pytest.mark.asyncio
+    async def test_stream_reintenta_en_otra_replica(self):
+        """Test que un stream con 503 en la cabecera se reintenta en otra réplica"""
+        balancer = TGILoadBalancer(["http://tgi-a", "http://tgi-b"])
+        urls = []
+        
+        @asynccontextmanager
+        async def stream(method, url, **kwargs):
+            urls.append(url)
+            yield respuesta(503 if len(urls) == 1 else 200)
+        
+        client = Mock()
+        client.stream = stream
+        upstream = ResilientUpstream("tgi", lambda: client, ResilienceConfig(base_delay=0))
+        
+        async with upstream.stream("POST", "/v1/chat/completions", balancer=balancer) as response:
+            assert response.status_code == 200
+        
+        assert len(urls) == 2 and urls[0] != urls[1]
+        assert sum(r.errores for r in balancer.replicas) == 1
+        assert all(r.en_curso == 0 for r in balancer.replicas)
@@ -0,0 +1,68 @@
+# tests/test_semantic_cache.py
+"""
+Tests para la caché semántica de respuestas
+"""
+
+import time
+
+from semantic_cache import SemanticResponseCache, huella
+
+class TestSemanticResponseCache:
+    """Tests para SemanticResponseCache"""
+    
+    def test_hit_por_similitud_sobre_umbral(self):
+        """Test que un embedding casi idéntico reutiliza la respuesta"""
+        cache = SemanticResponseCache(threshold=0.95)
+        cache.guardar("chat", "General|es", [1.0, 0.0, 0.0], "respuesta")
+        
+        assert cache.buscar("chat", "General|es", [0.99, 0.05, 0.0]) == "respuesta"
+        assert cache.buscar("chat", "General|es", [0.0, 1.0, 0.0]) is None
+        assert cache.get_stats()["hits"] == 1
+    
+    def test_namespace_separa_especialidades(self):
+        """Test que la misma pregunta en otra especialidad no comparte respuesta"""
+        cache = SemanticResponseCache()
+        cache.guardar("chat", "General|es", [1.0, 0.0], "general")
+        
+        assert cache.buscar("chat", "Cardiología|es", [1.0, 0.0]) is None
+    
+    def test_ttl_y_tamano_maximo(self):
+        """Test que las entradas expiran y se expulsan por LRU"""
+        cache = SemanticResponseCache(ttl_seconds=0.01, max_entries=2)
+        cache.guardar("chat", "a", [1.0, 0.0], "uno")
+        time.sleep(0.02)
+        assert cache.buscar("chat", "a", [1.0, 0.0]) is None
+        
+        cache = SemanticResponseCache(max_entries=2)
+        cache.guardar("chat", "a", [1.0, 0.0], "uno")
+        cache.guardar("chat", "b", [1.0, 0.0], "dos")
+        cache.guardar("chat", "c", [1.0, 0.0], "tres")
+        assert cache.buscar("chat", "a", [1.0, 0.0]) is None
+        assert cache.get_stats()["entries"] == 2
+    
+    def test_endpoint_excluido(self):
+        """Test que un endpoint fuera de la lista no usa la caché"""
+        cache = SemanticResponseCache(endpoints=["chat"])
+        cache.guardar("reportes", "x", [1.0], "reporte")
+        
+        assert not cache.habilitado("reportes")
+        assert cache.buscar("reportes", "x", [1.0]) is None
+    
+    def test_entradas_exactas_por_huella(self):
+        """Test que las entradas exactas solo se reutilizan con la misma huella"""
+        cache = SemanticResponseCache()
+        cache.guardar_exacta("reportes", huella({"prompt": "rodilla derecha", "temperature": 0.3}), "derecha")
+        
+        assert cache.buscar_exacta("reportes", huella({"temperature": 0.3, "prompt": "rodilla derecha"})) == "derecha"
+        assert cache.buscar_exacta("reportes", huella({"prompt": "rodilla izquierda", "temperature": 0.3})) is None
+        assert cache.buscar_exacta("reportes", huella({"prompt": "rodilla derecha", "temperature": 0.7})) is None
+    
+    def test_mejor_entrada_entre_muchas(self):
+        """Test que con muchas entradas se elige la de mayor similitud"""
+        cache = SemanticResponseCache(threshold=0.9, max_entries=500)
+        for i in range(300):
+            cache.guardar("chat", "General|es", [1.0, i / 100.0, 0.0], f"respuesta {i}")
+        
+        assert cache.buscar("chat", "General|es", [1.0, 1.5, 0.0]) == "respuesta 150"
+        cache.guardar("chat", "General|es", [0.0, 0.0, 1.0], "nueva")
+        assert cache.buscar("chat", "General|es", [0.0, 0.1, 1.0]) == "nueva"
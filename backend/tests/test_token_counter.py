@@ -0,0 +1,131 @@
+# tests/test_token_counter.py
+"""
+Tests para el conteo de tokens y el presupuesto de contexto del chat
+"""
+
+from collections import deque
+from datetime import datetime
+from unittest.mock import AsyncMock, Mock
+from uuid import uuid4
+
+import pytest
+
+from context_manager import ContextManager, ConversationContext, MensajeContexto
+from models import ChatMessage, RolChatEnum, EspecialidadEnum
+from token_counter import HeuristicTokenCounter, TokenCounter, TokenizerFileCounter
+
+class PalabrasCounter(TokenCounter):
+    """Un token por palabra, sin plantilla de chat (conteos exactos en los tests)"""
+    
+    nombre = "palabras"
+    
+    def __init__(self):
+        super().__init__(tokens_por_mensaje=0)
+    
+    def _contar(self, texto):
+        return len(texto.split())
+
+def contexto(counter, context_window=3000, messages=()):
+    return ConversationContext(
+        conversation_id=uuid4(),
+        user_id="u1",
+        speciality=EspecialidadEnum.GENERAL,
+        messages=deque(messages, maxlen=50),
+        metadata={},
+        last_activity=datetime.now(),
+        token_count=0,
+        context_window=context_window,
+        token_counter=counter
+    )
+
+def mensaje(texto, role=RolChatEnum.USER):
+    return ChatMessage(role=role, content=texto)
+
+class TestTokenCounter:
+    """Tests para los contadores de tokens"""
+    
+    def test_heuristico_cachea_por_contenido(self):
+        """Test que un mismo texto se cuenta una sola vez"""
+        counter = HeuristicTokenCounter(chars_por_token=3.0)
+        
+        assert counter.contar("abcdefg") == 3
+        assert counter.contar("abcdefg") == 3
+        assert counter.get_stats()["hit_rate"] == 0.5
+        assert counter.contar_mensajes([{"role": "user", "content": "abc"}]) == 1 + counter.tokens_por_mensaje
+    
+    def test_tokenizer_desde_archivo(self, tmp_path):
+        """Test que el contador usa el tokenizer real cargado desde tokenizer.json"""
+        tokenizers = pytest.importorskip("tokenizers")
+        from tokenizers.models import WordLevel
+        from tokenizers.pre_tokenizers import Whitespace
+        
+        tokenizer = tokenizers.Tokenizer(WordLevel({"[UNK]": 0, "dolor": 1}, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = Whitespace()
+        path = tmp_path / "tokenizer.json"
+        tokenizer.save(str(path))
+        
+        assert TokenizerFileCounter(str(path)).contar("dolor torácico agudo") == 3
+
+class TestConversationContextTokens:
+    """Tests para el recorte de ConversationContext por tokens"""
+    
+    def test_recorte_incluye_system_prompt(self):
+        """Test que el recorte reserva los tokens del system prompt generado"""
+        counter = PalabrasCounter()
+        ctx = contexto(counter)
+        system_tokens = ctx._system_prompt_tokens()
+        ctx.context_window = system_tokens + 10
+        
+        for texto in ["uno dos tres cuatro", "cinco seis siete", "ocho nueve", "diez once doce"]:
+            ctx.add_message(mensaje(texto))
+        
+        assert [m.content for m in ctx.messages] == ["cinco seis siete", "ocho nueve", "diez once doce"]
+        assert ctx.token_count == 8
+        assert ctx.prompt_tokens() == system_tokens + 8
+    
+    def test_conteo_con_historial_y_limite_de_mensajes(self):
+        """Test que el conteo inicial y el descarte del deque mantienen token_count exacto"""
+        counter = PalabrasCounter()
+        ctx = contexto(counter, messages=[mensaje("a b"), mensaje("c")])
+        assert ctx.token_count == 3
+        
+        for i in range(60):
+            ctx.add_message(mensaje(f"m{i} x"))
+        
+        assert len(ctx.messages) == 50
+        assert ctx.token_count == 100
+
+class TestMensajesCompactos:
+    """Tests para el almacenamiento compacto de mensajes en el contexto"""
+    
+    def test_registros_con_tokens_y_prompt_compartido(self):
+        """Test que los mensajes se guardan como registros con tokens y el system prompt no se reconstruye"""
+        counter = PalabrasCounter()
+        ctx = contexto(counter, messages=[mensaje("hola doctor")])
+        otro = contexto(counter)
+        ctx.add_message(mensaje("me duele la cabeza", RolChatEnum.ASSISTANT))
+        
+        assert all(isinstance(m, MensajeContexto) and not hasattr(m, "__dict__") for m in ctx.messages)
+        assert [m.tokens for m in ctx.messages] == [2, 4]
+        assert ctx.messages[0] == mensaje("hola doctor")
+        messages = ctx.get_context_messages()
+        assert messages[0] is ctx.get_context_messages()[0] is otro.get_context_messages()[0]
+        assert messages[-1].to_wire() == {"role": "assistant", "content": "me duele la cabeza"}
+    
+    @pytest.mark.asyncio
+    async def test_contexto_rag_no_modifica_el_prompt_compartido(self):
+        """Test que el contexto RAG se agrega en una copia del system prompt"""
+        db = Mock()
+        db.execute = AsyncMock(return_value=Mock(data=[]))
+        manager = ContextManager(Mock(), db=db, token_counter=PalabrasCounter())
+        conv_id = uuid4()
+        context = await manager.add_message_to_context(conv_id, mensaje("tengo fiebre"), "u1")
+        manager._get_rag_context = AsyncMock(return_value="guía de fiebre")
+        prompt = context.get_context_messages()[0].content
+        
+        messages = await manager.get_context_for_ai(conv_id, rag_query="fiebre")
+        
+        assert "guía de fiebre" in messages[0].content
+        assert messages[0].tokens == manager.token_counter.contar_mensaje(messages[0])
+        assert context.get_context_messages()[0].content == prompt
+        await manager.close()
@@ -0,0 +1,226 @@
+# tests/test_vector_index.py
+"""
+Tests para el índice vectorial local de RAG
+"""
+
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, Mock
+from uuid import uuid4
+
+np = pytest.importorskip("numpy")
+
+from vector_index import LocalVectorIndex
+from services import IAService
+from models import RAGSearchRequest
+
+PACIENTE_A = str(uuid4())
+PACIENTE_B = str(uuid4())
+IDS = {i: str(uuid4()) for i in range(1, 5)}
+
+
+def _fila(i, paciente_id, vector):
+    return {
+        'id': IDS[i],
+        'reporte_id': str(uuid4()),
+        'paciente_id': paciente_id,
+        'contenido': f"fragmento {i}",
+        'embedding': vector
+    }
+
+
+@pytest.fixture
+def indice():
+    index = LocalVectorIndex(dim=3)
+    index.add([
+        _fila(1, PACIENTE_A, [1.0, 0.0, 0.0]),
+        _fila(2, PACIENTE_A, [0.0, 1.0, 0.0]),
+        _fila(3, PACIENTE_B, "[0.9, 0.1, 0.0]"),  # formato texto de PostgREST
+    ])
+    index.listo = True
+    return index
+
+
+class TablaEmbeddings:
+    """Query builder mínimo de supabase-py sobre reporte_embeddings_new"""
+
+    def __init__(self, filas):
+        self.filas = filas
+        self.columnas = None
+        self.filtros = []
+        self.limite = None
+
+    def select(self, columnas):
+        self.columnas = columnas.split(",")
+        return self
+
+    def order(self, columna):
+        return self
+
+    def gt(self, columna, valor):
+        self.filtros.append(lambda f: f[columna] > valor)
+        return self
+
+    def in_(self, columna, valores):
+        self.filtros.append(lambda f: f[columna] in valores)
+        return self
+
+    def limit(self, n):
+        self.limite = n
+        return self
+
+    def execute(self):
+        filas = sorted((f for f in self.filas if all(filtro(f) for filtro in self.filtros)),
+                       key=lambda f: f['id'])
+        filas = filas[:self.limite] if self.limite is not None else filas
+        return Mock(data=[{c: f.get(c) for c in self.columnas} for f in filas])
+
+
+def base_de_datos(filas):
+    supabase = Mock()
+    supabase.table.side_effect = lambda tabla: TablaEmbeddings(filas)
+    db = Mock()
+    db.execute = AsyncMock(side_effect=lambda consulta: consulta.execute())
+    return supabase, db
+
+
+class TestLocalVectorIndex:
+    """Tests para LocalVectorIndex"""
+
+    def test_search_ordena_por_similitud(self, indice):
+        """Test que los resultados vienen ordenados y respetan el umbral"""
+        resultados = indice.search([1.0, 0.0, 0.0], k=5, threshold=0.5)
+
+        assert [r['id'] for r in resultados] == [IDS[1], IDS[3]]
+        assert resultados[0]['similarity'] == pytest.approx(1.0)
+
+    def test_search_filtra_por_paciente(self, indice):
+        """Test que el filtro por paciente excluye otros pacientes"""
+        resultados = indice.search([1.0, 0.0, 0.0], k=5, paciente_id=PACIENTE_B)
+
+        assert [r['id'] for r in resultados] == [IDS[3]]
+        assert indice.search([1.0, 0.0, 0.0], paciente_id=str(uuid4())) == []
+
+    def test_add_ignora_duplicados(self, indice):
+        """Test que reinsertar el mismo id no duplica vectores"""
+        assert indice.add([_fila(1, PACIENTE_A, [1.0, 0.0, 0.0])]) == 0
+        assert len(indice) == 3
+
+    def test_save_y_load_memory_mapped(self, indice, tmp_path):
+        """Test que el snapshot se reabre memory-mapped y admite inserciones"""
+        indice.path = str(tmp_path / "rag_index")
+        indice.save()
+
+        cargado = LocalVectorIndex(dim=3, path=indice.path)
+        assert cargado.load()
+        assert cargado.get_stats()["memory_mapped"]
+        assert cargado.search([0.0, 1.0, 0.0], k=1)[0]['id'] == IDS[2]
+
+        cargado.add([_fila(4, PACIENTE_B, [0.0, 0.0, 1.0])])
+        assert len(cargado) == 4
+        assert cargado.search([0.0, 0.0, 1.0], k=1)[0]['id'] == IDS[4]
+
+    def test_snapshot_sin_texto_de_reportes(self, indice, tmp_path):
+        """Test que el snapshot en disco no contiene el contenido de los fragmentos"""
+        indice.path = str(tmp_path / "rag_index")
+        indice.save()
+
+        assert "fragmento" not in (tmp_path / "rag_index.json").read_text()
+        assert 'contenido' not in indice.search([1.0, 0.0, 0.0], k=1)[0]
+
+    def test_remove_excluye_filas_de_la_busqueda(self, indice):
+        """Test que las filas eliminadas dejan de aparecer, con y sin filtro por paciente"""
+        assert indice.remove([IDS[1], str(uuid4())]) == 1
+
+        assert [r['id'] for r in indice.search([1.0, 0.0, 0.0], k=5, threshold=-1.0)] == [IDS[3], IDS[2]]
+        assert indice.search([1.0, 0.0, 0.0], k=5, threshold=0.5, paciente_id=PACIENTE_A) == []
+        assert len(indice) == 2
+
+    @pytest.mark.asyncio
+    async def test_buscar_fuera_del_event_loop(self, indice, monkeypatch):
+        """Test que la búsqueda asíncrona corre en un hilo y da el mismo resultado"""
+        en_hilo = []
+        to_thread = asyncio.to_thread
+
+        async def registrar(func, *args, **kwargs):
+            en_hilo.append(func)
+            return await to_thread(func, *args, **kwargs)
+
+        monkeypatch.setattr("vector_index.asyncio.to_thread", registrar)
+
+        resultados = await indice.buscar([1.0, 0.0, 0.0], k=5, threshold=0.5)
+
+        assert en_hilo == [indice.search]
+        assert resultados == indice.search([1.0, 0.0, 0.0], k=5, threshold=0.5)
+
+    @pytest.mark.asyncio
+    async def test_agregar_y_eliminar_esperan_el_lock(self, indice):
+        """Test que las altas y bajas no mutan el índice mientras otra operación tiene el lock"""
+        async with indice._lock:
+            alta = asyncio.create_task(indice.agregar([_fila(4, PACIENTE_B, [0.0, 0.0, 1.0])]))
+            baja = asyncio.create_task(indice.eliminar([IDS[1]]))
+            await asyncio.sleep(0)
+            assert len(indice) == 3
+
+        assert await alta == 1
+        assert await baja == 1
+        assert len(indice) == 3
+        assert (await indice.buscar([0.0, 0.0, 1.0], k=1))[0]['id'] == IDS[4]
+
+    @pytest.mark.asyncio
+    async def test_sync_reconcilia_altas_y_borrados(self, indice):
+        """Test que la sincronización elimina filas borradas y agrega las de otros workers"""
+        filas = [_fila(2, PACIENTE_A, [0.0, 1.0, 0.0]), _fila(3, PACIENTE_B, [0.9, 0.1, 0.0]),
+                 _fila(4, PACIENTE_B, [0.0, 0.0, 1.0])]
+        supabase, db = base_de_datos(filas)
+
+        cambios = await indice.sync_with_database(supabase, db, page_size=2)
+
+        assert cambios == {"agregados": 1, "eliminados": 1}
+        assert indice.search([1.0, 0.0, 0.0], k=1)[0]['id'] == IDS[3]
+        assert indice.search([0.0, 0.0, 1.0], k=1)[0]['id'] == IDS[4]
+
+
+class TestBuscarRagConIndiceLocal:
+    """Tests para buscar_rag usando el índice local"""
+
+    @pytest.mark.asyncio
+    async def test_buscar_rag_no_llama_rpc(self, indice):
+        """Test que con el índice listo no se consulta la RPC y el texto se lee de la BD"""
+        embedding_service = Mock()
+        embedding_service.encode = AsyncMock(return_value=[1.0, 0.0, 0.0])
+        supabase, db = base_de_datos([_fila(1, PACIENTE_A, [1.0, 0.0, 0.0])])
+        service = IAService(supabase, embedding_service, "http://tgi", Mock(), db=db, vector_index=indice)
+
+        resultados = await service.buscar_rag(RAGSearchRequest(
+            query="consolidación", paciente_id=PACIENTE_A, umbral_similitud=0.5
+        ))
+
+        assert [r.contenido for r in resultados] == ["fragmento 1"]
+        supabase.rpc.assert_not_called()
+        db.execute.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_buscar_rag_omite_filas_borradas(self, indice):
+        """Test que un resultado del índice ya borrado en la BD no se devuelve"""
+        embedding_service = Mock()
+        embedding_service.encode = AsyncMock(return_value=[1.0, 0.0, 0.0])
+        supabase, db = base_de_datos([_fila(3, PACIENTE_B, [0.9, 0.1, 0.0])])
+        service = IAService(supabase, embedding_service, "http://tgi", Mock(), db=db, vector_index=indice)
+
+        resultados = await service.buscar_rag(RAGSearchRequest(query="consolidación", umbral_similitud=0.5))
+
+        assert [r.contenido for r in resultados] == ["fragmento 3"]
+
+    @pytest.mark.asyncio
+    async def test_buscar_rag_usa_rpc_si_indice_no_listo(self):
+        """Test que sin índice cargado se usa la función RPC"""
+        embedding_service = Mock()
+        embedding_service.encode = AsyncMock(return_value=[1.0, 0.0, 0.0])
+        db = Mock()
+        db.execute = AsyncMock(return_value=Mock(data=[]))
+        service = IAService(Mock(), embedding_service, "http://tgi", Mock(), db=db,
+                            vector_index=LocalVectorIndex(dim=3))
+
+        assert await service.buscar_rag(RAGSearchRequest(query="consolidación")) == []
+        db.execute.assert_awaited_once()
@@ -0,0 +1,126 @@
+# tests/test_write_behind.py
+"""
+Tests para la persistencia diferida por lotes
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from resilience import ResilienceConfig
+from write_behind import WriteBehindQueue
+
+RAPIDO = ResilienceConfig(max_intentos=3, base_delay=0.001, max_delay=0.001)
+
+class Destino:
+    """insert_fn que registra los lotes y falla según se indique"""
+    
+    def __init__(self, fallos=0, rechazar=None):
+        self.lotes = []
+        self.fallos = fallos
+        self.rechazar = rechazar
+    
+    async def __call__(self, filas):
+        if self.fallos:
+            self.fallos -= 1
+            raise RuntimeError("BD no disponible")
+        if self.rechazar and any(f["contenido"] == self.rechazar for f in filas):
+            raise ValueError("violación de clave foránea")
+        self.lotes.append([f["contenido"] for f in filas])
+
+def fila(contenido, conversacion="c1"):
+    return {"conversacion_id": conversacion, "contenido": contenido}
+
+class TestWriteBehindQueue:
+    """Tests para WriteBehindQueue"""
+    
+    @pytest.mark.asyncio
+    async def test_agrupa_por_tamano_en_orden(self, al_cerrar):
+        """Test que las filas se insertan en lotes y en orden de llegada"""
+        destino = Destino()
+        cola = al_cerrar(WriteBehindQueue("mensajes", destino, max_batch_size=2, max_wait_ms=1000, reintentos=RAPIDO))
+        for i in range(5):
+            await cola.submit(fila(f"m{i}", conversacion=f"c{i % 2}"))
+        
+        await cola.flush()
+        
+        assert destino.lotes == [["m0", "m1"], ["m2", "m3"], ["m4"]]
+        stats = cola.get_stats()
+        assert stats["persisted"] == 5 and stats["queue_depth"] == 0
+    
+    @pytest.mark.asyncio
+    async def test_ventana_de_tiempo(self, al_cerrar):
+        """Test que un lote incompleto se inserta al vencer la ventana"""
+        destino = Destino()
+        cola = al_cerrar(WriteBehindQueue("mensajes", destino, max_batch_size=50, max_wait_ms=20, reintentos=RAPIDO))
+        await cola.submit(fila("hola"))
+        
+        assert cola.get_stats()["queue_depth"] == 1
+        await asyncio.sleep(0.1)
+        
+        assert destino.lotes == [["hola"]]
+    
+    @pytest.mark.asyncio
+    async def test_reintenta_fallos_transitorios(self, al_cerrar):
+        """Test que un fallo transitorio se reintenta sin perder filas"""
+        destino = Destino(fallos=1)
+        cola = al_cerrar(WriteBehindQueue("mensajes", destino, max_batch_size=10, max_wait_ms=1, reintentos=RAPIDO))
+        await cola.submit(fila("a"))
+        await cola.submit(fila("b"))
+        
+        await cola.flush()
+        
+        assert destino.lotes == [["a", "b"]]
+        assert cola.get_stats()["retries"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_aisla_filas_rechazadas(self, tmp_path, al_cerrar):
+        """Test que una fila inválida no bloquea el lote y queda en el archivo de pendientes"""
+        pendientes = tmp_path / "pendientes.jsonl"
+        destino = Destino(rechazar="mala")
+        cola = al_cerrar(WriteBehindQueue("mensajes", destino, max_batch_size=10, max_wait_ms=1,
+                                          reintentos=RAPIDO, dead_letter_path=str(pendientes)))
+        for contenido in ["a", "mala", "b"]:
+            await cola.submit(fila(contenido))
+        
+        await cola.flush()
+        
+        assert destino.lotes == [["a"], ["b"]]
+        assert [json.loads(l)["contenido"] for l in pendientes.read_text().splitlines()] == ["mala"]
+        assert cola.get_stats()["failed"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_cierre_vacia_la_cola(self):
+        """Test que al cerrar se persiste lo pendiente sin esperar la ventana"""
+        destino = Destino()
+        cola = WriteBehindQueue("mensajes", destino, max_batch_size=50, max_wait_ms=60000, reintentos=RAPIDO)
+        await cola.submit(fila("último"))
+        
+        await asyncio.wait_for(cola.close(), 1)
+        
+        assert destino.lotes == [["último"]]
+        with pytest.raises(RuntimeError):
+            await cola.submit(fila("tarde"))
+    
+    @pytest.mark.asyncio
+    async def test_cierre_con_timeout_guarda_el_lote_en_curso(self, tmp_path):
+        """Test que al vencer el cierre se guardan el lote en curso y lo encolado"""
+        pendientes = tmp_path / "pendientes.jsonl"
+        bloqueo = asyncio.Event()
+        
+        async def insert_colgado(filas):
+            await bloqueo.wait()
+        
+        cola = WriteBehindQueue("mensajes", insert_colgado, max_batch_size=2, max_wait_ms=1,
+                                reintentos=RAPIDO, dead_letter_path=str(pendientes))
+        for contenido in ["a", "b"]:
+            await cola.submit(fila(contenido))
+        await asyncio.sleep(0.05)
+        assert cola.get_stats()["in_flight"] == 2
+        await cola.submit(fila("c"))
+        
+        await cola.close(timeout=0.05)
+        
+        assert [json.loads(l)["contenido"] for l in pendientes.read_text().splitlines()] == ["a", "b", "c"]
+        assert cola.get_stats()["failed"] == 3
@@ -0,0 +1,123 @@
+# token_counter.py - Radix IA
+"""
+Conteo de tokens para el presupuesto de contexto del chat.
+
+- `TokenizerFileCounter`: tokenizer real del modelo cargado localmente desde
+  un archivo `tokenizer.json` (requiere el paquete opcional `tokenizers`)
+- `HeuristicTokenCounter`: estimación por caracteres cuando no hay tokenizer
+
+Ambos guardan en caché (LRU) el conteo por contenido, de modo que cada
+mensaje se tokeniza una sola vez aunque el contexto se recalcule en cada
+turno. `TOKENIZER_PATH` selecciona el tokenizer del singleton.
+"""
+
+import os
+import math
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Union
+
+try:
+    from tokenizers import Tokenizer
+    TOKENIZERS_DISPONIBLE = True
+except ImportError:
+    Tokenizer = None
+    TOKENIZERS_DISPONIBLE = False
+
+from models import ChatMessage
+
+# Tokens de la plantilla de chat por mensaje (marcadores de turno y rol)
+TOKENS_POR_MENSAJE = 4
+
+
+class TokenCounter:
+    """Contador de tokens con caché por contenido"""
+
+    nombre = "base"
+
+    def __init__(self, cache_size: int = 4096, tokens_por_mensaje: int = TOKENS_POR_MENSAJE):
+        self.cache_size = cache_size
+        self.tokens_por_mensaje = tokens_por_mensaje
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def contar(self, texto: str) -> int:
+        """Tokens de un texto"""
+        tokens = self._cache.get(texto)
+        if tokens is not None:
+            self.hits += 1
+            self._cache.move_to_end(texto)
+            return tokens
+
+        self.misses += 1
+        tokens = self._contar(texto)
+        self._cache[texto] = tokens
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def contar_mensaje(self, message: Union[ChatMessage, Dict[str, Any]]) -> int:
+        """Tokens de un mensaje, incluida la plantilla de chat"""
+        content = message["content"] if isinstance(message, dict) else message.content
+        return self.contar(content) + self.tokens_por_mensaje
+
+    def contar_mensajes(self, messages: Iterable[Union[ChatMessage, Dict[str, Any]]]) -> int:
+        """Tamaño del prompt de una lista de mensajes"""
+        return sum(self.contar_mensaje(m) for m in messages)
+
+    def _contar(self, texto: str) -> int:
+        raise NotImplementedError
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "tokenizer": self.nombre,
+            "cached_texts": len(self._cache),
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+
+class HeuristicTokenCounter(TokenCounter):
+    """Estimación por caracteres (≈3 caracteres por token en español clínico)"""
+
+    nombre = "heuristico"
+
+    def __init__(self, chars_por_token: float = 3.0, **kwargs):
+        super().__init__(**kwargs)
+        self.chars_por_token = chars_por_token
+
+    def _contar(self, texto: str) -> int:
+        return math.ceil(len(texto) / self.chars_por_token)
+
+
+class TokenizerFileCounter(TokenCounter):
+    """Tokenizer del modelo cargado desde un archivo tokenizer.json local"""
+
+    def __init__(self, path: str, **kwargs):
+        if not TOKENIZERS_DISPONIBLE:
+            raise ImportError("El paquete 'tokenizers' no está instalado")
+        super().__init__(**kwargs)
+        self._tokenizer = Tokenizer.from_file(path)
+        self.nombre = os.path.basename(os.path.dirname(os.path.abspath(path))) or path
+
+    def _contar(self, texto: str) -> int:
+        return len(self._tokenizer.encode(texto, add_special_tokens=False).ids)
+
+
+# Singleton global para el contador de tokens
+_token_counter: Optional[TokenCounter] = None
+
+def get_token_counter() -> TokenCounter:
+    """Obtener instancia singleton del contador de tokens"""
+    global _token_counter
+    if _token_counter is None:
+        path = os.environ.get("TOKENIZER_PATH")
+        if path:
+            try:
+                _token_counter = TokenizerFileCounter(path)
+                print(f"✅ Tokenizer cargado desde {path}")
+            except Exception as e:
+                print(f"⚠️ No se pudo cargar el tokenizer ({e}); se usará la estimación por caracteres")
+        if _token_counter is None:
+            _token_counter = HeuristicTokenCounter()
+    return _token_counter
@@ -0,0 +1,314 @@
+# vector_index.py - Radix IA
+"""
+Índice vectorial en proceso para la búsqueda RAG.
+
+Mantiene los embeddings de `reporte_embeddings_new` como una matriz float32
+normalizada y resuelve la similitud coseno con un único producto
+matriz-vector (búsqueda exacta). La matriz se persiste en disco y se abre
+memory-mapped al arrancar; las inserciones nuevas se agregan de forma
+incremental y las filas borradas se marcan como eliminadas. Desde código
+asíncrono se usan `buscar`/`agregar`/`eliminar`, que serializan el acceso con
+`_lock` y sacan la búsqueda del event loop.
+
+El índice guarda solo ids, metadatos de fragmento y vectores: el texto de
+los reportes (datos del paciente) no se guarda en memoria ni en el snapshot,
+se obtiene de la BD para los resultados de cada búsqueda. `sync_with_database`
+reconcilia los ids con la tabla (altas de otros workers y borrados, p. ej.
+tras `backfill --rebuild`).
+
+NumPy es una dependencia opcional: si no está instalada el índice queda
+deshabilitado y `IAService.buscar_rag` usa la función RPC de Supabase.
+"""
+
+import os
+import json
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depende del entorno
+    np = None
+
+
+def _parse_vector(value: Any) -> List[float]:
+    """PostgREST devuelve las columnas vector como texto '[0.1,0.2,...]'"""
+    if isinstance(value, str):
+        return json.loads(value)
+    return list(value)
+
+
+class LocalVectorIndex:
+    """Índice de similitud coseno en memoria con filtro por paciente"""
+
+    def __init__(self, dim: int = 1024, path: Optional[str] = None):
+        self.dim = dim
+        self.path = path
+        self.listo = False
+        self._size = 0
+        self._matrix = None           # float32 [capacidad, dim], filas normalizadas
+        self._pacientes = None        # int32 [capacidad], código de paciente por fila
+        self._activos = None          # bool [capacidad], False si la fila se eliminó
+        self._paciente_codes: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._reporte_ids: List[str] = []
+        self._paciente_ids: List[str] = []
+        self._secciones: List[Optional[str]] = []
+        self._offsets: List[List[Optional[int]]] = []  # [chunk_inicio, chunk_fin]
+        self._posiciones: Dict[str, int] = {}  # id -> fila de las filas activas
+        self._lock = asyncio.Lock()
+
+    @property
+    def disponible(self) -> bool:
+        """El índice requiere NumPy"""
+        return np is not None
+
+    def __len__(self) -> int:
+        return len(self._posiciones)
+
+    # -------------------------------
+    # Inserción
+    # -------------------------------
+
+    def add(self, rows: Sequence[Dict[str, Any]]) -> int:
+        """Agregar filas {id, reporte_id, paciente_id, embedding[, seccion, chunk_inicio, chunk_fin]}"""
+        if not self.disponible:
+            return 0
+
+        nuevas = [r for r in rows if r.get('id') and str(r['id']) not in self._posiciones]
+        if not nuevas:
+            return 0
+
+        vectores = np.asarray([_parse_vector(r['embedding']) for r in nuevas], dtype=np.float32)
+        if vectores.ndim != 2 or vectores.shape[1] != self.dim:
+            raise ValueError(f"Dimensión de embedding inválida: {vectores.shape}, se esperaba {self.dim}")
+        normas = np.linalg.norm(vectores, axis=1, keepdims=True)
+        vectores /= np.where(normas == 0, 1, normas)
+
+        self._ensure_capacity(self._size + len(nuevas))
+        fin = self._size + len(nuevas)
+        self._matrix[self._size:fin] = vectores
+        for offset, row in enumerate(nuevas):
+            paciente = str(row['paciente_id'])
+            code = self._paciente_codes.setdefault(paciente, len(self._paciente_codes))
+            self._pacientes[self._size + offset] = code
+            self._activos[self._size + offset] = True
+            self._ids.append(str(row['id']))
+            self._reporte_ids.append(str(row['reporte_id']))
+            self._paciente_ids.append(paciente)
+            self._secciones.append(row.get('seccion'))
+            self._offsets.append([row.get('chunk_inicio'), row.get('chunk_fin')])
+            self._posiciones[str(row['id'])] = self._size + offset
+        self._size = fin
+        return len(nuevas)
+
+    def remove(self, ids: Iterable[str]) -> int:
+        """Marcar filas como eliminadas (dejan de aparecer en las búsquedas)"""
+        eliminadas = 0
+        for id_ in ids:
+            fila = self._posiciones.pop(str(id_), None)
+            if fila is not None:
+                self._activos[fila] = False
+                eliminadas += 1
+        return eliminadas
+
+    def _ensure_capacity(self, requerida: int) -> None:
+        """Crecer la matriz (duplicando capacidad) y copiar si está memory-mapped"""
+        capacidad = 0 if self._matrix is None else self._matrix.shape[0]
+        writable = self._matrix is not None and self._matrix.flags.writeable
+        if requerida <= capacidad and writable:
+            return
+
+        nueva_capacidad = max(requerida, capacidad * 2, 1024)
+        matrix = np.zeros((nueva_capacidad, self.dim), dtype=np.float32)
+        pacientes = np.zeros(nueva_capacidad, dtype=np.int32)
+        activos = np.zeros(nueva_capacidad, dtype=bool)
+        if self._size:
+            matrix[:self._size] = self._matrix[:self._size]
+            pacientes[:self._size] = self._pacientes[:self._size]
+            activos[:self._size] = self._activos[:self._size]
+        self._matrix, self._pacientes, self._activos = matrix, pacientes, activos
+
+    # -------------------------------
+    # Búsqueda
+    # -------------------------------
+
+    def search(self, query_embedding: Sequence[float], k: int = 5, threshold: float = 0.0,
+               paciente_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Top-k por similitud coseno, opcionalmente filtrado por paciente
+        
+        Los resultados no incluyen `contenido`: se obtiene de la BD por id.
+        """
+        if not self.disponible or not self._posiciones:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norma = np.linalg.norm(query)
+        if norma == 0:
+            return []
+        query /= norma
+
+        matrix = self._matrix[:self._size]
+        activos = self._activos[:self._size]
+        if paciente_id is not None:
+            code = self._paciente_codes.get(str(paciente_id))
+            if code is None:
+                return []
+            filas = np.nonzero((self._pacientes[:self._size] == code) & activos)[0]
+            if filas.size == 0:
+                return []
+            scores = matrix[filas] @ query
+        else:
+            filas = None
+            scores = matrix @ query
+            scores[~activos] = -np.inf
+
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        resultados = []
+        for pos in top:
+            similitud = float(scores[pos])
+            if similitud <= threshold:
+                break
+            fila = int(filas[pos]) if filas is not None else int(pos)
+            resultados.append({
+                'id': self._ids[fila],
+                'reporte_id': self._reporte_ids[fila],
+                'paciente_id': self._paciente_ids[fila],
+                'seccion': self._secciones[fila],
+                'chunk_inicio': self._offsets[fila][0],
+                'chunk_fin': self._offsets[fila][1],
+                'similarity': similitud
+            })
+        return resultados
+
+    # -------------------------------
+    # Acceso desde el event loop
+    # -------------------------------
+
+    async def buscar(self, query_embedding: Sequence[float], k: int = 5, threshold: float = 0.0,
+                     paciente_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """`search` en un hilo, sin bloquear el loop con el producto matriz-vector
+        
+        Se ejecuta bajo `_lock` para no leer las matrices mientras `agregar` o
+        `sync_with_database` las reemplazan al crecer.
+        """
+        async with self._lock:
+            return await asyncio.to_thread(self.search, query_embedding, k, threshold, paciente_id)
+
+    async def agregar(self, rows: Sequence[Dict[str, Any]]) -> int:
+        """`add` bajo `_lock` (no se mezcla con búsquedas ni sincronizaciones en curso)"""
+        async with self._lock:
+            return self.add(rows)
+
+    async def eliminar(self, ids: Iterable[str]) -> int:
+        """`remove` bajo `_lock`"""
+        async with self._lock:
+            return self.remove(ids)
+
+    # -------------------------------
+    # Persistencia
+    # -------------------------------
+
+    def save(self) -> None:
+        """Persistir matriz (.npy) y metadatos (.json) de las filas activas en `path`
+        
+        El snapshot no contiene el texto de los fragmentos, solo ids y vectores.
+        """
+        if not (self.disponible and self.path and self._posiciones):
+            return
+        filas = sorted(self._posiciones.values())
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        np.save(f"{self.path}.npy.tmp.npy", np.ascontiguousarray(self._matrix[filas]))
+        os.replace(f"{self.path}.npy.tmp.npy", f"{self.path}.npy")
+        with open(f"{self.path}.json.tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                'dim': self.dim,
+                'ids': [self._ids[i] for i in filas],
+                'reporte_ids': [self._reporte_ids[i] for i in filas],
+                'paciente_ids': [self._paciente_ids[i] for i in filas],
+                'secciones': [self._secciones[i] for i in filas],
+                'offsets': [self._offsets[i] for i in filas]
+            }, f, ensure_ascii=False)
+        os.replace(f"{self.path}.json.tmp", f"{self.path}.json")
+
+    def load(self) -> bool:
+        """Abrir la matriz persistida en modo memory-mapped (solo lectura)"""
+        if not (self.disponible and self.path):
+            return False
+        if not (os.path.exists(f"{self.path}.npy") and os.path.exists(f"{self.path}.json")):
+            return False
+
+        with open(f"{self.path}.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(f"{self.path}.npy", mmap_mode='r')
+        if meta.get('dim') != self.dim or matrix.shape[0] != len(meta['ids']):
+            print("⚠️ Índice vectorial persistido inconsistente, se reconstruirá")
+            return False
+
+        self._matrix = matrix
+        self._size = matrix.shape[0]
+        self._ids = meta['ids']
+        self._reporte_ids = meta['reporte_ids']
+        self._paciente_ids = meta['paciente_ids']
+        self._secciones = meta.get('secciones') or [None] * self._size
+        self._offsets = meta.get('offsets') or [[None, None]] * self._size
+        self._posiciones = {id_: i for i, id_ in enumerate(self._ids)}
+        self._activos = np.ones(self._size, dtype=bool)
+        self._paciente_codes = {}
+        self._pacientes = np.zeros(self._size, dtype=np.int32)
+        for i, paciente in enumerate(self._paciente_ids):
+            self._pacientes[i] = self._paciente_codes.setdefault(paciente, len(self._paciente_codes))
+        self.listo = True
+        return True
+
+    async def sync_with_database(self, supabase, db, page_size: int = 1000) -> Dict[str, int]:
+        """Reconciliar el índice con `reporte_embeddings_new`
+        
+        Recorre solo los ids de la tabla (keyset por id), elimina del índice los
+        que ya no existen y carga los embeddings de los que faltan.
+        """
+        if not self.disponible:
+            return {"agregados": 0, "eliminados": 0}
+        async with self._lock:
+            en_bd = set()
+            faltantes: List[str] = []
+            last_id = None
+            while True:
+                query = supabase.table('reporte_embeddings_new').select('id').order('id')
+                if last_id:
+                    query = query.gt('id', last_id)
+                result = await db.execute(query.limit(page_size))
+                rows = result.data or []
+                if not rows:
+                    break
+                for row in rows:
+                    id_ = str(row['id'])
+                    en_bd.add(id_)
+                    if id_ not in self._posiciones:
+                        faltantes.append(id_)
+                last_id = rows[-1]['id']
+
+            eliminados = self.remove([id_ for id_ in list(self._posiciones) if id_ not in en_bd])
+            agregados = 0
+            # Los embeddings se piden en tandas acotadas (la URL lleva los ids)
+            for inicio in range(0, len(faltantes), 100):
+                result = await db.execute(supabase.table('reporte_embeddings_new').select(
+                    'id,reporte_id,paciente_id,seccion,chunk_inicio,chunk_fin,embedding'
+                ).in_('id', faltantes[inicio:inicio + 100]))
+                agregados += self.add(result.data or [])
+            self.listo = True
+            return {"agregados": agregados, "eliminados": eliminados}
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estado del índice"""
+        return {
+            "disponible": self.disponible,
+            "listo": self.listo,
+            "vectores": len(self._posiciones),
+            "eliminados": self._size - len(self._posiciones),
+            "pacientes": len(self._paciente_codes),
+            "memory_mapped": bool(self._matrix is not None and not self._matrix.flags.writeable)
+        }
@@ -0,0 +1,187 @@
+# write_behind.py - Radix IA
+"""
+Persistencia diferida (write-behind) con inserciones por lotes.
+
+Las filas se encolan sin esperar a la BD y un único consumidor las inserta
+en lotes multi-fila cuando se junta `max_batch_size` o pasa `max_wait_ms`
+desde la primera fila pendiente. Al haber un solo consumidor que no avanza
+hasta confirmar el lote, las filas se insertan en el orden de llegada (y por
+tanto en orden dentro de cada conversación).
+
+Los fallos se reintentan con backoff; si un lote sigue fallando se inserta
+fila por fila para aislar las filas problemáticas, que se guardan en un
+archivo JSONL de pendientes en lugar de perderse.
+"""
+
+import json
+import time
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from resilience import ResilienceConfig
+
+
+class WriteBehindQueue:
+    """Cola de filas pendientes de insertar, agrupadas en lotes"""
+
+    def __init__(self, nombre: str, insert_fn: Callable[[List[Dict[str, Any]]], Awaitable[Any]],
+                 max_batch_size: int = 50, max_wait_ms: float = 200.0,
+                 max_queue: int = 10000, reintentos: Optional[ResilienceConfig] = None,
+                 dead_letter_path: Optional[str] = None):
+        self.nombre = nombre
+        self.insert_fn = insert_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+        self.reintentos = reintentos or ResilienceConfig(max_intentos=5, base_delay=0.5, max_delay=10.0)
+        self.dead_letter_path = dead_letter_path
+        self._filas: Deque[Dict[str, Any]] = deque()
+        self._encoladas_en: Deque[float] = deque()
+        self._hay_filas: Optional[asyncio.Event] = None
+        self._hay_espacio: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._lote: List[Dict[str, Any]] = []  # Lote en curso aún sin confirmar
+        self._cerrando = False
+        self._forzar = False  # flush() pendiente: no esperar la ventana del lote
+        self.lotes = 0
+        self.insertadas = 0
+        self.reintentos_realizados = 0
+        self.fallidas = 0
+
+    def __len__(self) -> int:
+        return len(self._filas) + len(self._lote)
+
+    async def submit(self, fila: Dict[str, Any]) -> None:
+        """Encolar una fila (espera solo si la cola está llena)"""
+        if self._cerrando:
+            raise RuntimeError(f"La cola {self.nombre} está cerrada")
+        self._iniciar()
+        while len(self._filas) >= self.max_queue:
+            self._hay_espacio.clear()
+            await self._hay_espacio.wait()
+        self._filas.append(fila)
+        self._encoladas_en.append(time.monotonic())
+        self._hay_filas.set()
+
+    def _iniciar(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._hay_filas = self._hay_filas or asyncio.Event()
+            self._hay_espacio = self._hay_espacio or asyncio.Event()
+            self._worker = asyncio.create_task(self._consumir())
+
+    async def _consumir(self) -> None:
+        while True:
+            if not self._filas:
+                self._forzar = False
+                if self._cerrando:
+                    return
+                self._hay_filas.clear()
+                await self._hay_filas.wait()
+                continue
+
+            # Esperar a completar el lote o a que venza la ventana de la fila más antigua
+            espera = self._encoladas_en[0] + self.max_wait - time.monotonic()
+            if (len(self._filas) < self.max_batch_size and espera > 0
+                    and not self._cerrando and not self._forzar):
+                self._hay_filas.clear()
+                try:
+                    await asyncio.wait_for(self._hay_filas.wait(), espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            cantidad = min(self.max_batch_size, len(self._filas))
+            lote = [self._filas.popleft() for _ in range(cantidad)]
+            for _ in range(cantidad):
+                self._encoladas_en.popleft()
+            self._hay_espacio.set()
+            self._lote = lote
+            try:
+                await self._insertar(lote)
+            finally:
+                self._lote = []
+
+    async def _insertar(self, lote: List[Dict[str, Any]]) -> None:
+        """Insertar un lote con reintentos; aislar las filas que sigan fallando"""
+        if await self._intentar(lote, self.reintentos.max_intentos):
+            self.lotes += 1
+            self.insertadas += len(lote)
+            return
+        if len(lote) == 1:
+            self._descartar(lote)
+            return
+        print(f"⚠️ Lote de {len(lote)} filas rechazado en {self.nombre}; insertando fila por fila")
+        for fila in list(lote):
+            if await self._intentar([fila], 1):
+                self.lotes += 1
+                self.insertadas += 1
+            else:
+                self._descartar([fila])
+            # Resuelta: ya no forma parte del lote en curso
+            lote.pop(0)
+
+    async def _intentar(self, lote: List[Dict[str, Any]], intentos: int) -> bool:
+        for intento in range(intentos):
+            try:
+                await self.insert_fn(lote)
+                return True
+            except Exception as e:
+                print(f"⚠️ Error insertando {len(lote)} filas en {self.nombre} (intento {intento + 1}): {e}")
+                if intento < intentos - 1:
+                    self.reintentos_realizados += 1
+                    await asyncio.sleep(self.reintentos.espera(intento))
+        return False
+
+    def _descartar(self, filas: List[Dict[str, Any]]) -> None:
+        """Guardar en el archivo de pendientes las filas que no se pudieron insertar"""
+        self.fallidas += len(filas)
+        if not self.dead_letter_path:
+            print(f"❌ {len(filas)} filas de {self.nombre} no se pudieron persistir")
+            return
+        try:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                for fila in filas:
+                    f.write(json.dumps(fila, ensure_ascii=False, default=str) + "\n")
+            print(f"❌ {len(filas)} filas de {self.nombre} guardadas en {self.dead_letter_path}")
+        except OSError as e:
+            print(f"❌ {len(filas)} filas de {self.nombre} perdidas: {e}")
+
+    async def flush(self) -> None:
+        """Esperar a que se persista todo lo encolado hasta ahora"""
+        while len(self) and self._worker is not None and not self._worker.done():
+            self._forzar = True
+            self._hay_filas.set()
+            await asyncio.sleep(0.01)
+
+    async def close(self, timeout: Optional[float] = 30.0) -> None:
+        """Vaciar la cola y detener el consumidor (apagado ordenado)"""
+        self._cerrando = True
+        if self._worker is None or self._worker.done():
+            return
+        self._hay_filas.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._worker), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {len(self)} filas de {self.nombre} sin persistir al cerrar")
+            # El lote en curso (sin confirmar) va primero para conservar el orden
+            pendientes = list(self._lote) + list(self._filas)
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._filas.clear()
+            self._encoladas_en.clear()
+            self._descartar(pendientes)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Profundidad de la cola y métricas de persistencia"""
+        antiguedad = time.monotonic() - self._encoladas_en[0] if self._encoladas_en else 0.0
+        return {
+            "queue_depth": len(self._filas),
+            "in_flight": len(self._lote),
+            "oldest_pending_ms": round(antiguedad * 1000, 1),
+            "batches": self.lotes,
+            "persisted": self.insertadas,
+            "avg_batch_size": round(self.insertadas / self.lotes, 2) if self.lotes else 0.0,
+            "retries": self.reintentos_realizados,
+            "failed": self.fallidas
+        }